@@ -0,0 +1,152 @@
+'''Measures the startup cost of the three lambda handlers.
+
+Every sample runs in a fresh interpreter, like a lambda cold start, and reports:
+- import: time to import the handler module (includes building the clients in prewarm mode)
+- first: latency of the first invocation
+- warm: latency of the second invocation in the same interpreter
+
+AWS calls are answered by canned responses hooked into botocore's before-call event,
+so real clients and service models are built but nothing is sent over the network.
+
+Usage, from the repository root:
+    python benchmarks/cold_start.py --runs 5 --mode both
+    python benchmarks/cold_start.py --handler evaluate_instance --top-imports 15
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLERS = ('evaluate_instance', 'stop_instance', 'lock_instance')
+MODES = ('prewarm', 'lazy')
+
+with open(os.path.join(ROOT, 'tests', 'describe_instance_response.json'), encoding='utf-8') as f:
+    DESCRIBE_INSTANCES_RESPONSE = json.load(f)
+with open(os.path.join(ROOT, 'tests', 'describe_security_groups_response.json'), encoding='utf-8') as f:
+    DESCRIBE_SECURITY_GROUPS_RESPONSE = json.load(f)
+
+INSTANCE = DESCRIBE_INSTANCES_RESPONSE['Reservations'][0]['Instances'][0]
+# Canned responses keyed by operation name
+RESPONSES = {
+    'DescribeInstances': DESCRIBE_INSTANCES_RESPONSE,
+    'DescribeSecurityGroups': DESCRIBE_SECURITY_GROUPS_RESPONSE,
+    'DescribeAutoScalingInstances': {'AutoScalingInstances': []},
+    'GetQueueUrl': {'QueueUrl': 'https://sqs.us-east-1.amazonaws.com/000000000000/benchmark_queue'},
+    'SendMessageBatch': {'Successful': [], 'Failed': []},
+    'StopInstances': {'StoppingInstances': [{'InstanceId': INSTANCE['InstanceId']}]},
+    'CreateSecurityGroup': {'GroupId': 'sg-quarantine'},
+    'ModifyInstanceAttribute': {},
+}
+DECISION = {
+    'instance_id': INSTANCE['InstanceId'],
+    'flag': 'default',
+    'security_group_ids': [sg['GroupId'] for sg in INSTANCE['SecurityGroups']],
+    'vpc_id': INSTANCE['VpcId'],
+    'region': 'us-east-1',
+}
+EVENTS = {
+    'evaluate_instance': {'instance_id': INSTANCE['InstanceId'], 'region': 'us-east-1'},
+    'stop_instance': dict(DECISION, action='stop'),
+    'lock_instance': dict(DECISION, action='lock'),
+}
+
+
+def stub_response(model, **kwargs):
+    '''before-call handler, short circuits the request with the canned response of the operation'''
+    from botocore.awsrequest import AWSResponse
+    return AWSResponse('https://benchmark.invalid', 200, {}, None), RESPONSES.get(model.name, {})
+
+
+def run_child(handler):
+    '''Imports and invokes one handler, prints the timings as a JSON line'''
+    sys.path.insert(0, os.path.join(ROOT, 'src', 'common'))
+    sys.path.insert(0, os.path.join(ROOT, 'src', handler))
+    start = time.perf_counter()
+    module = __import__(handler)
+    imported = time.perf_counter()
+    # Every client the handler builds answers from the canned responses
+    original_get_client = module.get_client
+    stubbed = set()
+    def get_client(service, region):
+        client = original_get_client(service, region)
+        if id(client) not in stubbed:
+            client.meta.events.register('before-call', stub_response)
+            stubbed.add(id(client))
+        return client
+    module.get_client = get_client
+    event = {'Records': [{'messageId': 'benchmark-1', 'body': json.dumps(EVENTS[handler])}]}
+    first_start = time.perf_counter()
+    module.lambda_handler(event, None)
+    first_end = time.perf_counter()
+    module.lambda_handler(event, None)
+    warm_end = time.perf_counter()
+    print(json.dumps({
+        'import': (imported - start) * 1000,
+        'first': (first_end - first_start) * 1000,
+        'warm': (warm_end - first_end) * 1000,
+    }))
+
+
+def sample(handler, mode):
+    '''Runs one cold start of a handler in a fresh interpreter, returns its timings'''
+    env = dict(os.environ, STARTUP_MODE=mode, AWS_DEFAULT_REGION='us-east-1')
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', handler],
+                            env=env, cwd=ROOT, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return json.loads(output.stdout.decode().strip().splitlines()[-1])
+
+
+def top_imports(handler, count):
+    '''Returns the slowest imports of a handler module, by cumulative time, using python -X importtime'''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + handler],
+                            env=dict(os.environ, STARTUP_MODE='lazy', PYTHONPATH=os.path.join(ROOT, 'src', 'common')), cwd=os.path.join(ROOT, 'src', handler),
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = []
+    for line in output.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time: self [us] | cumulative | imported package
+        _, cumulative, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        imports.append((int(cumulative), name))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handler', choices=HANDLERS, action='append', help='handler to benchmark, defaults to all')
+    parser.add_argument('--mode', choices=MODES + ('both',), default='both')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts per handler and mode')
+    parser.add_argument('--top-imports', type=int, default=0, help='also list the N slowest imports of each handler')
+    parser.add_argument('--json', action='store_true', help='print the raw samples as JSON')
+    parser.add_argument('--child', choices=HANDLERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child)
+        return
+    handlers = args.handler or HANDLERS
+    modes = MODES if args.mode == 'both' else (args.mode,)
+    results = {}
+    for handler in handlers:
+        for mode in modes:
+            results['{0}/{1}'.format(handler, mode)] = [sample(handler, mode) for _ in range(args.runs)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{0:<28} {1:>12} {2:>12} {3:>12} {4:>14}'.format('handler/mode', 'import ms', 'first ms', 'warm ms', 'cold total ms'))
+    for name, samples in results.items():
+        medians = {key: statistics.median(s[key] for s in samples) for key in ('import', 'first', 'warm')}
+        print('{0:<28} {1:>12.1f} {2:>12.1f} {3:>12.1f} {4:>14.1f}'.format(
+            name, medians['import'], medians['first'], medians['warm'], medians['import'] + medians['first']))
+    if not args.top_imports:
+        return
+    for handler in handlers:
+        print('\nSlowest imports of {0} (cumulative us):'.format(handler))
+        for cumulative, name in top_imports(handler, args.top_imports):
+            print('{0:>10}  {1}'.format(cumulative, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+'''In-process fake of the EC2, Auto Scaling, SQS, Lambda, DynamoDB and STS APIs the lambdas call, backed by a generated Fleet.
+
+Every call is counted per service and operation, so benchmarks and tests can assert
+how many AWS calls a handler makes. Errors are raised as botocore ClientErrors with the
+codes the real APIs use, e.g. InvalidInstanceID.NotFound for an unknown instance.
+'''
+import copy
+import datetime
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+QUEUE_URL_PREFIX = 'https://sqs.us-east-1.amazonaws.com/000000000000/'
+# Access keys of assumed role credentials are this prefix and the account ID
+ASSUMED_KEY_PREFIX = 'ASIA'
+# Error code each service throttles with
+THROTTLE_CODES = {'ec2': 'RequestLimitExceeded', 'autoscaling': 'Throttling', 'sqs': 'ThrottlingException', 'lambda': 'TooManyRequestsException',
+                  'dynamodb': 'ProvisionedThroughputExceededException', 'sts': 'Throttling'}
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+def paginate(items, max_results, next_token):
+    '''Returns the page of items starting at next_token and the token of the next page'''
+    start = int(next_token or 0)
+    if not max_results:
+        return items[start:], None
+    end = start + max_results
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+def tag_value(resource, key):
+    for tag in resource.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+class FakeAws:
+    '''Fake AWS account backed by a Fleet. Use patched() to route boto3.client to it.
+    With api_rate set, every service and region allows api_rate calls per second with bursts of api_burst,
+    like the EC2 token buckets, and throttles the calls above it'''
+    def __init__(self, fleet, latency_seconds=0.0, api_rate=None, api_burst=None):
+        self.fleet = fleet
+        self.latency_seconds = latency_seconds
+        self.api_rate = api_rate
+        self.api_burst = api_burst or api_rate
+        # (service, region) -> [tokens, last refill]
+        self.buckets = {}
+        self.calls = Counter()
+        self.throttled = Counter()
+        # queue name -> list of message bodies
+        self.queues = defaultdict(list)
+        self.stopped = set()
+        # instance ID -> security group IDs it was modified to
+        self.modified = {}
+        # Instances whose stop or security group change is refused, like stop protected instances or a denied IAM policy
+        self.unstoppable = set()
+        self.unlockable = set()
+        # (function name, payload) of every asynchronous lambda invocation
+        self.invocations = []
+        # table name -> key value -> item, DynamoDB items in their typed attribute form
+        self.tables = defaultdict(dict)
+        # Role ARN of every AssumeRole call, and the number of clients built per (account, service).
+        # Every account sees the same fleet, the account of a client is the one its assumed credentials were issued for
+        self.assumed_roles = []
+        self.clients = Counter()
+        self._lock = threading.Lock()
+
+    def client(self, service, region_name=None, aws_access_key_id=None, **kwargs):
+        '''Stands in for boto3.client'''
+        clients = {'ec2': FakeEc2, 'autoscaling': FakeAutoscaling, 'sqs': FakeSqs, 'lambda': FakeLambda, 'dynamodb': FakeDynamoDb, 'sts': FakeSts}
+        account_id = aws_access_key_id[len(ASSUMED_KEY_PREFIX):] if aws_access_key_id else None
+        with self._lock:
+            self.clients[(account_id, service)] += 1
+        return clients[service](self, region_name)
+
+    def record(self, service, operation, region=None):
+        with self._lock:
+            self.calls[(service, operation)] += 1
+            if self.api_rate and not self._take_token(service, region):
+                self.throttled[(service, operation)] += 1
+                raise client_error(THROTTLE_CODES[service], operation, 'Rate exceeded')
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def _take_token(self, service, region):
+        now = time.monotonic()
+        bucket = self.buckets.setdefault((service, region), [self.api_burst, now])
+        bucket[0] = min(self.api_burst, bucket[0] + (now - bucket[1]) * self.api_rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def calls_by_service(self):
+        '''Returns the number of calls per service'''
+        totals = Counter()
+        for (service, _), count in self.calls.items():
+            totals[service] += count
+        return dict(totals)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    @contextmanager
+    def patched(self, *modules):
+        '''Routes boto3.client to this fake and clears the modules' cached clients and lookups on the way in and out'''
+        def reset():
+            for module in modules:
+                module.reset_clients()
+                if hasattr(module, 'reset_lookup_caches'):
+                    module.reset_lookup_caches()
+        with mock.patch('boto3.client', self.client):
+            reset()
+            try:
+                yield self
+            finally:
+                reset()
+
+
+class FakeClient:
+    service = None
+
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.fleet = aws.fleet
+        self.region = region
+
+    def _record(self, operation):
+        self.aws.record(self.service, operation, self.region)
+
+
+class FakeEc2(FakeClient):
+    service = 'ec2'
+
+    def describe_instances(self, InstanceIds=None, Filters=None, MaxResults=None, NextToken=None):
+        self._record('DescribeInstances')
+        instances = self.fleet.instances[self.region]
+        if InstanceIds is not None:
+            missing = [instance_id for instance_id in InstanceIds if instance_id not in instances]
+            if missing:
+                raise client_error('InvalidInstanceID.NotFound', 'DescribeInstances', 'The instance IDs {0} do not exist'.format(missing))
+            selected = [instances[instance_id] for instance_id in dict.fromkeys(InstanceIds)]
+        else:
+            selected = list(instances.values())
+        for f in Filters or []:
+            if f['Name'] == 'instance-state-name':
+                selected = [i for i in selected if self._state(i) in f['Values']]
+            elif f['Name'] == 'instance.group-id':
+                selected = [i for i in selected if any(sg['GroupId'] in f['Values'] for sg in i['SecurityGroups'])]
+        page, token = paginate(selected, MaxResults, NextToken)
+        response = {'Reservations': [{'ReservationId': 'r-' + i['InstanceId'][2:], 'Instances': [copy.deepcopy(dict(i, State=self._state_dict(i)))]} for i in page]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def _state(self, instance):
+        return 'stopping' if instance['InstanceId'] in self.aws.stopped else instance['State']['Name']
+
+    def _state_dict(self, instance):
+        if instance['InstanceId'] in self.aws.stopped:
+            return {'Code': 64, 'Name': 'stopping'}
+        return instance['State']
+
+    def describe_regions(self, Filters=None):
+        self._record('DescribeRegions')
+        return {'Regions': [{'RegionName': region, 'OptInStatus': 'opt-in-not-required'} for region in self.fleet.regions()]}
+
+    def describe_security_groups(self, GroupIds=None, Filters=None, MaxResults=None, NextToken=None):
+        self._record('DescribeSecurityGroups')
+        groups = self.fleet.security_groups[self.region]
+        if GroupIds is not None:
+            missing = [sg_id for sg_id in GroupIds if sg_id not in groups]
+            if missing:
+                raise client_error('InvalidGroup.NotFound', 'DescribeSecurityGroups', 'The security groups {0} do not exist'.format(missing))
+            selected = [groups[sg_id] for sg_id in dict.fromkeys(GroupIds)]
+        else:
+            selected = list(groups.values())
+        for f in Filters or []:
+            if f['Name'] == 'vpc-id':
+                selected = [sg for sg in selected if sg['VpcId'] in f['Values']]
+            elif f['Name'] == 'group-name':
+                selected = [sg for sg in selected if sg['GroupName'] in f['Values']]
+            elif f['Name'] == 'group-id':
+                selected = [sg for sg in selected if sg['GroupId'] in f['Values']]
+            elif f['Name'].startswith('tag:'):
+                selected = [sg for sg in selected if tag_value(sg, f['Name'][4:]) in f['Values']]
+        page, token = paginate(selected, MaxResults, NextToken)
+        response = {'SecurityGroups': copy.deepcopy(page)}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def create_security_group(self, GroupName, Description, VpcId, TagSpecifications=()):
+        self._record('CreateSecurityGroup')
+        groups = self.fleet.security_groups[self.region]
+        with self.aws._lock:
+            if any(sg['VpcId'] == VpcId and sg['GroupName'] == GroupName for sg in groups.values()):
+                raise client_error('InvalidGroup.Duplicate', 'CreateSecurityGroup')
+            group_id = 'sg-created{0:09x}'.format(len(groups))
+            tags = [tag for spec in TagSpecifications for tag in spec['Tags']]
+            groups[group_id] = {'GroupId': group_id, 'GroupName': GroupName, 'VpcId': VpcId, 'Description': Description,
+                                'IpPermissions': [], 'Tags': tags,
+                                # Like EC2, a new group allows all outbound traffic
+                                'IpPermissionsEgress': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'Ipv6Ranges': [],
+                                                         'PrefixListIds': [], 'UserIdGroupPairs': []}]}
+        return {'GroupId': group_id}
+
+    def revoke_security_group_egress(self, GroupId, IpPermissions):
+        self._record('RevokeSecurityGroupEgress')
+        groups = self.fleet.security_groups[self.region]
+        if GroupId not in groups:
+            raise client_error('InvalidGroup.NotFound', 'RevokeSecurityGroupEgress')
+        with self.aws._lock:
+            groups[GroupId]['IpPermissionsEgress'] = [rule for rule in groups[GroupId]['IpPermissionsEgress'] if rule not in IpPermissions]
+        return {'Return': True}
+
+    def modify_instance_attribute(self, InstanceId, Groups):
+        self._record('ModifyInstanceAttribute')
+        if InstanceId not in self.fleet.instances[self.region]:
+            raise client_error('InvalidInstanceID.NotFound', 'ModifyInstanceAttribute')
+        if InstanceId in self.aws.unlockable:
+            raise client_error('UnauthorizedOperation', 'ModifyInstanceAttribute', 'You are not authorized to perform this operation')
+        self.aws.modified[InstanceId] = list(Groups)
+        return {}
+
+    def stop_instances(self, InstanceIds):
+        self._record('StopInstances')
+        instances = self.fleet.instances[self.region]
+        missing = [instance_id for instance_id in InstanceIds if instance_id not in instances]
+        if missing:
+            raise client_error('InvalidInstanceID.NotFound', 'StopInstances', 'The instance IDs {0} do not exist'.format(missing))
+        protected = [instance_id for instance_id in InstanceIds if instance_id in self.aws.unstoppable]
+        if protected:
+            raise client_error('OperationNotPermitted', 'StopInstances', 'The instances {0} may not be stopped'.format(protected))
+        self.aws.stopped.update(InstanceIds)
+        return {'StoppingInstances': [{'InstanceId': instance_id, 'CurrentState': {'Code': 64, 'Name': 'stopping'}} for instance_id in InstanceIds]}
+
+
+class FakeAutoscaling(FakeClient):
+    service = 'autoscaling'
+
+    def describe_auto_scaling_instances(self, InstanceIds=None, MaxRecords=50, NextToken=None):
+        self._record('DescribeAutoScalingInstances')
+        if InstanceIds is not None and len(InstanceIds) > 50:
+            raise client_error('ValidationError', 'DescribeAutoScalingInstances', 'At most 50 instance IDs are allowed')
+        members = self.fleet.asg_members[self.region]
+        selected = [instance_id for instance_id in (InstanceIds or members) if instance_id in members]
+        page, token = paginate(selected, MaxRecords, NextToken)
+        response = {'AutoScalingInstances': [{'InstanceId': instance_id, 'AutoScalingGroupName': members[instance_id],
+                                              'LifecycleState': 'InService', 'HealthStatus': 'HEALTHY'} for instance_id in page]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+class FakeSqs(FakeClient):
+    service = 'sqs'
+
+    def get_queue_url(self, QueueName):
+        self._record('GetQueueUrl')
+        return {'QueueUrl': QUEUE_URL_PREFIX + QueueName}
+
+    def send_message(self, QueueUrl, MessageBody):
+        self._record('SendMessage')
+        queue = self.aws.queues[QueueUrl[len(QUEUE_URL_PREFIX):]]
+        queue.append(MessageBody)
+        return {'MessageId': str(len(queue))}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._record('SendMessageBatch')
+        if len(Entries) > 10:
+            raise client_error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 'SendMessageBatch')
+        queue = self.aws.queues[QueueUrl[len(QUEUE_URL_PREFIX):]]
+        queue.extend(entry['MessageBody'] for entry in Entries)
+        return {'Successful': [{'Id': entry['Id'], 'MessageId': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class FakeLambda(FakeClient):
+    service = 'lambda'
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b''):
+        self._record('Invoke')
+        self.aws.invocations.append((FunctionName, Payload))
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200}
+
+
+class FakeSts(FakeClient):
+    service = 'sts'
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds=3600):
+        self._record('AssumeRole')
+        with self.aws._lock:
+            self.aws.assumed_roles.append(RoleArn)
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)
+        return {'Credentials': {'AccessKeyId': ASSUMED_KEY_PREFIX + RoleArn.split(':')[4], 'SecretAccessKey': 'secret',
+                                'SessionToken': 'token', 'Expiration': expiration}}
+
+
+class FakeDynamoDb(FakeClient):
+    '''Conditional puts and deletes on tables with a single string key, enough for the dedup table.
+    Understands conditions of the form attribute_not_exists(key) [OR attribute < :value]'''
+    service = 'dynamodb'
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        self._record('PutItem')
+        with self.aws._lock:
+            table = self.aws.tables[TableName]
+            match = re.match(r'attribute_not_exists\((\w+)\)(?: OR (\w+) < (:\w+))?$', ConditionExpression or '')
+            if ConditionExpression and not match:
+                raise client_error('ValidationException', 'PutItem', 'Unsupported condition: {0}'.format(ConditionExpression))
+            key_name = match.group(1) if match else next(iter(Item))
+            existing = table.get(Item[key_name]['S'])
+            if match and existing is not None:
+                attribute, placeholder = match.group(2), match.group(3)
+                expired = attribute and float(existing[attribute]['N']) < float(ExpressionAttributeValues[placeholder]['N'])
+                if not expired:
+                    raise client_error('ConditionalCheckFailedException', 'PutItem', 'The conditional request failed')
+            table[Item[key_name]['S']] = copy.deepcopy(Item)
+        return {}
+
+    def delete_item(self, TableName, Key):
+        self._record('DeleteItem')
+        with self.aws._lock:
+            self.aws.tables[TableName].pop(next(iter(Key.values()))['S'], None)
+        return {}
@@ -0,0 +1,153 @@
+'''Synthetic fleet generator for the benchmarks.
+
+Builds instances, security groups with realistic rule counts and ASG memberships
+in the shapes the EC2 and Auto Scaling describe calls return them.
+'''
+import datetime
+import random
+from collections import defaultdict
+
+DEFAULT_REGIONS = ('us-east-1',)
+# Ports commonly opened by real security groups, picked for the generated rules
+COMMON_PORTS = (22, 80, 443, 3306, 5432, 6379, 8080, 8443, 9200, 27017)
+PRIVATE_CIDRS = ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16')
+
+
+class Fleet:
+    '''A generated fleet: instances, security groups and ASG memberships per region'''
+    def __init__(self):
+        # region -> instance ID -> instance dict
+        self.instances = defaultdict(dict)
+        # region -> security group ID -> security group dict
+        self.security_groups = defaultdict(dict)
+        # region -> instance ID -> ASG name
+        self.asg_members = defaultdict(dict)
+
+    def instance_ids(self, region=None):
+        '''Returns the instance IDs of a region, or of every region'''
+        regions = [region] if region else sorted(self.instances)
+        return [instance_id for r in regions for instance_id in self.instances[r]]
+
+    def regions(self):
+        return sorted(self.instances)
+
+    def region_of(self, instance_id):
+        for region, instances in self.instances.items():
+            if instance_id in instances:
+                return region
+        return None
+
+    def instance_events(self):
+        '''Returns the get_instance_info queue message bodies for every instance, like the EventBridge transformer builds them'''
+        return [{'instance_id': instance_id, 'region': region, 'time': '2022-01-07T04:52:50Z'} for region in self.regions() for instance_id in self.instances[region]]
+
+    def decisions(self, action, flag='both'):
+        '''Returns stop or lock decisions for every instance, as evaluate_instance routes them'''
+        decisions = []
+        for region in self.regions():
+            for instance in self.instances[region].values():
+                decisions.append({
+                    'instance_id': instance['InstanceId'],
+                    'action': action,
+                    'flag': flag,
+                    'security_group_ids': [sg['GroupId'] for sg in instance['SecurityGroups']],
+                    'vpc_id': instance['VpcId'],
+                    'region': region,
+                })
+        return decisions
+
+
+def make_rule(rng, world_ssh=False):
+    '''Builds one ingress rule, world open SSH when asked for'''
+    if world_ssh:
+        return {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                'Ipv6Ranges': [], 'PrefixListIds': [], 'UserIdGroupPairs': []}
+    port = rng.choice(COMMON_PORTS)
+    if port == 22:
+        # SSH rules that aren't meant to be flagged stay on private ranges
+        cidrs = [{'CidrIp': rng.choice(PRIVATE_CIDRS)}]
+    elif rng.random() < 0.3:
+        cidrs = [{'CidrIp': '0.0.0.0/0'}]
+    else:
+        cidrs = [{'CidrIp': cidr} for cidr in rng.sample(PRIVATE_CIDRS, rng.randint(1, len(PRIVATE_CIDRS)))]
+    return {'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port, 'IpRanges': cidrs,
+            'Ipv6Ranges': [], 'PrefixListIds': [], 'UserIdGroupPairs': []}
+
+
+def generate_fleet(instance_count, security_group_count=20, rules_per_group=10, groups_per_instance=3,
+                   regions=DEFAULT_REGIONS, vpcs_per_region=2, ssh_open_fraction=0.1, default_group_fraction=0.1,
+                   asg_fraction=0.3, spot_fraction=0.1, instance_store_fraction=0.05, excluded_fraction=0.05,
+                   launch_templates=None, seed=0):
+    '''Generates a fleet of instance_count instances spread across regions.
+    launch_templates, when set, makes the instances share that many distinct launch configurations
+    (security groups, root device, lifecycle and ASG), like an ASG burst does'''
+    rng = random.Random(seed)
+    fleet = Fleet()
+    launch_time = datetime.datetime(2022, 1, 7, 4, 52, 37, tzinfo=datetime.timezone.utc)
+    for region_index, region in enumerate(regions):
+        vpc_ids = ['vpc-{0:02d}{1:015x}'.format(region_index, n) for n in range(vpcs_per_region)]
+        groups_by_vpc = defaultdict(list)
+        for vpc_id in vpc_ids:
+            default_group = {'GroupId': 'sg-{0}default'.format(vpc_id[4:]), 'GroupName': 'default', 'VpcId': vpc_id,
+                             'Description': 'default VPC security group', 'IpPermissions': [], 'IpPermissionsEgress': []}
+            fleet.security_groups[region][default_group['GroupId']] = default_group
+        for n in range(security_group_count):
+            vpc_id = vpc_ids[n % len(vpc_ids)]
+            world_ssh = rng.random() < ssh_open_fraction
+            rules = [make_rule(rng) for _ in range(rules_per_group - 1)] + [make_rule(rng, world_ssh)]
+            group = {'GroupId': 'sg-{0:02d}{1:015x}'.format(region_index, n), 'GroupName': 'group-{0}'.format(n), 'VpcId': vpc_id,
+                     'Description': 'generated group', 'IpPermissions': rules, 'IpPermissionsEgress': []}
+            fleet.security_groups[region][group['GroupId']] = group
+            groups_by_vpc[vpc_id].append(group)
+        templates = None
+        if launch_templates:
+            templates = [make_launch_config(rng, vpc_ids, groups_by_vpc, fleet, region, groups_per_instance, default_group_fraction,
+                                            asg_fraction, spot_fraction, instance_store_fraction, 'asg-{0}-{1}'.format(region, t))
+                         for t in range(launch_templates)]
+        region_count = instance_count // len(regions) + (1 if region_index < instance_count % len(regions) else 0)
+        for n in range(region_count):
+            instance_id = 'i-{0:02d}{1:015x}'.format(region_index, n)
+            if templates:
+                config = templates[n % len(templates)]
+            else:
+                config = make_launch_config(rng, vpc_ids, groups_by_vpc, fleet, region, groups_per_instance, default_group_fraction,
+                                            asg_fraction, spot_fraction, instance_store_fraction, 'asg-{0}-{1}'.format(region, n % 7))
+            tags = [{'Key': 'Name', 'Value': 'benchmark-{0}'.format(n)}]
+            if rng.random() < excluded_fraction:
+                tags.append({'Key': 'shutdown_service_excluded', 'Value': 'True'})
+            if config['asg_name']:
+                tags.append({'Key': 'aws:autoscaling:groupName', 'Value': config['asg_name']})
+                fleet.asg_members[region][instance_id] = config['asg_name']
+            instance = {
+                'InstanceId': instance_id,
+                'ImageId': 'ami-0123456789abcdef0',
+                'InstanceType': 't3.micro',
+                'LaunchTime': launch_time,
+                'State': {'Code': 16, 'Name': 'running'},
+                'VpcId': config['vpc_id'],
+                'SubnetId': 'subnet-{0}'.format(config['vpc_id'][4:]),
+                'RootDeviceType': config['root_device_type'],
+                'SecurityGroups': [{'GroupId': sg['GroupId'], 'GroupName': sg['GroupName']} for sg in config['groups']],
+                'Tags': tags,
+            }
+            if config['spot']:
+                instance['InstanceLifecycle'] = 'spot'
+            fleet.instances[region][instance_id] = instance
+    return fleet
+
+
+def make_launch_config(rng, vpc_ids, groups_by_vpc, fleet, region, groups_per_instance, default_group_fraction,
+                       asg_fraction, spot_fraction, instance_store_fraction, asg_name):
+    '''Picks the launch configuration of an instance: VPC, security groups, root device, lifecycle and ASG'''
+    vpc_id = rng.choice(vpc_ids)
+    candidates = groups_by_vpc[vpc_id]
+    groups = rng.sample(candidates, min(groups_per_instance, len(candidates)))
+    if rng.random() < default_group_fraction or not groups:
+        groups.append(fleet.security_groups[region]['sg-{0}default'.format(vpc_id[4:])])
+    return {
+        'vpc_id': vpc_id,
+        'groups': groups,
+        'root_device_type': 'instance-store' if rng.random() < instance_store_fraction else 'ebs',
+        'spot': rng.random() < spot_fraction,
+        'asg_name': asg_name if rng.random() < asg_fraction else None,
+    }
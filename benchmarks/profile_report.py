@@ -0,0 +1,142 @@
+'''Aggregates profiles of the lambda handlers into a report of the functions the invocation time goes to.
+
+The handlers write a profile for the invocations they sample when profiling is enabled (PROFILE_COLD_START,
+PROFILE_WARM_ONE_IN): a pstats file next to a JSON file of its tags, the batch size, regions and stage timings
+of the invocation. pstats files without tags, like the ones cProfile writes, are reported too. The report has:
+- profiles: the profiles read, the cold starts among them, and the regions they handled
+- batch size, duration and stage timings: min, median and max over the tagged profiles
+- top functions: by self time (or cumulative time with --sort cumtime), summed over the profiles, with their
+  share of the profiled self time and the number of profiles they appear in
+
+Usage, from the repository root:
+    python benchmarks/profile_report.py /tmp/profiles --top 20
+    python benchmarks/profile_report.py profiles/ --function evaluate_instances --warm --sort cumtime
+'''
+import argparse
+import glob
+import json
+import os
+import pstats
+import statistics
+from collections import Counter, defaultdict
+
+# Files read from a profile directory, .out is what the hand captured profiles in src/ are named
+PROFILE_PATTERNS = ('*.prof', '*.out')
+SORT_KEYS = ('tottime', 'cumtime')
+
+
+def find_profiles(paths):
+    '''Returns the profile files of the paths, directories and their subdirectories are searched for PROFILE_PATTERNS'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(name for pattern in PROFILE_PATTERNS for name in glob.glob(os.path.join(path, '**', pattern), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def load_profile(path):
+    '''Returns the tags of a profile, empty when it has none, and its pstats entries'''
+    tags = {}
+    tags_path = os.path.splitext(path)[0] + '.json'
+    if os.path.exists(tags_path):
+        with open(tags_path, encoding='utf-8') as f:
+            tags = json.load(f)
+    return tags, pstats.Stats(path).stats
+
+
+def select_profiles(profiles, function=None, cold_start=None):
+    '''Returns the profiles of a function and of cold or warm invocations, None selects both'''
+    return [(tags, stats) for tags, stats in profiles
+            if (function is None or tags.get('function') == function) and (cold_start is None or tags.get('cold_start') == cold_start)]
+
+
+def function_label(key):
+    '''Returns file:line(function) for a pstats key, builtins are only named'''
+    filename, line, name = key
+    if filename == '~':
+        return name
+    return '{0}:{1}({2})'.format(os.path.basename(filename), line, name)
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {'min': min(values), 'p50': statistics.median(values), 'max': max(values)}
+
+
+def aggregate(profiles, top=20, sort='tottime'):
+    '''Returns the report of a list of (tags, pstats entries) profiles, with its top functions by sort'''
+    functions = {}
+    total_seconds = 0.0
+    for _, stats in profiles:
+        for key, (_, calls, tottime, cumtime, _) in stats.items():
+            entry = functions.setdefault(key, {'calls': 0, 'tottime': 0.0, 'cumtime': 0.0, 'profiles': 0})
+            entry['calls'] += calls
+            entry['tottime'] += tottime
+            entry['cumtime'] += cumtime
+            entry['profiles'] += 1
+            total_seconds += tottime
+    tagged = [tags for tags, _ in profiles if tags]
+    stages = defaultdict(list)
+    for tags in tagged:
+        for stage, duration_ms in tags.get('stages', {}).items():
+            stages[stage].append(duration_ms)
+    ranked = sorted(functions.items(), key=lambda item: item[1][sort], reverse=True)[:top]
+    return {
+        'profiles': len(profiles),
+        'tagged': len(tagged),
+        'cold_starts': sum(1 for tags in tagged if tags.get('cold_start')),
+        'regions': dict(Counter(region for tags in tagged for region in tags.get('regions', []))),
+        'batch_size': summarize([tags['batch_size'] for tags in tagged if tags.get('batch_size') is not None]),
+        'duration_ms': summarize([tags['duration_ms'] for tags in tagged if 'duration_ms' in tags]),
+        'stages_ms': {stage: summarize(values) for stage, values in sorted(stages.items())},
+        'total_seconds': total_seconds,
+        'top': [dict(entry, function=function_label(key), share=entry['tottime'] / total_seconds if total_seconds else 0.0)
+                for key, entry in ranked],
+    }
+
+
+def print_report(report):
+    def spread(summary, unit=''):
+        if summary is None:
+            return '-'
+        return 'min {0:.1f}{3}, p50 {1:.1f}{3}, max {2:.1f}{3}'.format(summary['min'], summary['p50'], summary['max'], unit)
+    print('profiles {0}, tagged {1}, cold starts {2}, profiled time {3:.3f}s'.format(
+        report['profiles'], report['tagged'], report['cold_starts'], report['total_seconds']))
+    print('regions: ' + (', '.join('{0}={1}'.format(region, count) for region, count in sorted(report['regions'].items())) or '-'))
+    print('batch size: ' + spread(report['batch_size']))
+    print('duration: ' + spread(report['duration_ms'], 'ms'))
+    for stage, summary in report['stages_ms'].items():
+        print('stage {0}: {1}'.format(stage, spread(summary, 'ms')))
+    print('{0:>10} {1:>10} {2:>10} {3:>7} {4:>8}  {5}'.format('calls', 'tottime', 'cumtime', 'share', 'profiles', 'function'))
+    for entry in report['top']:
+        print('{0:>10} {1:>10.4f} {2:>10.4f} {3:>6.1%} {4:>8}  {5}'.format(
+            entry['calls'], entry['tottime'], entry['cumtime'], entry['share'], entry['profiles'], entry['function']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='profile files, or directories of profiles')
+    parser.add_argument('--top', type=int, default=20, help='number of functions reported')
+    parser.add_argument('--sort', choices=SORT_KEYS, default='tottime', help='rank functions by self or cumulative time')
+    parser.add_argument('--function', help='only the profiles of this lambda function, as tagged')
+    cold = parser.add_mutually_exclusive_group()
+    cold.add_argument('--cold', dest='cold_start', action='store_const', const=True, help='only cold start profiles')
+    cold.add_argument('--warm', dest='cold_start', action='store_const', const=False, help='only warm invocation profiles')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    files = find_profiles(args.paths)
+    if not files:
+        parser.error('no profiles found in: {0}'.format(', '.join(args.paths)))
+    profiles = select_profiles([load_profile(path) for path in files], args.function, args.cold_start)
+    report = aggregate(profiles, args.top, args.sort)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
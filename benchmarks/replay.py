@@ -0,0 +1,406 @@
+'''Replays EventBridge traces through the whole pipeline in process, to tune batch sizes and concurrency offline.
+
+The three handlers are chained through local stand-ins for the SQS queues, their dead-letter
+queues and the event source mappings, on a virtual clock:
+- each queue delivers batches of up to its batch size, waiting up to the batching window to fill one
+- each function runs at most --concurrency batches at once
+- records reported as batchItemFailures (or the whole batch, if the handler raises) become visible
+  again after the visibility timeout, and move to the dead-letter queue after max_receive_count receives
+
+The handlers run for real against the fake AWS of benchmarks/fake_aws.py. An invocation takes
+its measured wall time plus --api-latency-ms for every AWS call it makes. Every function is one
+warm container, so caches and dedup claims carry over between its invocations like in lambda.
+
+Reports the time from an instance's first event to its containment (stopped or locked) as
+p50/p99/max, the invocations and records per function, the messages and dead-letter counts per
+queue, and the AWS calls made.
+
+Traces:
+- trickle: one instance launched every --interval seconds
+- burst: --size instances launched over --burst-seconds, from a few launch configurations like ASGs scaling out
+- mixed: instances spread across --regions, launched at random over --burst-seconds
+- --trace-file: recorded EventBridge events (a JSON list or one event per line), their instance IDs are
+  mapped onto a generated fleet so the verdicts are synthetic but the timing is real
+
+Usage, from the repository root:
+    python benchmarks/replay.py --trace burst --size 500
+    python benchmarks/replay.py --trace mixed --size 300 --evaluate-batch-size 50 --batching-window 2
+    python benchmarks/replay.py --trace-file events.json --concurrency 2 --api-latency-ms 50
+'''
+import argparse
+import contextlib
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+from collections import deque
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeAws  # noqa: E402
+from fleet import generate_fleet  # noqa: E402
+from run_benchmarks import BURST_LAUNCH_TEMPLATES, MODULES  # noqa: E402
+import shutdown_common  # noqa: E402
+from src.evaluate_instance import evaluate_instance  # noqa: E402
+from src.lock_instance import lock_instance  # noqa: E402
+from src.stop_instance import stop_instance  # noqa: E402
+
+TRACES = ('trickle', 'burst', 'mixed')
+MIXED_REGIONS = ('us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2')
+TRACE_START = datetime.datetime(2022, 1, 7, 4, 52, 50)
+# Queue settings from terraform/sqs.tf and the event source mappings in terraform/lambdas.tf
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_BATCHING_WINDOW_SECONDS = 0.0
+VISIBILITY_TIMEOUT_SECONDS = 30
+MAX_RECEIVE_COUNT = 4
+# Concurrent batches per function, the SQS event source starts with 5 pollers
+DEFAULT_CONCURRENCY = 5
+
+
+class Message:
+    def __init__(self, message_id, body, sent_at):
+        self.message_id = message_id
+        self.body = body
+        self.sent_at = sent_at
+        self.visible_at = sent_at
+        self.receive_count = 0
+
+
+class LocalQueue:
+    '''SQS queue feeding a lambda event source mapping: batching, visibility timeout and redrive to a dead-letter queue'''
+    def __init__(self, name, batch_size=DEFAULT_BATCH_SIZE, batching_window=DEFAULT_BATCHING_WINDOW_SECONDS,
+                 visibility_timeout=VISIBILITY_TIMEOUT_SECONDS, max_receive_count=MAX_RECEIVE_COUNT):
+        self.name = name
+        self.batch_size = batch_size
+        self.batching_window = batching_window
+        self.visibility_timeout = visibility_timeout
+        self.max_receive_count = max_receive_count
+        self.messages = []
+        self.dead_letters = []
+        self.sent = 0
+        self.received = 0
+        self._ids = itertools.count()
+
+    def send(self, body, now):
+        self.sent += 1
+        self.messages.append(Message('{0}-{1}'.format(self.name, next(self._ids)), body, now))
+
+    def visible(self, now):
+        return [message for message in self.messages if message.visible_at <= now]
+
+    def ready_at(self, now):
+        '''Returns the earliest time a batch can be delivered, or None when the queue is empty.
+        A batch goes out when it is full or when its oldest visible message has waited for the batching window'''
+        if not self.messages:
+            return None
+        visible = self.visible(now)
+        if len(visible) >= self.batch_size:
+            return now
+        if visible:
+            return max(now, min(message.visible_at for message in visible) + self.batching_window)
+        return min(message.visible_at for message in self.messages) + self.batching_window
+
+    def receive(self, now):
+        '''Takes the next batch out of the queue, it comes back through fail() if it isn't processed'''
+        batch = sorted(self.visible(now), key=lambda message: message.visible_at)[:self.batch_size]
+        for message in batch:
+            self.messages.remove(message)
+            message.receive_count += 1
+        self.received += len(batch)
+        return batch
+
+    def fail(self, message, received_at):
+        '''Returns a message after its visibility timeout, or moves it to the dead-letter queue'''
+        if message.receive_count >= self.max_receive_count:
+            self.dead_letters.append(message)
+            return
+        message.visible_at = received_at + self.visibility_timeout
+        self.messages.append(message)
+
+
+class Function:
+    '''A lambda function polling one queue, with at most concurrency invocations running'''
+    def __init__(self, name, handler, queue, concurrency=DEFAULT_CONCURRENCY):
+        self.name = name
+        self.handler = handler
+        self.queue = queue
+        self.concurrency = concurrency
+        self.running = 0
+        self.invocations = 0
+        self.records = 0
+        self.failed_records = 0
+        self.durations = []
+
+
+def message_instance_id(body):
+    try:
+        return evaluate_instance.Decision.decode(body).instance_id
+    except (ValueError, TypeError):
+        return None
+
+
+def percentile(values, fraction):
+    '''Nearest rank percentile of a list of values, None when it is empty'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Pipeline:
+    '''Chains the evaluate, stop and lock handlers through local queues on a virtual clock'''
+    def __init__(self, aws, batch_sizes=None, batching_window=DEFAULT_BATCHING_WINDOW_SECONDS,
+                 concurrency=DEFAULT_CONCURRENCY, api_latency_ms=0.0):
+        batch_sizes = batch_sizes or {}
+        self.aws = aws
+        self.api_latency = api_latency_ms / 1000
+        self.queues = {name: LocalQueue(name, batch_sizes.get(name, DEFAULT_BATCH_SIZE), batching_window)
+                       for name in ('get_instance_info', evaluate_instance.STOP_QUEUE_NAME, evaluate_instance.LOCK_QUEUE_NAME)}
+        self.functions = [
+            Function('evaluate_instance', evaluate_instance.lambda_handler, self.queues['get_instance_info'], concurrency),
+            Function('stop_instance', stop_instance.lambda_handler, self.queues[evaluate_instance.STOP_QUEUE_NAME], concurrency),
+            Function('lock_instance', lock_instance.lambda_handler, self.queues[evaluate_instance.LOCK_QUEUE_NAME], concurrency),
+        ]
+        # instance ID -> time of its first event, time it was contained
+        self.first_seen = {}
+        self.contained_at = {}
+        # Instances a stop or lock decision was made for
+        self.flagged = set()
+
+    def invoke(self, function, now):
+        '''Runs one batch through the function's handler, returns when it completes and what it produced'''
+        batch = function.queue.receive(now)
+        calls_before = sum(self.aws.calls.values())
+        contained_before = self.aws.stopped | set(self.aws.modified)
+        event = {'Records': [{'messageId': message.message_id, 'body': message.body} for message in batch]}
+        start = time.perf_counter()
+        try:
+            response = function.handler(event, None)
+            failed_ids = {failure['itemIdentifier'] for failure in response.get('batchItemFailures', [])}
+        except Exception:  # pylint: disable=broad-except
+            # An error fails the whole batch, like an unhandled exception in lambda
+            failed_ids = {message.message_id for message in batch}
+        duration = time.perf_counter() - start + self.api_latency * (sum(self.aws.calls.values()) - calls_before)
+        # Messages the handler sent are delivered when it completes
+        sent = {name: self.aws.queues.pop(name, []) for name in list(self.aws.queues)}
+        contained = (self.aws.stopped | set(self.aws.modified)) - contained_before
+        function.running += 1
+        function.invocations += 1
+        function.records += len(batch)
+        function.failed_records += len(failed_ids)
+        function.durations.append(duration)
+        return now + duration, (function, batch, now, failed_ids, sent, contained)
+
+    def complete(self, outcome, now):
+        function, batch, received_at, failed_ids, sent, contained = outcome
+        function.running -= 1
+        for message in batch:
+            if message.message_id in failed_ids:
+                function.queue.fail(message, received_at)
+        for name, bodies in sent.items():
+            for body in bodies:
+                self.flagged.add(message_instance_id(body))
+                self.queues[name].send(body, now)
+        for instance_id in contained:
+            self.flagged.add(instance_id)
+            self.contained_at.setdefault(instance_id, now)
+
+    def run(self, trace):
+        '''Replays a trace of (seconds, body) events, returns the report'''
+        arrivals = deque(sorted(trace, key=lambda event: event[0]))
+        completions = []
+        sequence = itertools.count()
+        now = 0.0
+        while True:
+            while completions and completions[0][0] <= now:
+                _, _, outcome = heapq.heappop(completions)
+                self.complete(outcome, now)
+            while arrivals and arrivals[0][0] <= now:
+                _, body = arrivals.popleft()
+                self.first_seen.setdefault(body['instance_id'], now)
+                self.queues['get_instance_info'].send(json.dumps(body), now)
+            for function in self.functions:
+                while function.running < function.concurrency and function.queue.ready_at(now) == now:
+                    end, outcome = self.invoke(function, now)
+                    heapq.heappush(completions, (end, next(sequence), outcome))
+            upcoming = [arrivals[0][0]] if arrivals else []
+            upcoming += [completions[0][0]] if completions else []
+            upcoming += [function.queue.ready_at(now) for function in self.functions
+                         if function.running < function.concurrency and function.queue.messages]
+            if not upcoming:
+                break
+            now = min(upcoming)
+        return self.report(now)
+
+    def report(self, makespan):
+        times = [self.contained_at[instance_id] - self.first_seen[instance_id] for instance_id in self.contained_at if instance_id in self.first_seen]
+        return {
+            'events': len(self.first_seen),
+            'flagged': len(self.flagged),
+            'contained': len(self.contained_at),
+            'uncontained': len(self.flagged - set(self.contained_at)),
+            'containment_seconds': {'p50': percentile(times, 0.5), 'p99': percentile(times, 0.99), 'max': max(times) if times else None},
+            'functions': {function.name: {
+                'invocations': function.invocations,
+                'records': function.records,
+                'failed_records': function.failed_records,
+                'p50_duration_ms': (percentile(function.durations, 0.5) or 0.0) * 1000,
+            } for function in self.functions},
+            'queues': {name: {'messages': queue.sent, 'received': queue.received, 'dead_letters': len(queue.dead_letters)}
+                       for name, queue in self.queues.items()},
+            'calls_by_service': self.aws.calls_by_service(),
+            'makespan_seconds': makespan,
+        }
+
+
+def event_body(instance_id, region, seconds):
+    '''Builds the get_instance_info message the EventBridge input transformer sends for a launch at seconds into the trace'''
+    launched = TRACE_START + datetime.timedelta(seconds=seconds)
+    return {'instance_id': instance_id, 'region': region, 'time': launched.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+def synthetic_trace(trace, size, interval=2.0, burst_seconds=60.0, regions=MIXED_REGIONS, seed=0):
+    '''Generates a fleet and the launch events of a synthetic trace, returns (fleet, [(seconds, body)])'''
+    rng = random.Random(seed)
+    if trace == 'trickle':
+        fleet = generate_fleet(size, regions=regions[:1], seed=seed)
+        offsets = [n * interval for n in range(size)]
+    elif trace == 'burst':
+        fleet = generate_fleet(size, security_group_count=max(20, size // 20), regions=regions[:1],
+                               launch_templates=BURST_LAUNCH_TEMPLATES, seed=seed)
+        offsets = sorted(rng.uniform(0, burst_seconds) for _ in range(size))
+    elif trace == 'mixed':
+        fleet = generate_fleet(size, security_group_count=max(20, size // 20), regions=regions, seed=seed)
+        offsets = sorted(rng.uniform(0, burst_seconds) for _ in range(size))
+    else:
+        raise ValueError("Unknown trace: {0}".format(trace))
+    instances = [(instance_id, region) for region in fleet.regions() for instance_id in fleet.instance_ids(region)]
+    rng.shuffle(instances)
+    return fleet, [(seconds, event_body(instance_id, region, seconds)) for seconds, (instance_id, region) in zip(offsets, instances)]
+
+
+def load_trace(path):
+    '''Reads recorded EventBridge events, a JSON list or one event per line'''
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def recorded_trace(events, seed=0):
+    '''Maps recorded EC2 state change events onto a generated fleet, returns (fleet, [(seconds, body)]).
+    Each recorded instance ID gets a generated instance of the same region, every event of it keeps its time'''
+    events = [event for event in events if event.get('detail', {}).get('state', 'running') == 'running']
+    if not events:
+        raise ValueError("The trace has no running state events")
+    times = [datetime.datetime.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ') for event in events]
+    recorded = list(dict.fromkeys((event['region'], event['detail']['instance-id']) for event in events))
+    regions = tuple(dict.fromkeys(region for region, _ in recorded))
+    fleet = generate_fleet(len(recorded), security_group_count=max(20, len(recorded) // 20), regions=regions, seed=seed)
+    available = {region: iter(fleet.instance_ids(region)) for region in regions}
+    mapping = {}
+    for region, instance_id in recorded:
+        # The fleet spreads instances evenly, a region with more recorded instances borrows from the others
+        generated = next(available[region], None)
+        if generated is None:
+            generated = next(instance for other in regions for instance in available[other])
+        mapping[(region, instance_id)] = (generated, fleet.region_of(generated))
+    start = min(times)
+    trace = []
+    for event, event_time in zip(events, times):
+        generated, region = mapping[(event['region'], event['detail']['instance-id'])]
+        seconds = (event_time - start).total_seconds()
+        trace.append((seconds, dict(event_body(generated, region, seconds), time=event['time'])))
+    return fleet, trace
+
+
+def replay(fleet, trace, batch_sizes=None, batching_window=DEFAULT_BATCHING_WINDOW_SECONDS, concurrency=DEFAULT_CONCURRENCY,
+           api_latency_ms=0.0, inline=False, unstoppable_fraction=0.0, unlockable_fraction=0.0, seed=0):
+    '''Replays a trace through the pipeline against a fake AWS backed by the fleet, returns the report.
+    unstoppable_fraction of the instances refuse to stop and unlockable_fraction refuse the security group change,
+    to exercise the lock fallback and the dead-letter queues'''
+    aws = FakeAws(fleet)
+    rng = random.Random(seed)
+    instance_ids = fleet.instance_ids()
+    aws.unstoppable.update(rng.sample(instance_ids, int(len(instance_ids) * unstoppable_fraction)))
+    aws.unlockable.update(rng.sample(instance_ids, int(len(instance_ids) * unlockable_fraction)))
+    pipeline = Pipeline(aws, batch_sizes, batching_window, concurrency, api_latency_ms)
+    # The handlers print their EMF metrics line to stdout, keep it out of the report
+    with aws.patched(*MODULES), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(shutdown_common, 'RATE_LIMIT_ENABLED', False))
+        stack.enter_context(mock.patch.object(evaluate_instance, 'INLINE_CONTAINMENT', 'stop' if inline else 'off'))
+        return pipeline.run(trace)
+
+
+def print_report(report):
+    containment = report['containment_seconds']
+    def seconds(value):
+        return '-' if value is None else '{0:.2f}s'.format(value)
+    print('events {0}, flagged {1}, contained {2}, uncontained {3}, makespan {4}'.format(
+        report['events'], report['flagged'], report['contained'], report['uncontained'], seconds(report['makespan_seconds'])))
+    print('time to containment: p50 {0}, p99 {1}, max {2}'.format(seconds(containment['p50']), seconds(containment['p99']), seconds(containment['max'])))
+    print('{0:<20} {1:>11} {2:>8} {3:>7} {4:>10}'.format('function', 'invocations', 'records', 'failed', 'p50 ms'))
+    for name, stats in report['functions'].items():
+        print('{0:<20} {1:>11} {2:>8} {3:>7} {4:>10.1f}'.format(name, stats['invocations'], stats['records'], stats['failed_records'], stats['p50_duration_ms']))
+    print('{0:<20} {1:>11} {2:>8} {3:>7}'.format('queue', 'messages', 'received', 'dlq'))
+    for name, stats in report['queues'].items():
+        print('{0:<20} {1:>11} {2:>8} {3:>7}'.format(name, stats['messages'], stats['received'], stats['dead_letters']))
+    print('calls by service: ' + ', '.join('{0}={1}'.format(service, count) for service, count in sorted(report['calls_by_service'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', choices=TRACES, default='burst', help='synthetic trace to replay')
+    parser.add_argument('--trace-file', help='recorded EventBridge events to replay instead of a synthetic trace')
+    parser.add_argument('--size', type=int, default=500, help='instances launched by a synthetic trace')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between launches of the trickle trace')
+    parser.add_argument('--burst-seconds', type=float, default=60.0, help='seconds the burst and mixed launches are spread over')
+    parser.add_argument('--regions', nargs='+', default=list(MIXED_REGIONS), help='regions of the mixed trace')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='batch size of every event source mapping')
+    parser.add_argument('--evaluate-batch-size', type=int, help='batch size of the get_instance_info queue')
+    parser.add_argument('--stop-batch-size', type=int, help='batch size of the stop_instance queue')
+    parser.add_argument('--lock-batch-size', type=int, help='batch size of the lock_instance queue')
+    parser.add_argument('--batching-window', type=float, default=DEFAULT_BATCHING_WINDOW_SECONDS, help='maximum batching window, in seconds')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='concurrent invocations per function')
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help='simulated latency added per AWS call')
+    parser.add_argument('--inline', action='store_true', help='stop from the evaluate lambda, INLINE_CONTAINMENT=stop')
+    parser.add_argument('--unstoppable-fraction', type=float, default=0.0, help='fraction of instances that refuse to stop')
+    parser.add_argument('--unlockable-fraction', type=float, default=0.0, help='fraction of instances that refuse the lock')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--verbose', action='store_true', help='print the lambda logs')
+    args = parser.parse_args()
+    if not args.verbose:
+        # Log records are still built, like in lambda, but not printed
+        logging.getLogger().handlers = [logging.NullHandler()]
+    if args.trace_file:
+        fleet, trace = recorded_trace(load_trace(args.trace_file), args.seed)
+    else:
+        regions = tuple(args.regions) if args.trace == 'mixed' else ('us-east-1',)
+        fleet, trace = synthetic_trace(args.trace, args.size, args.interval, args.burst_seconds, regions, args.seed)
+    batch_sizes = {
+        'get_instance_info': args.evaluate_batch_size or args.batch_size,
+        evaluate_instance.STOP_QUEUE_NAME: args.stop_batch_size or args.batch_size,
+        evaluate_instance.LOCK_QUEUE_NAME: args.lock_batch_size or args.batch_size,
+    }
+    report = replay(fleet, trace, batch_sizes, args.batching_window, args.concurrency, args.api_latency_ms,
+                    args.inline, args.unstoppable_fraction, args.unlockable_fraction, args.seed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+'''Scaling benchmarks for the three lambdas against a synthetic fleet.
+
+Each scenario drives one entry point against an in-process fake of EC2, Auto Scaling and SQS
+(benchmarks/fake_aws.py) backed by a generated fleet (benchmarks/fleet.py), and reports:
+- wall: median wall time of the scenario, in ms
+- peak: peak memory allocated while it runs, in KiB (tracemalloc)
+- calls: AWS API calls per service, and per instance
+
+Handler scenarios deliver the fleet as SQS batches of --batch-size records to one warm
+container, so lookups cached by one invocation are reused by the next like in lambda.
+
+API call counts are deterministic for a given fleet, so a saved baseline catches changes
+that make a scenario call AWS more often, e.g. API calls per instance growing with the fleet.
+
+Usage, from the repository root:
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000
+    python benchmarks/run_benchmarks.py --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json
+'''
+import argparse
+import contextlib
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The handlers import the shared module the lambda images copy next to them
+sys.path.insert(0, os.path.join(ROOT, 'src', 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeAws  # noqa: E402
+from fleet import generate_fleet  # noqa: E402
+import shutdown_common  # noqa: E402
+from src.evaluate_instance import evaluate_instance  # noqa: E402
+from src.lock_instance import lock_instance  # noqa: E402
+from src.stop_instance import stop_instance  # noqa: E402
+
+MODULES = (evaluate_instance, stop_instance, lock_instance)
+DEFAULT_SIZES = (10, 100, 1000)
+SCENARIOS = ('evaluate', 'burst', 'inline', 'redelivery', 'sweep', 'analyze', 'route', 'stop', 'lock')
+# Distinct launch configurations of the burst scenario's fleet, like a few ASGs scaling out at once
+BURST_LAUNCH_TEMPLATES = 5
+
+
+def sqs_batches(bodies, batch_size):
+    '''Splits message bodies into SQS lambda events of batch_size records, bodies that aren't already strings are JSON encoded'''
+    events = []
+    for start in range(0, len(bodies), batch_size):
+        records = [{'messageId': 'message-{0}'.format(start + n), 'body': body if isinstance(body, str) else json.dumps(body)}
+                   for n, body in enumerate(bodies[start:start + batch_size])]
+        events.append({'Records': records})
+    return events
+
+
+def encoded_decisions(fleet, action):
+    '''Returns the stop or lock queue message bodies for every instance, as evaluate_instance routes them'''
+    return [evaluate_instance.Decision.from_dict(decision).encode() for decision in fleet.decisions(action)]
+
+
+def describe_response(fleet):
+    '''Builds one describe_instances response covering the whole fleet, as analyze_instances receives it'''
+    return {'Reservations': [{'Instances': [instance]} for region in fleet.regions() for instance in fleet.instances[region].values()]}
+
+
+def prepare(scenario, fleet, batch_size):
+    '''Returns a callable running the scenario once against the fleet'''
+    if scenario in ('evaluate', 'burst'):
+        events = sqs_batches(fleet.instance_events(), batch_size)
+        return lambda: [evaluate_instance.lambda_handler(event, None) for event in events]
+    if scenario == 'inline':
+        # evaluate with INLINE_CONTAINMENT=stop, stops are made by the evaluate lambda instead of the stop queue
+        events = sqs_batches(fleet.instance_events(), batch_size)
+        def run_inline():
+            with mock.patch.object(evaluate_instance, 'INLINE_CONTAINMENT', 'stop'):
+                return [evaluate_instance.lambda_handler(event, None) for event in events]
+        return run_inline
+    if scenario == 'redelivery':
+        # Every event is delivered twice, like EventBridge and SQS may, the copies are dropped as duplicates
+        events = sqs_batches(fleet.instance_events(), batch_size)
+        return lambda: [evaluate_instance.lambda_handler(event, None) for event in events + events]
+    if scenario == 'sweep':
+        # One scheduled sweep over the whole fleet, in pages of SWEEP_PAGE_SIZE running instances
+        return lambda: evaluate_instance.sweep_handler({}, None)
+    if scenario == 'analyze':
+        response = describe_response(fleet)
+        region = fleet.regions()[0]
+        return lambda: evaluate_instance.analyze_instances(response, region)
+    if scenario == 'route':
+        decisions = [evaluate_instance.Decision.from_dict(decision) for decision in fleet.decisions('stop')]
+        return lambda: evaluate_instance.route_instance_message([decisions])
+    if scenario == 'stop':
+        events = sqs_batches(encoded_decisions(fleet, 'stop'), batch_size)
+        return lambda: [stop_instance.lambda_handler(event, None) for event in events]
+    if scenario == 'lock':
+        events = sqs_batches(encoded_decisions(fleet, 'lock'), batch_size)
+        return lambda: [lock_instance.lambda_handler(event, None) for event in events]
+    raise ValueError("Unknown scenario: {0}".format(scenario))
+
+
+def run_scenario(scenario, size, runs=3, batch_size=10, regions=('us-east-1',), seed=0, rate_limit=False, api_rate=None):
+    '''Runs one scenario against a fleet of size instances, returns its measurements.
+    Every run starts from a cold container: fresh fleet, clients and caches.
+    The lambdas' rate limiter is off unless rate_limit is set, so wall time measures the code rather than the pacing.
+    api_rate makes the fake AWS throttle calls above that many per second'''
+    if scenario == 'analyze':
+        # analyze_instances evaluates a single region
+        regions = regions[:1]
+    wall_times = []
+    calls = None
+    peak = 0
+    for run in range(runs + 1):
+        launch_templates = BURST_LAUNCH_TEMPLATES if scenario == 'burst' else None
+        fleet = generate_fleet(size, security_group_count=max(20, size // 20), regions=regions, launch_templates=launch_templates, seed=seed)
+        aws = FakeAws(fleet, api_rate=api_rate)
+        # The handlers print their EMF metrics line to stdout, keep it out of the report
+        with aws.patched(*MODULES), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(shutdown_common, 'RATE_LIMIT_ENABLED', rate_limit))
+            scenario_run = prepare(scenario, fleet, batch_size)
+            if run == 0:
+                # The first run measures allocations and API calls, tracemalloc slows down the timed runs
+                tracemalloc.start()
+                scenario_run()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                calls = {'{0}:{1}'.format(*key): count for key, count in sorted(aws.calls.items())}
+                by_service = aws.calls_by_service()
+                throttled = sum(aws.throttled.values())
+                continue
+            start = time.perf_counter()
+            scenario_run()
+            wall_times.append((time.perf_counter() - start) * 1000)
+    total = sum(by_service.values())
+    return {
+        'scenario': scenario,
+        'size': size,
+        'wall_ms': statistics.median(wall_times) if wall_times else None,
+        'peak_kib': peak / 1024,
+        'calls': calls,
+        'calls_by_service': by_service,
+        'total_calls': total,
+        'calls_per_instance': total / size,
+        'throttled': throttled,
+    }
+
+
+def run_all(scenarios=SCENARIOS, sizes=DEFAULT_SIZES, runs=3, batch_size=10, regions=('us-east-1',), seed=0, rate_limit=False, api_rate=None):
+    return [run_scenario(scenario, size, runs, batch_size, regions, seed, rate_limit, api_rate) for scenario in scenarios for size in sizes]
+
+
+def compare(results, baseline, time_tolerance=None):
+    '''Compares results against a baseline, returns a list of regression descriptions.
+    Any scenario making more API calls to a service than the baseline is a regression,
+    wall time is only compared when time_tolerance is set as it depends on the machine'''
+    regressions = []
+    baseline_results = {(b['scenario'], b['size']): b for b in baseline}
+    for result in results:
+        key = (result['scenario'], result['size'])
+        if key not in baseline_results:
+            continue
+        expected = baseline_results[key]
+        for service, count in result['calls_by_service'].items():
+            expected_count = expected['calls_by_service'].get(service, 0)
+            if count > expected_count:
+                regressions.append("{0}/{1}: {2} calls went from {3} to {4}".format(key[0], key[1], service, expected_count, count))
+        if time_tolerance is not None and expected['wall_ms'] and result['wall_ms'] > expected['wall_ms'] * (1 + time_tolerance):
+            regressions.append("{0}/{1}: wall time went from {2:.1f} ms to {3:.1f} ms".format(key[0], key[1], expected['wall_ms'], result['wall_ms']))
+    return regressions
+
+
+def print_table(results):
+    print('{0:<10} {1:>6} {2:>10} {3:>10} {4:>8} {5:>10} {6:>9}  {7}'.format(
+        'scenario', 'size', 'wall ms', 'peak KiB', 'calls', 'per inst', 'throttled', 'calls by service'))
+    for r in results:
+        services = ', '.join('{0}={1}'.format(service, count) for service, count in sorted(r['calls_by_service'].items()))
+        print('{0:<10} {1:>6} {2:>10.1f} {3:>10.1f} {4:>8} {5:>10.3f} {6:>9}  {7}'.format(
+            r['scenario'], r['size'], r['wall_ms'] or 0.0, r['peak_kib'], r['total_calls'], r['calls_per_instance'], r.get('throttled', 0), services))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', help='scenario to run, defaults to all')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='fleet sizes, in instances')
+    parser.add_argument('--regions', nargs='+', default=['us-east-1'], help='regions to spread the fleet across')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs per scenario and size')
+    parser.add_argument('--batch-size', type=int, default=10, help='SQS records per handler invocation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--save-baseline', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare the results to this file, exits 1 on a regression')
+    parser.add_argument('--time-tolerance', type=float, help='also flag wall times more than this fraction above the baseline')
+    parser.add_argument('--rate-limit', action='store_true', help="turn on the lambdas' adaptive rate limiter")
+    parser.add_argument('--api-rate', type=float, help='throttle fake AWS calls above this many per second, per service and region')
+    parser.add_argument('--verbose', action='store_true', help='print the lambda logs')
+    args = parser.parse_args()
+    if not args.verbose:
+        # Log records are still built, like in lambda, but not printed
+        logging.getLogger().handlers = [logging.NullHandler()]
+    results = run_all(args.scenario or SCENARIOS, args.sizes, args.runs, args.batch_size, tuple(args.regions), args.seed,
+                      args.rate_limit, args.api_rate)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.time_tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,742 @@
+'''Infrastructure shared by the shutdown service lambdas: JSON logging, the client registry with its assumed account roles,
+per invocation metrics, the adaptive rate limiter AWS calls go through, invocation profiling and the decision wire format.
+Each lambda image copies this module next to its handler, see the Dockerfiles'''
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from botocore.exceptions import BotoCoreError, ClientError
+
+### VARIABLES
+# The region of the queues and of STS
+DEFAULT_REGION = "us-east-1"
+# Name the metrics, profiles and assumed role sessions are reported under when not running in lambda,
+# the handlers report under the name of their module (see handler_function_name)
+FUNCTION_NAME = "shutdown_service"
+# Connection pool size for each shared client, raise it alongside any worker pools that share a client
+CLIENT_MAX_POOL_CONNECTIONS = int(os.environ.get("CLIENT_MAX_POOL_CONNECTIONS", "10"))
+# "prewarm" builds the handler's clients while the lambda initializes, "lazy" defers them (and the boto3 import) to first use
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "prewarm" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else "lazy")
+PREWARM_REGIONS = os.environ.get("PREWARM_REGIONS", DEFAULT_REGION).split(",")
+
+# Records carry the account of their instance. Instances in the other accounts of the organization are reached through
+# a role of that name assumed in each account, without it every record is handled with the lambda's own credentials
+ACCOUNT_ROLE_NAME = os.environ.get("ACCOUNT_ROLE_NAME", "")
+# The account the lambda is deployed in, its records use the lambda's own credentials
+HOME_ACCOUNT_ID = os.environ.get("HOME_ACCOUNT_ID", "")
+ASSUME_ROLE_DURATION_SECONDS = int(os.environ.get("ASSUME_ROLE_DURATION_SECONDS", "3600"))
+# Assumed credentials, and the clients built from them, are refreshed this long before they expire
+CREDENTIAL_REFRESH_SECONDS = float(os.environ.get("CREDENTIAL_REFRESH_SECONDS", "300"))
+# Services whose resources live in the instance's account, the queues, table and functions stay in the home account
+ACCOUNT_SERVICES = ('ec2', 'autoscaling')
+# StopInstances errors caused by one of the instances of the call. Only these bisect the call, so the other instances are still
+# stopped. Any other error (throttling, missing permissions) would fail every half the same way, it fails the whole call at once
+STOP_INSTANCE_ERROR_CODES = ('InvalidInstanceID.', 'IncorrectInstanceState', 'OperationNotPermitted', 'UnsupportedOperation')
+
+# Per invocation metrics, flushed as CloudWatch Embedded Metric Format on stdout
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ShutdownService")
+# EMF accepts at most 100 values per metric
+METRICS_MAX_VALUES = 100
+# Error codes AWS returns when a call is throttled
+THROTTLE_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled',
+                        'RequestThrottledException', 'TooManyRequestsException', 'SlowDown')
+# Request parameters whose length is recorded as the batch size of a call
+BATCH_PARAMETERS = ('InstanceIds', 'GroupIds', 'Entries')
+# AWS calls are paced by an adaptive token bucket per service and region, shared by every thread of the container.
+# The rate is cut by RATE_LIMIT_DECREASE_FACTOR when the service throttles, and grows back by about
+# RATE_LIMIT_INCREASE_STEP requests per second for every second of successful calls
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_INITIAL_RATE = float(os.environ.get("RATE_LIMIT_INITIAL_RATE", "20"))
+RATE_LIMIT_MIN_RATE = float(os.environ.get("RATE_LIMIT_MIN_RATE", "1"))
+RATE_LIMIT_MAX_RATE = float(os.environ.get("RATE_LIMIT_MAX_RATE", "100"))
+RATE_LIMIT_DECREASE_FACTOR = 0.5
+RATE_LIMIT_INCREASE_STEP = 1.0
+# Throttles seen by concurrent calls within this window count as one congestion signal
+RATE_LIMIT_DECREASE_COOLDOWN_SECONDS = 1.0
+# Throttled and transient errors are retried with full jitter backoff, botocore's own retries are turned off so every throttle reaches the limiter
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_SECONDS = 0.1
+RETRY_MAX_DELAY_SECONDS = 2.0
+TRANSIENT_ERROR_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable', 'RequestTimeout', 'RequestTimeoutException')
+
+# Logs are JSON documents with fixed fields, "text" keeps the plain format
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# API payloads are logged as a summary of their shape unless LOG_PAYLOADS is set, and capped at LOG_PAYLOAD_MAX_CHARS either way
+LOG_PAYLOADS = os.environ.get("LOG_PAYLOADS", "false").lower() == "true"
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "2000"))
+# Fraction of the high volume, per instance messages below WARNING that are kept
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.1"))
+LOG_FIELDS = ('request_id', 'account_id', 'instance_id', 'region', 'stage')
+
+# Opt-in profiling of sampled invocations with cProfile, see InvocationProfiler. Both are off by default
+# Profile the first invocation of each container, which includes building its clients
+PROFILE_COLD_START = os.environ.get("PROFILE_COLD_START", "false").lower() == "true"
+# Profile 1 in PROFILE_WARM_ONE_IN warm invocations, 0 profiles none
+PROFILE_WARM_ONE_IN = int(os.environ.get("PROFILE_WARM_ONE_IN", "0"))
+# Directory the profiles are written to, /tmp is the only writable path in lambda
+PROFILE_PATH = os.environ.get("PROFILE_PATH", "/tmp/profiles")
+
+### LOGGING
+# Messages are formatted lazily, log.info("... %s", value), so records below the log level cost no string work.
+# Every record carries LOG_FIELDS, taken from the log context unless the call passes them as extra
+_log_context = contextvars.ContextVar('log_context', default={})
+
+@contextlib.contextmanager
+def log_context(**fields):
+    '''Adds fields to the log context of the enclosed code'''
+    token = _log_context.set(dict(_log_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+def log_fields(instance_id=None, sampled=False):
+    '''Returns the extra of a log call about one instance, sampled marks it as high volume'''
+    return {'instance_id': instance_id, 'sampled': sampled}
+
+class ContextFilter(logging.Filter):
+    '''Drops the unsampled share of high volume records and stamps the others with the log context'''
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and record.levelno < logging.WARNING and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        context = _log_context.get()
+        for field in LOG_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, context.get(field))
+        return True
+
+class JsonFormatter(logging.Formatter):
+    '''Formats a record as one JSON document'''
+    def format(self, record):
+        document = {
+            'timestamp': '{0}.{1:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)), int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            document[field] = getattr(record, field, None)
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+class Payload:
+    '''Wraps an API payload for a log call, it is only rendered if the record is emitted'''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = json.dumps(self.value, default=str) if LOG_PAYLOADS else summarize_payload(self.value)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            return "{0}... ({1} chars)".format(text[:LOG_PAYLOAD_MAX_CHARS], len(text))
+        return text
+
+def summarize_payload(value):
+    '''Describes the shape of a payload, lists are reduced to their length and response metadata is left out'''
+    if isinstance(value, dict):
+        return '{' + ', '.join('{0}: {1}'.format(key, summarize_payload(item)) for key, item in value.items() if key != 'ResponseMetadata') + '}'
+    if isinstance(value, (list, tuple)):
+        return '[{0} items]'.format(len(value))
+    return str(value)
+
+def bind_request_id(handler):
+    '''Wraps a lambda handler so its log records carry the request ID of the invocation'''
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        with log_context(request_id=getattr(context, 'aws_request_id', None)):
+            return handler(event, context)
+    return wrapper
+
+def get_logger(name):
+    '''Returns a logger at LOG_LEVEL whose records carry the log context, each handler logs under its own name'''
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+    logger.addFilter(ContextFilter())
+    return logger
+
+logging.basicConfig(level=LOG_LEVEL)
+log = get_logger("ec2_common_logger")
+if LOG_FORMAT == "json":
+    # In lambda, the root logger's handler is the runtime's, it writes the records to CloudWatch as they are formatted here
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JsonFormatter())
+
+### CLIENT REGISTRY
+# Clients are cached at module scope, keyed by account, service and region, so warm invocations
+# reuse their connection pools and the service models botocore has already loaded.
+_clients = {}
+_clients_lock = threading.Lock()
+# Rate limiters, keyed by account, service and region like the clients
+_rate_limiters = {}
+
+# The account of the records being handled, set by account_context
+_account_id = contextvars.ContextVar('account_id', default=None)
+
+@contextlib.contextmanager
+def account_context(account_id):
+    '''Runs the enclosed code against an account: its EC2 and Auto Scaling clients use the role assumed in the account,
+    and its log records carry the account ID'''
+    token = _account_id.set(account_id)
+    try:
+        with log_context(account_id=account_id):
+            yield
+    finally:
+        _account_id.reset(token)
+
+def current_account_id():
+    '''Returns the account of the records being handled, or None outside an account context'''
+    return _account_id.get()
+
+def client_account(service):
+    '''Returns the account whose assumed role a client of the service uses in the current context, or None for the lambda's own credentials'''
+    account_id = _account_id.get()
+    if not _account_credentials.role_name or service not in ACCOUNT_SERVICES or not account_id or account_id == HOME_ACCOUNT_ID:
+        return None
+    return account_id
+
+class AccountCredentials:
+    '''Caches the credentials of the role assumed in each account. They are assumed again CREDENTIAL_REFRESH_SECONDS
+    before they expire, so one AssumeRole call serves every client of an account until then'''
+    def __init__(self, role_name, duration_seconds, refresh_seconds):
+        self.role_name = role_name
+        self.duration_seconds = duration_seconds
+        self.refresh_seconds = refresh_seconds
+        # account ID -> (refresh time, credentials)
+        self._credentials = {}
+        # One lock per account, so an account's role is assumed once while the other accounts use their cached credentials
+        self._locks = {}
+        self.assumptions = 0
+
+    def _current(self, account_id):
+        entry = self._credentials.get(account_id)
+        if entry is not None and entry[0] > time.time():
+            return entry
+        return None
+
+    def get(self, account_id):
+        '''Returns the refresh time and the credentials of an account, assuming its role when they aren't cached or are due for refresh.
+        Raises ValueError if the role can't be assumed'''
+        entry = self._current(account_id)
+        if entry is not None:
+            return entry
+        with self._locks.setdefault(account_id, threading.Lock()):
+            # Another thread may have assumed the role while we waited
+            entry = self._current(account_id)
+            if entry is not None:
+                return entry
+            role_arn = "arn:aws:iam::{0}:role/{1}".format(account_id, self.role_name)
+            try:
+                response = call_aws('sts', DEFAULT_REGION, 'AssumeRole', get_client('sts', DEFAULT_REGION).assume_role, RoleArn=role_arn,
+                                    RoleSessionName=os.environ.get("AWS_LAMBDA_FUNCTION_NAME", FUNCTION_NAME), DurationSeconds=self.duration_seconds)
+            except (ClientError, BotoCoreError) as error:
+                # Also covers an STS client that can't be built or reached, so one account fails only its own records
+                raise ValueError("Unable to assume role: {0}, error: {1}".format(role_arn, error))
+            credentials = response['Credentials']
+            self.assumptions += 1
+            log.info("Assumed role: %s, its credentials expire at %s", role_arn, credentials['Expiration'])
+            entry = (credentials['Expiration'].timestamp() - self.refresh_seconds, credentials)
+            self._credentials[account_id] = entry
+            return entry
+
+    def clear(self):
+        self._credentials.clear()
+        self.assumptions = 0
+
+_account_credentials = AccountCredentials(ACCOUNT_ROLE_NAME, ASSUME_ROLE_DURATION_SECONDS, CREDENTIAL_REFRESH_SECONDS)
+
+def get_client(service, region):
+    '''Returns the shared boto3 client for a service and region, creating it on first use.
+    In an account context, the clients of the ACCOUNT_SERVICES are built from the account's assumed role, and built again when it is refreshed'''
+    account_id = client_account(service)
+    key = (account_id, service, region)
+    entry = _clients.get(key)
+    if entry is None or entry[0] <= time.time():
+        # The role is assumed outside the clients lock, so an account waiting on STS doesn't hold up the clients of the others
+        refresh_at, credentials = _account_credentials.get(account_id) if account_id is not None else (float('inf'), None)
+        # Client creation from the default session is not thread safe, so only one thread builds a client at a time
+        with _clients_lock:
+            entry = _clients.get(key)
+            if entry is None or entry[0] <= time.time():
+                # boto3 and botocore.config make up most of the import time, so they are only imported once a client is needed
+                import boto3
+                from botocore.config import Config
+                keys = {}
+                if credentials is not None:
+                    keys = {'aws_access_key_id': credentials['AccessKeyId'], 'aws_secret_access_key': credentials['SecretAccessKey'],
+                            'aws_session_token': credentials['SessionToken']}
+                # total_max_attempts counts the first call, max_attempts doesn't: 1 is a single attempt, call_aws does the retrying
+                client = boto3.client(service, region_name=region, config=Config(max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS, retries={'mode': 'standard', 'total_max_attempts': 1}), **keys)
+                entry = (refresh_at, client)
+                _clients[key] = entry
+    return entry[1]
+
+def reset_clients():
+    '''Drops every cached client, rate limiter and assumed role so the next lookup builds a new one. The handlers' reset_clients
+    also drop their own caches, tests call those so a patched boto3.client is picked up'''
+    _account_credentials.clear()
+    with _clients_lock:
+        _clients.clear()
+        _rate_limiters.clear()
+
+def prewarm_clients(services):
+    '''Builds the clients of the services a handler uses in the prewarm regions, loading their service models ahead of the first invocation'''
+    for region in PREWARM_REGIONS:
+        for service in services:
+            try:
+                get_client(service, region)
+            except Exception as error:
+                # A failed prewarm only costs us the cold path, the client is built again on first use
+                log.warning("Unable to prewarm %s client in region: %s, error: %s", service, region, error)
+
+### METRICS
+# Every AWS call and pipeline stage is recorded per invocation and flushed as one CloudWatch
+# Embedded Metric Format line on stdout, which CloudWatch Logs turns into metrics
+class MetricsRecorder:
+    '''Collects the metrics of one invocation. When disabled, recording is a no-op and nothing is flushed'''
+    def __init__(self, namespace, function_name, enabled=True):
+        self.namespace = namespace
+        self.function_name = function_name
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # metric name -> list of values, and metric name -> unit
+            self._values = defaultdict(list)
+            self._units = {}
+
+    def put(self, name, value, unit='Count'):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[name].append(value)
+            self._units[name] = unit
+
+    def record_api_call(self, service, operation, duration_ms, retries=0, error_code=None, batch_size=None, throttles=0):
+        prefix = "{0}.{1}.".format(service, operation)
+        self.put(prefix + 'Duration', duration_ms, 'Milliseconds')
+        self.put(prefix + 'Calls', 1)
+        self.put(prefix + 'Retries', retries)
+        if throttles:
+            self.put(prefix + 'Throttles', throttles)
+        if error_code is not None:
+            self.put(prefix + 'Errors', 1)
+        if batch_size is not None:
+            self.put(prefix + 'BatchSize', batch_size, 'None')
+
+    def stage(self, name):
+        '''Returns a context manager recording the duration of a pipeline stage, and naming it in the log context'''
+        return StageTimer(self, name)
+
+    def stage_durations(self):
+        '''Returns the total duration of each pipeline stage recorded so far, in ms keyed by stage name'''
+        prefix, suffix = 'Stage.', '.Duration'
+        with self._lock:
+            return {name[len(prefix):-len(suffix)]: sum(values) for name, values in self._values.items()
+                    if name.startswith(prefix) and name.endswith(suffix)}
+
+    def snapshot(self):
+        '''Returns the metrics as an EMF document, or None when nothing was recorded.
+        Counts are summed, other units keep up to METRICS_MAX_VALUES values per metric'''
+        with self._lock:
+            if not self._values:
+                return None
+            document = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['FunctionName']],
+                        'Metrics': [{'Name': name, 'Unit': self._units[name]} for name in sorted(self._values)]
+                    }]
+                },
+                'FunctionName': self.function_name,
+            }
+            for name, values in self._values.items():
+                document[name] = sum(values) if self._units[name] == 'Count' else values[:METRICS_MAX_VALUES]
+            return document
+
+    def flush(self):
+        '''Prints the invocation's metrics as one EMF line and starts over'''
+        if not self.enabled:
+            return
+        document = self.snapshot()
+        self.reset()
+        if document is not None:
+            print(json.dumps(document), file=sys.stdout, flush=True)
+
+class StageTimer:
+    '''Records the duration of a pipeline stage as Stage.<name>.Duration, the stage is the log context's stage meanwhile'''
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.token = _log_context.set(dict(_log_context.get(), stage=self.name))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.put("Stage.{0}.Duration".format(self.name), (time.perf_counter() - self.start) * 1000, 'Milliseconds')
+        _log_context.reset(self.token)
+        return False
+
+metrics = MetricsRecorder(METRICS_NAMESPACE, os.environ.get("AWS_LAMBDA_FUNCTION_NAME", FUNCTION_NAME), METRICS_ENABLED)
+
+class AdaptiveRateLimiter:
+    '''Token bucket whose rate shrinks multiplicatively when the service throttles and recovers additively on success.
+    Bursts up to one second of calls, acquire blocks until a token is available'''
+    def __init__(self, rate=RATE_LIMIT_INITIAL_RATE, min_rate=RATE_LIMIT_MIN_RATE, max_rate=RATE_LIMIT_MAX_RATE):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.monotonic()
+        self.last_decrease = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_LIMIT_INCREASE_STEP / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.last_decrease is not None and now - self.last_decrease < RATE_LIMIT_DECREASE_COOLDOWN_SECONDS:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * RATE_LIMIT_DECREASE_FACTOR)
+            # Drop the burst so the calls already waiting slow down straight away
+            self.tokens = min(self.tokens, 0.0)
+
+def get_rate_limiter(service, region):
+    '''Returns the rate limiter shared by every call to a service in a region of an account, API limits are per account'''
+    key = (client_account(service), service, region)
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        with _clients_lock:
+            limiter = _rate_limiters.setdefault(key, AdaptiveRateLimiter())
+    return limiter
+
+def call_aws(service, region, operation, method, **kwargs):
+    '''Calls a client method through the rate limiter of its service and region.
+    Throttled and transient errors are retried with jittered backoff, throttles also slow the limiter down.
+    Records the call's latency, retries, errors, throttles and batch size'''
+    limiter = get_rate_limiter(service, region) if RATE_LIMIT_ENABLED else None
+    start = time.perf_counter() if metrics.enabled else None
+    attempts = 0
+    throttles = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        attempts += 1
+        try:
+            response = method(**kwargs)
+            break
+        except ClientError as error:
+            code = error.response.get('Error', {}).get('Code')
+            throttled = code in THROTTLE_ERROR_CODES
+            if throttled:
+                throttles += 1
+                if limiter is not None:
+                    limiter.on_throttle()
+            if attempts >= RETRY_MAX_ATTEMPTS or not (throttled or code in TRANSIENT_ERROR_CODES):
+                if start is not None:
+                    metrics.record_api_call(service, operation, (time.perf_counter() - start) * 1000,
+                                            attempts - 1 + retry_attempts(error.response), code, batch_size(kwargs), throttles)
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempts))
+            log.warning("%s %s failed with %s in region: %s, retrying in %.2fs", service, operation, code, region, delay)
+            time.sleep(delay)
+    if limiter is not None:
+        limiter.on_success()
+    if start is not None:
+        metrics.record_api_call(service, operation, (time.perf_counter() - start) * 1000,
+                                attempts - 1 + retry_attempts(response), None, batch_size(kwargs), throttles)
+    return response
+
+def batch_size(kwargs):
+    '''Returns the number of items in the batch parameter of a request, or None'''
+    for parameter in BATCH_PARAMETERS:
+        if parameter in kwargs:
+            return len(kwargs[parameter])
+    return None
+
+def retry_attempts(response):
+    '''Returns the number of retries botocore made for a response'''
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    return 0
+
+def handler_function_name(handler):
+    '''Returns the name a handler reports under: the lambda function's, or outside lambda the name of the handler's module'''
+    return os.environ.get("AWS_LAMBDA_FUNCTION_NAME", handler.__module__.rpartition('.')[2])
+
+def flush_metrics(handler):
+    '''Wraps a lambda handler so the metrics of each invocation are flushed, under the handler's name, when it returns or raises'''
+    function_name = handler_function_name(handler)
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        metrics.function_name = function_name
+        metrics.reset()
+        try:
+            return handler(event, context)
+        finally:
+            metrics.flush()
+    return wrapper
+
+### PROFILING
+# Sampled invocations run under cProfile. Each profile is written as a pstats file (<name>.prof) next to a JSON file of its
+# tags (<name>.json): the batch size, regions and stage timings of the invocation. benchmarks/profile_report.py aggregates
+# them into a report of the functions the time goes to
+# Profiles of the thread pool tasks of the invocation being profiled, the tasks inherit it through their copied context
+_thread_profiles = contextvars.ContextVar('thread_profiles', default=None)
+
+class InvocationProfiler:
+    '''Decides which invocations are profiled, and hands their profiles to the sink. With cold_start, the first invocation of
+    the container is profiled, then 1 in warm_one_in of the warm invocations, none when it is 0'''
+    def __init__(self, function_name, cold_start, warm_one_in, path):
+        self.function_name = function_name
+        self.cold_start = cold_start
+        self.warm_one_in = warm_one_in
+        self.path = path
+        # Called with the tags and the marshalled pstats of each profile, tests and tools can inject their own
+        self.sink = self.write_profile
+        self.invocations = 0
+
+    def sample(self):
+        '''Counts an invocation, returns whether it is profiled and whether it is the cold start of the container'''
+        self.invocations += 1
+        if self.invocations == 1:
+            return self.cold_start, True
+        return self.warm_one_in > 0 and random.randrange(self.warm_one_in) == 0, False
+
+    def profile(self, handler, event, context):
+        '''Runs the handler, under cProfile when the invocation is sampled. A profile that can't be written doesn't fail the invocation'''
+        profiled, cold_start = self.sample()
+        if not profiled:
+            return handler(event, context)
+        # The profilers are only imported once an invocation is profiled, they stay out of the cold start otherwise
+        import cProfile
+        import marshal
+        import pstats
+        profile = cProfile.Profile()
+        thread_profiles = []
+        token = _thread_profiles.set(thread_profiles)
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return handler(event, context)
+        finally:
+            profile.disable()
+            duration_ms = (time.perf_counter() - start) * 1000
+            _thread_profiles.reset(token)
+            try:
+                stats = pstats.Stats(profile)
+                for thread_profile in list(thread_profiles):
+                    stats.add(thread_profile)
+                self.sink(self.tags(event, context, cold_start, duration_ms), marshal.dumps(stats.stats))
+            except Exception as error:
+                log.warning("Unable to write profile, error: %s", error)
+
+    def tags(self, event, context, cold_start, duration_ms):
+        '''Returns what a profile is tagged with, the stage timings are those recorded by the metrics'''
+        records = event.get('Records') if isinstance(event, dict) else None
+        return {
+            'function': self.function_name,
+            'request_id': getattr(context, 'aws_request_id', None),
+            'time': time.time(),
+            'cold_start': cold_start,
+            'batch_size': len(records) if records is not None else None,
+            'regions': event_regions(records or []),
+            'stages': metrics.stage_durations(),
+            'duration_ms': duration_ms,
+        }
+
+    def write_profile(self, tags, stats):
+        '''Writes a profile and its tags to the profile path, named after the function, time and invocation'''
+        os.makedirs(self.path, exist_ok=True)
+        name = os.path.join(self.path, "{0}-{1}-{2}".format(self.function_name, int(tags['time'] * 1000), self.invocations))
+        with open(name + '.prof', 'wb') as profile_file:
+            profile_file.write(stats)
+        with open(name + '.json', 'w', encoding='utf-8') as tags_file:
+            json.dump(tags, tags_file)
+        log.info("Wrote profile: %s.prof", name)
+
+profiler = InvocationProfiler(os.environ.get("AWS_LAMBDA_FUNCTION_NAME", FUNCTION_NAME), PROFILE_COLD_START, PROFILE_WARM_ONE_IN, PROFILE_PATH)
+
+def event_regions(records):
+    '''Returns the sorted regions of SQS records, whether they are instance events or decisions'''
+    regions = set()
+    for record in records:
+        try:
+            body = json.loads(record['body'])
+            region = Decision.decode(record['body']).region if isinstance(body, list) else body.get('region')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+        if isinstance(region, str):
+            regions.add(region)
+    return sorted(regions)
+
+def profile_invocations(handler):
+    '''Wraps a lambda handler so the invocations the profiler samples are profiled, under the handler's name'''
+    function_name = handler_function_name(handler)
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        profiler.function_name = function_name
+        return profiler.profile(handler, event, context)
+    return wrapper
+
+def profile_thread(function, *args):
+    '''Runs a thread pool task, under its own cProfile when the invocation is profiled, so the work done off the handler
+    thread is in the invocation's profile'''
+    thread_profiles = _thread_profiles.get()
+    if thread_profiles is None:
+        return function(*args)
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12 and later allow a single active profiler, the task is only seen as time waiting on it
+        return function(*args)
+    try:
+        return function(*args)
+    finally:
+        profile.disable()
+        thread_profiles.append(profile)
+
+### INSTANCES
+def stop_instances(instance_ids, region):
+    '''Accepts a list of instance IDs and region, stops the instances with one call. Both the stop lambda and inline containment use it.
+    If the call fails because of one of the instances (e.g. one ID is invalid or protected), the list is bisected so the other
+    instances are still stopped. Any other error fails every instance of the list without more calls.
+    Returns the list of instance IDs that could not be stopped'''
+    if not instance_ids:
+        return []
+    try:
+        response = call_aws('ec2', region, 'StopInstances', get_client('ec2', region).stop_instances, InstanceIds=instance_ids)
+        log.info("Stopped instances: %s", instance_ids)
+        log.debug("Stop instances response: %s", Payload(response))
+        return []
+    except ClientError as error:
+        log.error("Unable to stop instances: %s, error: %s", instance_ids, error)
+        if len(instance_ids) == 1 or not error.response.get('Error', {}).get('Code', '').startswith(STOP_INSTANCE_ERROR_CODES):
+            return list(instance_ids)
+    middle = len(instance_ids) // 2
+    return stop_instances(instance_ids[:middle], region) + stop_instances(instance_ids[middle:], region)
+
+### SECURITY GROUPS
+def world_open_ip_versions(permission):
+    '''Returns the IP versions, 4 and 6, whose whole internet a security group permission is open to.
+    Any /0 block spans its whole address space whatever its address bits, so "10.0.0.0/0" is as open as "0.0.0.0/0".
+    The evaluation and the lock both use it, so they agree on which groups expose an instance'''
+    versions = []
+    if any(r['CidrIp'].endswith('/0') for r in permission.get('IpRanges', [])):
+        versions.append(4)
+    if any(r['CidrIpv6'].endswith('/0') for r in permission.get('Ipv6Ranges', [])):
+        versions.append(6)
+    return versions
+
+### DECISIONS
+# Decisions travel from evaluate_instances to the stop and lock queues in a compact, versioned wire format: a JSON array of
+# DECISION_WIRE_VERSION followed by the fields in Decision.__slots__ order, without its trailing empty fields.
+# Messages in the previous format, a JSON object keyed by field name, are still decoded
+DECISION_WIRE_VERSION = 1
+DECISION_ACTIONS = ('stop', 'lock')
+# The fields every decision has, the others may be empty
+DECISION_REQUIRED_FIELDS = ('instance_id', 'action', 'region')
+
+class Decision:
+    '''The stop or lock decision for one instance, with what the stop and lock lambdas need to act on it'''
+    __slots__ = ('instance_id', 'action', 'flag', 'region', 'security_group_ids', 'vpc_id', 'account_id', 'bad_security_group_ids')
+
+    def __init__(self, instance_id, action, flag, region, security_group_ids=None, vpc_id=None, account_id=None, bad_security_group_ids=None):
+        self.instance_id = instance_id
+        self.action = action
+        self.flag = flag
+        self.region = region
+        self.security_group_ids = security_group_ids if security_group_ids is not None else []
+        self.vpc_id = vpc_id
+        self.account_id = account_id
+        self.bad_security_group_ids = bad_security_group_ids
+
+    def __eq__(self, other):
+        return isinstance(other, Decision) and all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return "Decision({0})".format(", ".join("{0}={1!r}".format(field, getattr(self, field)) for field in self.__slots__))
+
+    def replace(self, **fields):
+        '''Returns a copy of the decision with some of its fields changed'''
+        decision = Decision(*(getattr(self, field) for field in self.__slots__))
+        for field, value in fields.items():
+            setattr(decision, field, value)
+        return decision
+
+    def encode(self):
+        '''Returns the message body of the decision in the wire format'''
+        values = [DECISION_WIRE_VERSION] + [getattr(self, field) for field in self.__slots__]
+        while values[-1] is None:
+            values.pop()
+        return json.dumps(values, separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, body):
+        '''Returns the decision of a message body, in the wire format or the previous JSON object format.
+        Raises ValueError for a body that isn't a valid decision'''
+        value = json.loads(body)
+        if isinstance(value, list):
+            if not value or value[0] != DECISION_WIRE_VERSION:
+                raise ValueError("Unsupported decision version: {0}".format(value[0] if value else None))
+            if not len(DECISION_REQUIRED_FIELDS) + 2 <= len(value) <= len(cls.__slots__) + 1:
+                raise ValueError("Decision has {0} fields".format(len(value) - 1))
+            decision = cls(*value[1:])
+        elif isinstance(value, dict):
+            decision = cls.from_dict(value)
+        else:
+            raise ValueError("Decision is neither a JSON array nor an object")
+        decision.validate()
+        return decision
+
+    @classmethod
+    def from_dict(cls, value):
+        '''Returns the decision of a dict keyed by field name. Raises ValueError if a required field is missing'''
+        missing = [field for field in DECISION_REQUIRED_FIELDS if field not in value]
+        if missing:
+            raise ValueError("Decision is missing fields: {0}".format(missing))
+        return cls(**{field: value.get(field) for field in cls.__slots__})
+
+    def validate(self):
+        '''Checks the types of the fields the lambdas act on, raises ValueError for an invalid decision'''
+        if self.action not in DECISION_ACTIONS:
+            raise ValueError("Unknown decision action: {0}".format(self.action))
+        if not isinstance(self.instance_id, str) or not isinstance(self.region, str):
+            raise ValueError("Decision instance ID and region must be strings")
+        if not isinstance(self.security_group_ids, list) or not isinstance(self.bad_security_group_ids, (list, type(None))):
+            raise ValueError("Decision security group IDs must be lists")
+
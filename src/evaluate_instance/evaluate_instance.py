@@ -1,149 +1,727 @@
+import bisect
+import contextvars
+import itertools
 import json
-import boto3
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from botocore.exceptions import ClientError
-from collections import defaultdict
-import logging
+from collections import OrderedDict, defaultdict, namedtuple
+import shutdown_common
+from shutdown_common import (DEFAULT_REGION, STARTUP_MODE, Decision, Payload, account_context, bind_request_id, call_aws,
+                             client_account, current_account_id, flush_metrics, get_client, get_logger, log_context, log_fields,
+                             metrics, prewarm_clients, profile_invocations, profile_thread, stop_instances, world_open_ip_versions)
 
 ### VARIABLES
 STOP_QUEUE_NAME = "stop_instance_queue"
 LOCK_QUEUE_NAME = "lock_instance_queue"
-# We need this so we know which region to send our SQS messages to
-DEFAULT_REGION  = "us-east-1"
+# Bulk lookups are chunked to stay within the API request limits
+SECURITY_GROUP_CHUNK_SIZE = 200
+ASG_INSTANCE_CHUNK_SIZE = 50
+INSTANCE_ID_CHUNK_SIZE = 200
+# Described instances are trimmed to the fields the evaluation reads, so large responses aren't kept in memory
+INSTANCE_FIELDS = ('InstanceId', 'State', 'Tags', 'SecurityGroups', 'RootDeviceType', 'InstanceLifecycle', 'VpcId', 'LaunchTime')
+# SendMessageBatch accepts at most 10 entries per call
+SQS_BATCH_SIZE = 10
+PREWARM_SERVICES = ('ec2', 'autoscaling', 'sqs')
+# Regions in a batch are evaluated in parallel. A region that hasn't finished within the timeout
+# (counted from the end of the batch parsing, so keep the worker count at or above the regions in a batch)
+# is reported for retry, it must stay below the lambda timeout. Inline stops share the same deadline
+REGION_MAX_WORKERS = int(os.environ.get("REGION_MAX_WORKERS", "10"))
+REGION_TIMEOUT_SECONDS = float(os.environ.get("REGION_TIMEOUT_SECONDS", "7"))
+# At most this many regions of one account are evaluated at once, so a large account leaves workers to the others
+ACCOUNT_MAX_CONCURRENCY = int(os.environ.get("ACCOUNT_MAX_CONCURRENCY", "4"))
+# Security groups and ASG memberships are cached across warm invocations for a short TTL
+LOOKUP_CACHE_ENABLED = os.environ.get("LOOKUP_CACHE_ENABLED", "true").lower() == "true"
+LOOKUP_CACHE_TTL_SECONDS = float(os.environ.get("LOOKUP_CACHE_TTL_SECONDS", "60"))
+LOOKUP_CACHE_MAX_SIZE = int(os.environ.get("LOOKUP_CACHE_MAX_SIZE", "2000"))
+# Instances launched from the same configuration get the same verdict, it is memoized per launch fingerprint.
+# The TTL defaults to the lookup caches', a verdict is never older than the security groups it was made from
+DECISION_MEMO_ENABLED = os.environ.get("DECISION_MEMO_ENABLED", "true").lower() == "true"
+DECISION_MEMO_TTL_SECONDS = float(os.environ.get("DECISION_MEMO_TTL_SECONDS", str(LOOKUP_CACHE_TTL_SECONDS)))
+ASG_NAME_TAG_KEY = "aws:autoscaling:groupName"
+EXCLUSION_TAG_KEY = "shutdown_service_excluded"
 
-### LOGGING
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("ec2_shutdown_logger")
-log.setLevel(logging.INFO)
+# "stop" stops the instances decided for stopping from this lambda instead of routing them through the stop queue,
+# failed stops are routed to the lock queue and stops above INLINE_STOP_MAX_INSTANCES per region to the stop queue.
+# Locks always go through the lock queue, the lock engine only ships in the lock_instance image
+INLINE_CONTAINMENT = os.environ.get("INLINE_CONTAINMENT", "off").lower()
+INLINE_STOP_MAX_INSTANCES = int(os.environ.get("INLINE_STOP_MAX_INSTANCES", "50"))
+
+# The sweep pages through every running instance of every region, SWEEP_PAGE_SIZE instances at a time.
+# When less than SWEEP_TIME_RESERVE_SECONDS of the lambda timeout is left, it saves its position and invokes itself to continue
+SWEEP_REGIONS = [region for region in os.environ.get("SWEEP_REGIONS", "").split(",") if region]
+# Accounts the sweep covers, through ACCOUNT_ROLE_NAME. Empty sweeps the lambda's own account
+SWEEP_ACCOUNTS = [account_id for account_id in os.environ.get("SWEEP_ACCOUNTS", "").split(",") if account_id]
+SWEEP_PAGE_SIZE = int(os.environ.get("SWEEP_PAGE_SIZE", "1000"))
+SWEEP_TIME_RESERVE_SECONDS = float(os.environ.get("SWEEP_TIME_RESERVE_SECONDS", "60"))
+# Bounds the number of self invocations of one sweep, in case a region never finishes
+SWEEP_MAX_CONTINUATIONS = int(os.environ.get("SWEEP_MAX_CONTINUATIONS", "50"))
+# Deduplication of repeated deliveries. Claims are held in memory for the container, and in the DEDUP_TABLE DynamoDB table
+# (partition key dedup_key, TTL attribute expires_at) when it is set, so they are shared by every container
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_TTL_SECONDS = int(os.environ.get("DEDUP_TTL_SECONDS", "600"))
+DEDUP_MAX_SIZE = int(os.environ.get("DEDUP_MAX_SIZE", "5000"))
+DEDUP_TABLE = os.environ.get("DEDUP_TABLE", "")
+# Every security group of a region is indexed by the policies it violates. The index is built by one paginated scan of the region
+# and kept current by the security group change events, so it is only rebuilt after SECURITY_GROUP_INDEX_TTL_SECONDS.
+# A container only sees the events delivered to it, but the container that handles a change evaluates the running instances
+# of the group right away. The TTL bounds how long another container evaluates new launches against the old rules
+SECURITY_GROUP_INDEX_ENABLED = os.environ.get("SECURITY_GROUP_INDEX_ENABLED", "true").lower() == "true"
+SECURITY_GROUP_INDEX_TTL_SECONDS = float(os.environ.get("SECURITY_GROUP_INDEX_TTL_SECONDS", "3600"))
+SECURITY_GROUP_SCAN_PAGE_SIZE = 1000
+# CloudTrail events of the changes that can make a security group start or stop violating a policy
+SECURITY_GROUP_EVENTS = ('AuthorizeSecurityGroupIngress', 'RevokeSecurityGroupIngress', 'CreateSecurityGroup', 'DeleteSecurityGroup')
+
+# An exposure is a protocol and port that must not be open to the world, a protocol of "-1" means every protocol
+ExposurePolicy = namedtuple('ExposurePolicy', ['name', 'protocol', 'port'])
+SSH_EXPOSURE = ExposurePolicy('ssh', 'tcp', 22)
+# Policies an instance is checked against, e.g. add ExposurePolicy('rdp', 'tcp', 3389)
+FORBIDDEN_EXPOSURES = (SSH_EXPOSURE,)
+# Violation recorded for a VPC's default security group, which instances must not use
+DEFAULT_GROUP_VIOLATION = 'default'
+# Security group rules may use protocol numbers instead of names
+PROTOCOL_NAMES = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6'}
+ALL_PORTS = (0, 65535)
+
+log = get_logger("ec2_shutdown_logger")
+
+### CLIENT REGISTRY
+# Queue URLs are looked up once per container, keyed by region and queue name
+_queue_urls = {}
+
+def reset_clients():
+    '''Drops every cached client, queue URL and assumed role so the next lookup builds a new one. Tests call this so a patched boto3.client is picked up'''
+    shutdown_common.reset_clients()
+    _queue_urls.clear()
 
 ### CLASSES
+class TTLCache:
+    '''A bounded, thread safe LRU cache whose entries expire after a TTL. get returns None on a miss'''
+    def __init__(self, name, max_size, ttl_seconds, enabled=True):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the cached value for the key, or None if it is missing or expired'''
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        '''Caches a value for the TTL, evicting the least recently used entry when full'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value):
+        '''Caches a value only if the key is missing or expired, returns True if it was added. Checking and setting is atomic'''
+        if not self.enabled:
+            return True
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        '''Drops the entry for the key, if any'''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''Drops every entry and resets the hit/miss counters'''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''Returns the cache size and hit/miss counters'''
+        return {'name': self.name, 'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+class CompiledSecurityGroup:
+    '''A security group compiled into sorted, merged port intervals that are open to the world,
+    indexed by IP version (4 or 6) and protocol, so exposure checks are a binary search instead of a walk over the rules'''
+    __slots__ = ('group_id', 'group_name', 'intervals')
+
+    def __init__(self, security_group):
+        self.group_id = security_group.get('GroupId')
+        self.group_name = security_group.get('GroupName')
+        open_ranges = defaultdict(list)
+        for p in security_group.get('IpPermissions', []):
+            protocol = PROTOCOL_NAMES.get(p['IpProtocol'], p['IpProtocol'])
+            # Rules for every protocol, or without ports, cover the whole port range
+            if protocol == '-1' or p.get('FromPort', -1) == -1:
+                port_range = ALL_PORTS
+            else:
+                port_range = (p['FromPort'], p['ToPort'])
+            for version in world_open_ip_versions(p):
+                open_ranges[(version, protocol)].append(port_range)
+        # Each index entry is a pair of lists: the start and end of every merged interval
+        self.intervals = {}
+        for key, ranges in open_ranges.items():
+            starts, ends = [], []
+            for from_port, to_port in sorted(ranges):
+                if ends and from_port <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], to_port)
+                else:
+                    starts.append(from_port)
+                    ends.append(to_port)
+            self.intervals[key] = (starts, ends)
+
+    def is_open(self, protocol, port):
+        '''Returns True if the port is open to the world over IPv4 or IPv6 for the protocol'''
+        for version in (4, 6):
+            for rule_protocol in (protocol, '-1'):
+                index = self.intervals.get((version, rule_protocol))
+                if index is None:
+                    continue
+                starts, ends = index
+                position = bisect.bisect_right(starts, port) - 1
+                if position >= 0 and port <= ends[position]:
+                    return True
+        return False
+
+class DynamoDbDedupTable:
+    '''Shared tier of the dedup store, a DynamoDB table holding one item per claimed key until it expires'''
+    def __init__(self, table_name, region):
+        self.table_name = table_name
+        self.region = region
+
+    def claim(self, key, ttl_seconds):
+        '''Writes the key unless a live claim exists, returns False if it was already claimed.
+        Fails open, returning True, when the table can't be reached, so an outage never stops an evaluation'''
+        now = int(time.time())
+        client = get_client('dynamodb', self.region)
+        try:
+            call_aws('dynamodb', self.region, 'PutItem', client.put_item, TableName=self.table_name,
+                     Item={'dedup_key': {'S': key}, 'expires_at': {'N': str(now + ttl_seconds)}},
+                     ConditionExpression='attribute_not_exists(dedup_key) OR expires_at < :now',
+                     ExpressionAttributeValues={':now': {'N': str(now)}})
+            return True
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            log.error("Unable to claim dedup key: %s, evaluating it anyway. error: %s", key, error)
+            return True
+
+    def release(self, key):
+        '''Deletes the claim on the key so a retry is evaluated again'''
+        client = get_client('dynamodb', self.region)
+        try:
+            call_aws('dynamodb', self.region, 'DeleteItem', client.delete_item, TableName=self.table_name, Key={'dedup_key': {'S': key}})
+        except ClientError as error:
+            log.error("Unable to release dedup key: %s, error: %s", key, error)
+
+class DedupStore:
+    '''Claims keys for DEDUP_TTL_SECONDS, so repeated deliveries of an event or a decision are only handled once.
+    The in-memory tier catches duplicates delivered to the same container without an API call,
+    the shared table, when configured, catches the ones delivered to other containers'''
+    def __init__(self, ttl_seconds, max_size, table_name, enabled=True):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.memory = TTLCache('dedup', max_size, ttl_seconds, enabled)
+        # Keyed by account, region and instance ID, the key each decision was claimed with, so it can be released.
+        # The action is left out: a stop that fails inline is routed as a lock, and its release must still find the stop's claim
+        self.decision_keys = TTLCache('dedup_decision_keys', max_size, ttl_seconds, enabled)
+        self.table = DynamoDbDedupTable(table_name, DEFAULT_REGION) if table_name else None
+
+    def claim(self, key):
+        '''Returns True if the key was claimed by this call, False if it is a duplicate'''
+        if not self.enabled:
+            return True
+        if not self.memory.add(key, True):
+            return False
+        if self.table is not None and not self.table.claim(key, self.ttl_seconds):
+            return False
+        return True
+
+    def release(self, key):
+        '''Drops a claim, so the key is handled again when it is redelivered'''
+        if not self.enabled:
+            return
+        self.memory.delete(key)
+        if self.table is not None:
+            self.table.release(key)
+
+    def claim_decision(self, decision, launch_time):
+        '''Claims a decision for this launch of the instance, returns False if it was already made'''
+        key = "decision:{0}:{1}:{2}:{3}".format(decision.region, decision.instance_id, launch_time, decision.action)
+        if not self.claim(key):
+            return False
+        self.decision_keys.set((decision.account_id, decision.region, decision.instance_id), key)
+        return True
+
+    def release_decision(self, decision):
+        '''Drops the claim on a decision that could not be routed, whatever its action was when it was claimed'''
+        decision_key = (decision.account_id, decision.region, decision.instance_id)
+        key = self.decision_keys.get(decision_key)
+        if key is not None:
+            self.decision_keys.delete(decision_key)
+            self.release(key)
+
+class SecurityGroupIndex:
+    '''Per account and region index of every security group to the policies it violates: the names of the forbidden exposures it opens,
+    and DEFAULT_GROUP_VIOLATION for default groups. A region is indexed by one paginated scan, then updated group by group
+    from the change events, so evaluating an instance is a lookup of its groups rather than a describe'''
+    def __init__(self, ttl_seconds, enabled=True):
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        # (account ID, region) -> (expiry, {security group ID: frozenset of violations})
+        self._regions = {}
+        # One lock per account and region, so a region is scanned once while the other regions are looked up
+        self._locks = {}
+        self.scans = 0
+
+    def _key(self, region):
+        # The index of the account whose groups an EC2 client sees in the current account context
+        return (client_account('ec2'), region)
+
+    def _current(self, key):
+        entry = self._regions.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def get(self, region):
+        '''Returns the index of a region, scanning the region when it isn't indexed or its index expired.
+        Returns None when the index is off or the scan failed'''
+        if not self.enabled:
+            return None
+        key = self._key(region)
+        index = self._current(key)
+        if index is not None:
+            return index
+        with self._locks.setdefault(key, threading.Lock()):
+            # Another thread may have scanned the region while we waited
+            index = self._current(key)
+            if index is not None:
+                return index
+            try:
+                index = scan_security_group_violations(region)
+            except ValueError as error:
+                log.warning("Unable to index the security groups of region: %s, error: %s", region, error)
+                return None
+            self.scans += 1
+            self._regions[key] = (time.monotonic() + self.ttl_seconds, index)
+            return index
+
+    def lookup(self, region, security_group_ids):
+        '''Returns the violations of the security groups keyed by ID, or None when the region can't be indexed.
+        Groups the index doesn't know yet (e.g. created since the scan) are described and added, groups that can't be described are left out'''
+        index = self.get(region)
+        if index is None:
+            return None
+        unknown = [sg_id for sg_id in dict.fromkeys(security_group_ids) if sg_id not in index]
+        if unknown:
+            self.update(region, get_security_group_snapshot(unknown, region).values())
+        return {sg_id: index[sg_id] for sg_id in security_group_ids if sg_id in index}
+
+    def update(self, region, security_groups):
+        '''Indexes described security groups of a region, returns the IDs of the groups that violate a policy they didn't violate before.
+        When the region isn't indexed, every violating group counts as new'''
+        grown = []
+        key = self._key(region)
+        with self._locks.setdefault(key, threading.Lock()):
+            entry = self._regions.get(key)
+            for security_group in security_groups:
+                violations = security_group_violations(security_group)
+                previous = entry[1].get(security_group['GroupId'], frozenset()) if entry is not None else frozenset()
+                if violations - previous:
+                    grown.append(security_group['GroupId'])
+                if entry is not None:
+                    entry[1][security_group['GroupId']] = violations
+        return grown
+
+    def remove(self, region, security_group_ids):
+        '''Drops security groups from the index of a region, they are described again if an instance still uses them'''
+        key = self._key(region)
+        with self._locks.setdefault(key, threading.Lock()):
+            entry = self._regions.get(key)
+            if entry is not None:
+                for sg_id in security_group_ids:
+                    entry[1].pop(sg_id, None)
+
+    def invalidate(self, region):
+        '''Drops the index of a region, it is scanned again on the next lookup'''
+        self._regions.pop(self._key(region), None)
+
+    def clear(self):
+        self._regions.clear()
+        self.scans = 0
+
+    def stats(self):
+        '''Returns the number of indexed regions and groups, and of scans'''
+        return {'name': 'security_group_index', 'regions': len(self._regions), 'size': sum(len(index) for _, index in self._regions.values()), 'scans': self.scans}
+
+# Keyed by account, region and security group ID
+_security_group_cache = TTLCache('security_groups', LOOKUP_CACHE_MAX_SIZE, LOOKUP_CACHE_TTL_SECONDS, LOOKUP_CACHE_ENABLED)
+# Keyed by account, region and instance ID, the ASG instance record for members and False for instances outside an ASG
+_asg_membership_cache = TTLCache('asg_membership', LOOKUP_CACHE_MAX_SIZE, LOOKUP_CACHE_TTL_SECONDS, LOOKUP_CACHE_ENABLED)
+# Keyed by security group ID, the rules list the group was compiled from and its CompiledSecurityGroup
+_compiled_group_cache = TTLCache('compiled_security_groups', LOOKUP_CACHE_MAX_SIZE, LOOKUP_CACHE_TTL_SECONDS, LOOKUP_CACHE_ENABLED)
+# Keyed by launch fingerprint, the verdict of instances launched from that configuration
+_decision_memo = TTLCache('decision_memo', LOOKUP_CACHE_MAX_SIZE, DECISION_MEMO_TTL_SECONDS, DECISION_MEMO_ENABLED)
+# Keyed by event (region, instance ID and event time) and by decision (region, instance ID, launch time and action)
+_dedup_store = DedupStore(DEDUP_TTL_SECONDS, DEDUP_MAX_SIZE, DEDUP_TABLE, DEDUP_ENABLED)
+# Keyed by account and region, the violations of every security group of the region
+_security_group_index = SecurityGroupIndex(SECURITY_GROUP_INDEX_TTL_SECONDS, SECURITY_GROUP_INDEX_ENABLED)
+
+def reset_lookup_caches():
+    '''Flushes the security group and ASG membership caches, the security group index, and the in-memory dedup claims'''
+    _security_group_cache.clear()
+    _security_group_index.clear()
+    _asg_membership_cache.clear()
+    _compiled_group_cache.clear()
+    _decision_memo.clear()
+    _dedup_store.memory.clear()
+    _dedup_store.decision_keys.clear()
+
+def log_lookup_cache_stats():
+    '''Logs the hit/miss counters of the lookup caches'''
+    log.info("Lookup cache stats: %s", [_security_group_cache.stats(), _asg_membership_cache.stats(), _compiled_group_cache.stats(), _decision_memo.stats(), _security_group_index.stats()])
+
 class SqsClient:
     '''Creates a SQS Client to handle API actions'''
     def __init__(self, region):
-        self.client = boto3.client('sqs', region_name=region)
+        self.client = get_client('sqs', region)
         self.region = region
    
     def get_queue_url(self, queue_name):
-        '''Gets the URL of the queue'''
+        '''Gets the URL of the queue, cached for the lifetime of the container'''
+        key = (self.region, queue_name)
+        if key in _queue_urls:
+            return _queue_urls[key]
         try:
-            response = self.client.get_queue_url(QueueName=queue_name)
-            log.debug("Got queue url: {0}".format(response))
+            response = call_aws('sqs', self.region, 'GetQueueUrl', self.client.get_queue_url, QueueName=queue_name)
+            log.debug("Got queue url: %s", Payload(response))
+            _queue_urls[key] = response['QueueUrl']
             return response['QueueUrl']
         except ClientError as error:
-            log.error("Unable to get queue URL for queue: {0}, error: {1}".format(queue_name, error))
+            log.error("Unable to get queue URL for queue: %s, error: %s", queue_name, error)
             return {}
 
     def send_message(self, queue_url, message):
         '''Sends a message to the queue'''
         try:
-            response = self.client.send_message(QueueUrl=queue_url, MessageBody=message)
-            log.debug("Sent message: {0}".format(response))
+            response = call_aws('sqs', self.region, 'SendMessage', self.client.send_message, QueueUrl=queue_url, MessageBody=message)
+            log.debug("Sent message: %s", Payload(response))
             return response
         except ClientError as error:
-            log.error("Unable to send message to queue: {0}, error: {1}".format(queue_url, error))
+            log.error("Unable to send message to queue: %s, error: %s", queue_url, error)
             return {}
 
+    def send_message_batch(self, queue_url, messages):
+        '''Sends a list of messages to the queue in batches of SQS_BATCH_SIZE,
+        returns the indexes of the messages that could not be sent'''
+        failed_indexes = []
+        for start in range(0, len(messages), SQS_BATCH_SIZE):
+            chunk = messages[start:start + SQS_BATCH_SIZE]
+            # Entry IDs are the message's index in the list, so failures map straight back to the caller's messages
+            entries = [{'Id': str(start + offset), 'MessageBody': message} for offset, message in enumerate(chunk)]
+            try:
+                response = call_aws('sqs', self.region, 'SendMessageBatch', self.client.send_message_batch, QueueUrl=queue_url, Entries=entries)
+                log.debug("Sent message batch: %s", Payload(response))
+            except ClientError as error:
+                log.error("Unable to send message batch to queue: %s, error: %s", queue_url, error)
+                failed_indexes.extend(range(start, start + len(chunk)))
+                continue
+            for failure in response.get('Failed', []):
+                log.error("Unable to send message to queue: %s, error: %s", queue_url, failure.get('Message', failure['Code']))
+                failed_indexes.append(int(failure['Id']))
+        return sorted(failed_indexes)
+
 class Ec2Client:
     '''Creates a EC2 client to handle API actions'''
     def __init__(self, region):
-        self.client = boto3.client('ec2', region_name=region)
+        self.client = get_client('ec2', region)
         self.region = region
 
-    def describe_instances(self, instance_ids):
-        '''Describes instances given a instance ids, returns a list of instances'''
+    def describe_instances(self, instance_ids, next_token=None):
+        '''Describes the running instances among the given instance ids, returns the response or an empty dict if the call failed.
+        Errors about invalid instance IDs are raised, so the caller can set the offending IDs aside'''
+        filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
         try:
-            response = self.client.describe_instances(InstanceIds=instance_ids)
-            log.debug("Describe instances response: {0}".format(response))
+            if next_token:
+                response = call_aws('ec2', self.region, 'DescribeInstances', self.client.describe_instances, InstanceIds=instance_ids, Filters=filters, NextToken=next_token)
+            else:
+                response = call_aws('ec2', self.region, 'DescribeInstances', self.client.describe_instances, InstanceIds=instance_ids, Filters=filters)
+            log.debug("Described %d reservations", len(response['Reservations']))
             return response
         except ClientError as error:
-            log.error("Unable to list instances, error: {0}".format(error))
+            if error.response['Error']['Code'].startswith('InvalidInstanceID'):
+                raise
+            log.error("Unable to list instances, error: %s", error)
+            return {}
+
+    def describe_instance_page(self, filters, max_results, next_token=None):
+        '''Describes one page of the instances matching the filters, returns the response or an empty dict if the call failed'''
+        try:
+            if next_token:
+                return call_aws('ec2', self.region, 'DescribeInstances', self.client.describe_instances, Filters=filters, MaxResults=max_results, NextToken=next_token)
+            return call_aws('ec2', self.region, 'DescribeInstances', self.client.describe_instances, Filters=filters, MaxResults=max_results)
+        except ClientError as error:
+            log.error("Unable to describe instance page in region: %s, error: %s", self.region, error)
             return {}
+
+    def describe_security_group_page(self, max_results, next_token=None):
+        '''Describes one page of the region's security groups, returns the response or an empty dict if the call failed'''
+        try:
+            if next_token:
+                return call_aws('ec2', self.region, 'DescribeSecurityGroups', self.client.describe_security_groups, MaxResults=max_results, NextToken=next_token)
+            return call_aws('ec2', self.region, 'DescribeSecurityGroups', self.client.describe_security_groups, MaxResults=max_results)
+        except ClientError as error:
+            log.error("Unable to describe security group page in region: %s, error: %s", self.region, error)
+            return {}
+
+    def describe_regions(self):
+        '''Returns the names of the regions enabled for the account, or an empty list if the call failed'''
+        try:
+            response = call_aws('ec2', self.region, 'DescribeRegions', self.client.describe_regions,
+                                Filters=[{'Name': 'opt-in-status', 'Values': ['opt-in-not-required', 'opted-in']}])
+            return [region['RegionName'] for region in response['Regions']]
+        except ClientError as error:
+            log.error("Unable to describe regions, error: %s", error)
+            return []
+
     def describe_security_groups(self, security_group_ids):
-        '''Describes security groups given a security group ids, returns a list of security groups'''
+        '''Describes security groups given a security group ids, returns a list of security groups.
+        Groups in the lookup cache are not described again'''
+        if isinstance(security_group_ids, str):
+            security_group_ids = [security_group_ids]
+        security_groups = []
+        missing_ids = []
+        for sg_id in security_group_ids:
+            security_group = _security_group_cache.get((current_account_id(), self.region, sg_id))
+            if security_group is None:
+                missing_ids.append(sg_id)
+            else:
+                security_groups.append(security_group)
+        if not missing_ids:
+            return {'SecurityGroups': security_groups}
         try:
-            response = self.client.describe_security_groups(GroupIds=security_group_ids)
-            log.debug("Describe security groups response: {0}".format(response))
-            return response
+            response = call_aws('ec2', self.region, 'DescribeSecurityGroups', self.client.describe_security_groups, GroupIds=missing_ids)
+            log.debug("Describe security groups response: %s", Payload(response))
         except ClientError as error:
-            log.error("Unable to list security groups, error: {0}".format(error))
+            log.error("Unable to list security groups, error: %s", error)
             return {}
+        for security_group in response['SecurityGroups']:
+            _security_group_cache.set((current_account_id(), self.region, security_group['GroupId']), security_group)
+        return {'SecurityGroups': security_groups + response['SecurityGroups']}
 
 class AutoscalerClient:
     '''Creates an Autoscaler client to handle API actions'''
     def __init__(self, region):
-        self.client = boto3.client('autoscaling', region_name=region)
+        self.client = get_client('autoscaling', region)
         self.region = region
 
     def describe_auto_scaling_instances(self, instance_ids):
-        '''Given a list of instance IDs, determine if they are part of an ASG'''
-        try:
-            response = self.client.describe_auto_scaling_instances(InstanceIds=instance_ids)
-            log.debug("Describe AutoScaling Response: {0}".format(response))
-            return response
-        except ClientError as error:
-            log.error("Unable to list auto scaling instances, error: {0}".format(error))
-            return {}
+        '''Given a list of instance IDs, determine if they are part of an ASG, following every result page.
+        Instances with a cached membership are not looked up again. Returns an empty dict if a lookup failed'''
+        cached_instances = []
+        missing_ids = []
+        for instance_id in instance_ids:
+            membership = _asg_membership_cache.get((current_account_id(), self.region, instance_id))
+            if membership is None:
+                missing_ids.append(instance_id)
+            elif membership:
+                cached_instances.append(membership)
+        if not missing_ids:
+            return {'AutoScalingInstances': cached_instances}
+        asg_instances = []
+        kwargs = {}
+        while True:
+            try:
+                # Every page is asked for the same instance IDs, only the token changes
+                response = call_aws('autoscaling', self.region, 'DescribeAutoScalingInstances', self.client.describe_auto_scaling_instances,
+                                    InstanceIds=missing_ids, MaxRecords=ASG_INSTANCE_CHUNK_SIZE, **kwargs)
+                log.debug("Describe AutoScaling Response: %s", Payload(response))
+            except ClientError as error:
+                log.error("Unable to list auto scaling instances, error: %s", error)
+                return {}
+            asg_instances.extend(response['AutoScalingInstances'])
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+        member_ids = set()
+        for asg_instance in asg_instances:
+            if 'InstanceId' in asg_instance:
+                member_ids.add(asg_instance['InstanceId'])
+                _asg_membership_cache.set((current_account_id(), self.region, asg_instance['InstanceId']), asg_instance)
+        # Once every page is read, the instances that no page listed are outside an ASG
+        if len(member_ids) == len(asg_instances):
+            for instance_id in missing_ids:
+                if instance_id not in member_ids:
+                    _asg_membership_cache.set((current_account_id(), self.region, instance_id), False)
+        return {'AutoScalingInstances': cached_instances + asg_instances}
 
 ### FUNCTIONS
 
 def route_instance_message(instancelist):
-    '''Routes messages to SQS Queue'''
-    log.info("Routing instance list {} to SQS queue...".format(instancelist))
+    '''Routes lists of decisions to the SQS queues in batches, returns the list of decisions that could not be routed'''
+    log.info("Routing %d instances to SQS queues...", sum(len(instancedict) for instancedict in instancelist))
+    log.debug("Instance list: %s", Payload(instancelist))
     sqs_client = SqsClient(DEFAULT_REGION)
     lock_queue_url = sqs_client.get_queue_url(LOCK_QUEUE_NAME)
     stop_queue_url = sqs_client.get_queue_url(STOP_QUEUE_NAME)
-    if lock_queue_url and stop_queue_url == False:
+    if not lock_queue_url or not stop_queue_url:
         raise ValueError("Unable to get queue URLs for lock and stop queues, aborting...")
+    # Group the decisions per destination queue
+    stop_decisions = []
+    lock_instances = []
     for instancedict in instancelist:
         for instance in instancedict:
-            # on success or failure, we continue to the next instance in the dict
-            message_body = json.dumps(instance)
-            log.debug("Sending message: {0}".format(message_body))
-            # For instances that are being stopped, we can safely fail to the lock queue
-            if instance['action'] == 'stop':
-                response = sqs_client.send_message(stop_queue_url, message_body)
-                if response:
-                    continue
-                log.warn("Unable to send message to stop queue, attempting lock...")
-                response = sqs_client.send_message(lock_queue_url, message_body)
-                continue
-            # For instances that are being locked, we have no failure options but the dead letter queue
-            if instance['action'] == 'lock':
-                response = sqs_client.send_message(lock_queue_url, message_body)
-                if response:
-                    continue
-                log.error("Unable to send message to lock queue, aborting...")
-                continue
+            if instance.action == 'stop':
+                stop_decisions.append(instance)
+            elif instance.action == 'lock':
+                lock_instances.append(instance)
             else:
-                raise ValueError("Unable to route instance message, unknown action: {0}".format(instance['action']))
+                raise ValueError("Unable to route instance message, unknown action: {0}".format(instance.action))
+    # For instances that are being stopped, we can safely fail to the lock queue
+    failed_indexes = sqs_client.send_message_batch(stop_queue_url, [instance.encode() for instance in stop_decisions])
+    if failed_indexes:
+        log.warning("Unable to send %d messages to stop queue, attempting lock...", len(failed_indexes))
+        lock_instances.extend(stop_decisions[index] for index in failed_indexes)
+    # For instances that are being locked, we have no failure options but the dead letter queue
+    failed_indexes = sqs_client.send_message_batch(lock_queue_url, [instance.encode() for instance in lock_instances])
+    unrouted_instances = [lock_instances[index] for index in failed_indexes]
+    for instance in unrouted_instances:
+        log.error("Unable to send message to lock queue for instance: %s", instance.instance_id)
+    return unrouted_instances
+
+def contain_inline(decisions, region):
+    '''Stops the instances of a region decided for stopping right away, instead of routing them through the stop queue.
+    Returns the decisions left to route: locks, stops above INLINE_STOP_MAX_INSTANCES, and failed stops turned into locks'''
+    stop_ids = [decision.instance_id for decision in decisions if decision.action == 'stop'][:INLINE_STOP_MAX_INSTANCES]
+    if not stop_ids:
+        return decisions
+    with metrics.stage('stop'):
+        failed_ids = set(stop_instances(stop_ids, region))
+    metrics.put('InlineStops', len(stop_ids) - len(failed_ids))
+    inline_ids = set(stop_ids)
+    remaining = []
+    for decision in decisions:
+        if decision.action != 'stop' or decision.instance_id not in inline_ids:
+            remaining.append(decision)
+        elif decision.instance_id in failed_ids:
+            # Same fallback as the stop lambda, an instance we can't stop gets locked
+            log.error("Error stopping instance %s inline, routing it to the lock queue", decision.instance_id, extra=log_fields(decision.instance_id))
+            remaining.append(decision.replace(action='lock'))
+        else:
+            log.info("Stopped instance %s inline", decision.instance_id, extra=log_fields(decision.instance_id))
+    return remaining
+
+def event_dedup_key(region, instance_id, event_time):
+    return "event:{0}:{1}:{2}".format(region, instance_id, event_time)
+
+def claim_decisions(decisions, launch_times):
+    '''Claims each decision for the launch of its instance, returns the decisions that weren't already made.
+    A reboot, or a redelivered event, makes the same decision for the same launch and is dropped here before it is routed'''
+    claimed = [decision for decision in decisions if _dedup_store.claim_decision(decision, launch_times.get(decision.instance_id))]
+    if len(claimed) < len(decisions):
+        log.info("Dropped %d duplicate decisions", len(decisions) - len(claimed))
+        metrics.put('DuplicateDecisions', len(decisions) - len(claimed))
+    return claimed
+
+def release_decisions(decisions):
+    '''Releases the claims of decisions that could not be routed, so their retry is evaluated again'''
+    for decision in decisions:
+        _dedup_store.release_decision(decision)
+
+def get_launch_times(response):
+    '''Returns the launch time of every instance in a describe_instances response, keyed by instance ID'''
+    return {i['InstanceId']: i.get('LaunchTime') for r in response['Reservations'] for i in r['Instances']}
 
 def stop_lock_instance(instance, flag, security_group_ids, vpc_id, region):
     '''Given an instance dict and its flag, evaluate whether to stop or lock'''
     # Check to see if the instance is part of an autoscaling group, if the response is empty, then it is not part of an ASG
     log.info("Analyzing instances for shutdown/lock...")
     autoscaler_client = AutoscalerClient(region)
-    try:
-        response = autoscaler_client.describe_auto_scaling_instances(instance_ids=[instance['InstanceId']])
-    except ClientError as error:
-        log.warn("Unable to look up instance in ASG, marking for locking. error: {0}".format(error))
-        return {'instance_id': instance['InstanceId'], 'action': 'lock', 'flag': flag, "security_group_ids": security_group_ids, "region": region}
+    response = autoscaler_client.describe_auto_scaling_instances(instance_ids=[instance['InstanceId']])
+    if 'AutoScalingInstances' not in response:
+        return decide_stop_lock(instance, flag, security_group_ids, vpc_id, region, None)
+    # We only asked about one instance, so any ASG record in the response means it is part of an ASG
+    asg_instance_ids = set([instance['InstanceId']]) if response['AutoScalingInstances'] != [] else set()
+    return decide_stop_lock(instance, flag, security_group_ids, vpc_id, region, asg_instance_ids)
+
+def decide_stop_lock(instance, flag, security_group_ids, vpc_id, region, asg_instance_ids):
+    '''Given an instance dict, its flag, and the set of instance IDs known to be in an ASG, returns its stop or lock Decision.
+    asg_instance_ids is None when the ASG lookup failed.'''
+    if asg_instance_ids is None:
+        log.warning("Unable to look up instance %s in ASG, marking for locking.", instance['InstanceId'], extra=log_fields(instance['InstanceId']))
+        action = 'lock'
     # If we have an EBS volume, are not a spot instance, and do not have an ASG attached, we can safely shutdown
-    if instance['RootDeviceType'] == 'ebs' and 'InstanceLifecycle' not in instance and response['AutoScalingInstances'] == []:
-        log.info("Instance {0} has an EBS volume, is not in an ASG, and is not a spot instance, mark for stopping.".format(instance['InstanceId']))
-        return {'instance_id': instance['InstanceId'], 'action': 'stop', 'flag': flag, "security_group_ids": security_group_ids, "vpc_id": vpc_id, "region": region}
+    elif instance['RootDeviceType'] == 'ebs' and 'InstanceLifecycle' not in instance and instance['InstanceId'] not in asg_instance_ids:
+        log.info("Instance %s has an EBS volume, is not in an ASG, and is not a spot instance, mark for stopping.", instance['InstanceId'], extra=log_fields(instance['InstanceId']))
+        action = 'stop'
     else:
-        log.info("Instance {0} does not have an EBS volume, or is part of an ASG, or is a spot instance, mark for locking.".format(instance['InstanceId']))
-        return {'instance_id': instance['InstanceId'], 'action': 'lock', 'flag': flag, "security_group_ids": security_group_ids, "vpc_id": vpc_id, "region": region}
+        log.info("Instance %s does not have an EBS volume, or is part of an ASG, or is a spot instance, mark for locking.", instance['InstanceId'], extra=log_fields(instance['InstanceId']))
+        action = 'lock'
+    # The stop and lock lambdas act on the instance in the account it was evaluated in
+    return Decision(instance['InstanceId'], action, flag, region, security_group_ids, vpc_id, current_account_id() or None)
+
+def get_auto_scaling_instance_ids(instance_ids, region):
+    '''Looks up ASG membership for a list of instance IDs in chunks, each chunk following its result pages.
+    Returns the set of instance IDs that belong to an ASG, or None if any lookup failed'''
+    autoscaler_client = AutoscalerClient(region)
+    asg_instance_ids = set()
+    for chunk in chunk_list(instance_ids, ASG_INSTANCE_CHUNK_SIZE):
+        response = autoscaler_client.describe_auto_scaling_instances(chunk)
+        if 'AutoScalingInstances' not in response:
+            return None
+        for asg_instance in response['AutoScalingInstances']:
+            asg_instance_ids.add(asg_instance['InstanceId'])
+    return asg_instance_ids
+
+def compile_security_group(security_group):
+    '''Returns the CompiledSecurityGroup of a described security group.
+    A group is compiled again only when it was described again, since cached groups return the same rules list'''
+    group_id = security_group.get('GroupId')
+    rules = security_group.get('IpPermissions')
+    if group_id is not None:
+        cached = _compiled_group_cache.get(group_id)
+        if cached is not None and cached[0] is rules:
+            return cached[1]
+    compiled = CompiledSecurityGroup(security_group)
+    if group_id is not None:
+        _compiled_group_cache.set(group_id, (rules, compiled))
+    return compiled
+
+# Takes as input a list of security groups and exposure policies, returns the names of the policies the groups violate
+def find_exposures(security_groups, policies=FORBIDDEN_EXPOSURES):
+    compiled_groups = [compile_security_group(sg) for sg in security_groups]
+    return [policy.name for policy in policies if any(group.is_open(policy.protocol, policy.port) for group in compiled_groups)]
 
-# Takes as input a dictionary of security groups, parses for rules, and returns True or False if SSH is open
+# Takes as input a dictionary of security groups, parses for rules, and returns True or False if SSH is open to the world over IPv4 or IPv6
 def has_ssh_open(security_groups):
-    for sg in security_groups:
-        for p in sg['IpPermissions']:
-            # We need to check if the SG Rule actually refers to an IP protocol vs a security group, otherwise we get a key error when evaluating
-            if 'FromPort' in p and 'ToPort' in p:
-                if ((p['FromPort'] == 22 or p['FromPort'] == -1) and (p['ToPort'] == 22 or p['ToPort'] == -1)) or (p['FromPort'] <= 22 <= p['ToPort']):
-                    if p['IpProtocol'] == 'tcp' and (p['IpRanges'][0]['CidrIp'] == '0.0.0.0/0' or p['IpRanges'][0]['CidrIp'] == '::/0'):
-                        return True
-    return False
+    return SSH_EXPOSURE.name in find_exposures(security_groups, (SSH_EXPOSURE,))
 
 # Takes as input a dictionary of security groups, parses for rules, and returns True or False if HTTP is open
 def has_default_security_group(security_groups):
@@ -152,14 +730,21 @@ def has_default_security_group(security_groups):
             return True
     return False
 
-#
 def check_security_groups(instance_id, security_group_ids, region):
+    '''Describes the security groups of a single instance and evaluates them'''
     log.info("Checking security groups...")
     ec2_client = Ec2Client(region)
     response = ec2_client.describe_security_groups(security_group_ids)
+    if 'SecurityGroups' not in response:
+        # Skipping the instance could leave an exposed instance running, fail so its records are retried
+        raise ValueError("Unable to describe security groups of instance: {0}".format(instance_id))
+    return evaluate_security_groups(instance_id, response['SecurityGroups'])
+
+def evaluate_security_groups(instance_id, security_groups):
+    '''Given an instance ID and its described security groups, returns a dict with the action and flag'''
     # Store the results of our security group analysis in vars so we don't need to re-run when evaluating truthiness
-    ssh_open = has_ssh_open(response['SecurityGroups'])
-    default_group = has_default_security_group(response['SecurityGroups'])
+    ssh_open = has_ssh_open(security_groups)
+    default_group = has_default_security_group(security_groups)
     if ssh_open and default_group:
         return {'instance_id': instance_id, 'action': 'analyze', 'flag': 'both'}
     if ssh_open:
@@ -168,14 +753,81 @@ def check_security_groups(instance_id, security_group_ids, region):
         return {'instance_id': instance_id, 'action': 'analyze', 'flag': 'default'}
     return {'instance_id': instance_id, 'action': 'skip', 'flag': 'no_bad_sgs'}
 
+def security_group_violations(security_group, compiled=None):
+    '''Returns the policies a described security group violates: the names of the forbidden exposures it opens,
+    and DEFAULT_GROUP_VIOLATION if it is a default group'''
+    compiled = compiled or compile_security_group(security_group)
+    violations = [policy.name for policy in FORBIDDEN_EXPOSURES if compiled.is_open(policy.protocol, policy.port)]
+    if security_group.get('GroupName') == 'default':
+        violations.append(DEFAULT_GROUP_VIOLATION)
+    return frozenset(violations)
+
+def evaluate_security_group_violations(instance_id, violations):
+    '''Given an instance ID and the violations of each of its security groups keyed by ID, returns a dict with the action and flag.
+    Flagged instances also get the IDs of the groups that have to be removed to lock them'''
+    ssh_open = any(SSH_EXPOSURE.name in group_violations for group_violations in violations.values())
+    default_group = any(DEFAULT_GROUP_VIOLATION in group_violations for group_violations in violations.values())
+    if not ssh_open and not default_group:
+        return {'instance_id': instance_id, 'action': 'skip', 'flag': 'no_bad_sgs'}
+    flag = 'both' if ssh_open and default_group else 'ssh' if ssh_open else 'default'
+    bad_group_ids = [sg_id for sg_id, group_violations in violations.items() if SSH_EXPOSURE.name in group_violations or DEFAULT_GROUP_VIOLATION in group_violations]
+    return {'instance_id': instance_id, 'action': 'analyze', 'flag': flag, 'bad_security_group_ids': bad_group_ids}
+
+def scan_security_group_violations(region):
+    '''Pages through every security group of a region, returns the violations of each keyed by group ID.
+    Only the violations are kept, each page is dropped once indexed. Raises ValueError if a page can't be described'''
+    ec2_client = Ec2Client(region)
+    index = {}
+    next_token = None
+    while True:
+        response = ec2_client.describe_security_group_page(SECURITY_GROUP_SCAN_PAGE_SIZE, next_token)
+        if 'SecurityGroups' not in response:
+            raise ValueError("Unable to describe the security groups of region: {0}".format(region))
+        for security_group in response['SecurityGroups']:
+            # Compiled outside the compiled group cache, the index keeps the result
+            index[security_group['GroupId']] = security_group_violations(security_group, CompiledSecurityGroup(security_group))
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+    log.info("Indexed %d security groups in region: %s", len(index), region)
+    metrics.put('SecurityGroupIndexScans', 1)
+    return index
+
+def get_security_group_violations(security_group_ids, region):
+    '''Returns the violations of the security groups keyed by ID, from the region's index,
+    or from a describe of the groups when the index is off or the region can't be indexed. Groups that can't be described are left out'''
+    violations = _security_group_index.lookup(region, security_group_ids)
+    if violations is None:
+        snapshot = get_security_group_snapshot(security_group_ids, region)
+        violations = {sg_id: security_group_violations(security_group) for sg_id, security_group in snapshot.items()}
+    return violations
+
+def get_security_group_snapshot(security_group_ids, region):
+    '''Describes the union of the given security group IDs in chunks,
+    returns a dict of security group ID to security group. Groups in a chunk that failed to describe are left out.'''
+    ec2_client = Ec2Client(region)
+    snapshot = {}
+    for chunk in chunk_list(sorted(set(security_group_ids)), SECURITY_GROUP_CHUNK_SIZE):
+        response = ec2_client.describe_security_groups(chunk)
+        if 'SecurityGroups' not in response:
+            log.warning("Unable to describe security group chunk in region: %s, falling back to per instance lookups", region)
+            continue
+        for sg in response['SecurityGroups']:
+            snapshot[sg['GroupId']] = sg
+    return snapshot
+
+def chunk_list(items, size):
+    '''Splits a list into consecutive lists of at most size items'''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 # Takes as input an instance dictionary, parses for tags, and returns a dictionary with the instance ID and the action to take
 def check_tags(instance):
     instancedict = {}
     if 'Tags' in instance:
-        log.debug("instance: {0}" .format(instance))
+        log.debug("instance: %s", Payload(instance), extra=log_fields(instance['InstanceId']))
         for t in instance['Tags']:
-            log.debug("tag: {0}" .format(t))
-            if t['Key'] == 'shutdown_service_excluded' and t['Value'] == 'True':
+            log.debug("tag: %s", t)
+            if t['Key'] == EXCLUSION_TAG_KEY and t['Value'] == 'True':
                 instancedict = {'instance_id': instance['InstanceId'], 'action': 'skip', 'flag': 'excluded'}
                 return instancedict
             else:
@@ -183,80 +835,537 @@ def check_tags(instance):
     instancedict = {'instance_id': instance['InstanceId'], 'action': 'analyze', 'flag': 'no_exclusion_tags'}
     return instancedict                                            
 
-# Accepts a dictionary containing instance details, returns a list of dicts with the instance ID, action, and flag
+def launch_fingerprint(instance, region):
+    '''Returns the inputs of an instance's verdict: its account and region, security groups, root device, lifecycle, ASG and exclusion tag.
+    Instances an ASG or a launch template brings up together share a fingerprint'''
+    tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+    return (current_account_id(), region, tuple(sorted(sg['GroupId'] for sg in instance['SecurityGroups'])), instance.get('RootDeviceType'),
+            instance.get('InstanceLifecycle'), tags.get(ASG_NAME_TAG_KEY), tags.get(EXCLUSION_TAG_KEY) == 'True')
+
+def get_verdicts(representatives, region):
+    '''Evaluates one instance per fingerprint, returns a dict of fingerprint to verdict:
+    ('skip', 'excluded', None), ('skip', 'no_bad_sgs', None) or ('flagged', flag, bad security group IDs).
+    The bad security group IDs are None when the groups were checked one instance at a time'''
+    verdicts = {}
+    candidates = []
+    for fingerprint, (i, security_group_ids) in representatives.items():
+        # CHECK TAGS
+        log.info("Checking tags...", extra=log_fields(i['InstanceId'], sampled=True))
+        instance_tag_dict = check_tags(i)
+        log.debug("Instance tag dict: %s", instance_tag_dict)
+        if instance_tag_dict['action'] == 'skip':
+            verdicts[fingerprint] = ('skip', 'excluded', None)
+            continue
+        candidates.append((fingerprint, i, security_group_ids))
+    if not candidates:
+        return verdicts
+    # CHECK SECURITY GROUPS
+    log.info("Checking security groups...")
+    violations = get_security_group_violations([sg_id for _, _, sg_ids in candidates for sg_id in sg_ids], region)
+    for fingerprint, i, security_group_ids in candidates:
+        if all(sg_id in violations for sg_id in security_group_ids):
+            instance_sg_dict = evaluate_security_group_violations(i['InstanceId'], {sg_id: violations[sg_id] for sg_id in security_group_ids})
+        else:
+            instance_sg_dict = check_security_groups(i['InstanceId'], security_group_ids, region)
+        if instance_sg_dict['action'] == 'skip':
+            verdicts[fingerprint] = ('skip', 'no_bad_sgs', None)
+        else:
+            verdicts[fingerprint] = ('flagged', instance_sg_dict['flag'], instance_sg_dict.get('bad_security_group_ids'))
+    return verdicts
+
+# Accepts a dictionary containing instance details, returns the list of Decisions of the instances to stop or lock
+# The whole response is evaluated against one snapshot of its security groups and ASG memberships,
+# so a batch costs a handful of bulk lookups rather than two API calls per instance.
+# Only one instance per launch fingerprint is evaluated, its verdict is memoized and applied to the others
 def analyze_instances(response, region):
-    instancelist = []
+    running = []
+    verdicts = {}
+    representatives = {}
+    hits = 0
     for r in response['Reservations']:
         for i in r['Instances']:
-            log.info("Checking instance: {0}".format(i['InstanceId']))
+            log.info("Checking instance: %s", i['InstanceId'], extra=log_fields(i['InstanceId'], sampled=True))
             # If the instance is already stopped by some other cause, we don't need to try again.
-            if i['State']['Name'] == 'running':
-                # CHECK TAGS
-                log.info("Checking tags...")
-                instance_tag_dict = check_tags(i)
-                log.debug("Instance tag dict: {0}".format(instance_tag_dict))
-                if instance_tag_dict['action'] == 'skip':
-                    log.info("Skipping instance {0} due to exclusion tag...".format(i['InstanceId']))
-                    continue
-                # CHECK SECURITY GROUPS
-                security_group_ids = []
-                for sg in i['SecurityGroups']:
-                    security_group_ids.append(sg['GroupId'])
-                instance_sg_dict = check_security_groups(i['InstanceId'], security_group_ids, region)
-                if instance_sg_dict['action'] == 'skip':
-                    log.info("Skipping instance {0} due to no bad security groups...".format(i['InstanceId']))
+            if i['State']['Name'] != 'running':
+                continue
+            security_group_ids = [sg['GroupId'] for sg in i['SecurityGroups']]
+            fingerprint = launch_fingerprint(i, region)
+            running.append((i, fingerprint, security_group_ids))
+            if fingerprint not in verdicts and fingerprint not in representatives:
+                verdict = _decision_memo.get(fingerprint)
+                if verdict is None:
+                    representatives[fingerprint] = (i, security_group_ids)
                     continue
-                else:
-                    # ANALYZE FLAGGED INSTANCES
-                    # stop_lock_instance returns a dict with the instance ID, action (stop/lock), flag (ssh/default/both), region
-                    # security_group_ids and vpc_id are only used if we're locking an instance
-                    vpc_id = i['VpcId']
-                    instancelist.append(stop_lock_instance(i, instance_sg_dict['flag'], security_group_ids, vpc_id, region))
-    return instancelist           
+                verdicts[fingerprint] = verdict
+            hits += 1
+    if not running:
+        return []
+    for fingerprint, verdict in get_verdicts(representatives, region).items():
+        _decision_memo.set(fingerprint, verdict)
+        verdicts[fingerprint] = verdict
+    log.info("Decision memo: %d hits, %d misses", hits, len(representatives))
+    metrics.put('DecisionMemoHits', hits)
+    metrics.put('DecisionMemoMisses', len(representatives))
+    flagged = []
+    for i, fingerprint, security_group_ids in running:
+        verdict, flag, bad_group_ids = verdicts[fingerprint]
+        if verdict == 'skip':
+            if flag == 'excluded':
+                log.info("Skipping instance %s due to exclusion tag...", i['InstanceId'], extra=log_fields(i['InstanceId'], sampled=True))
+            else:
+                log.info("Skipping instance %s due to no bad security groups...", i['InstanceId'], extra=log_fields(i['InstanceId'], sampled=True))
+            continue
+        flagged.append((i, flag, security_group_ids, bad_group_ids))
+    if not flagged:
+        return []
+    # ANALYZE FLAGGED INSTANCES
+    # decide_stop_lock returns a Decision with the instance ID, action (stop/lock), flag (ssh/default/both), region
+    # security_group_ids and vpc_id are only used if we're locking an instance
+    log.info("Analyzing instances for shutdown/lock...")
+    # ASG membership only matters to instances that could be stopped, the others are locked either way
+    stoppable_ids = [i['InstanceId'] for i, _, _, _ in flagged if i['RootDeviceType'] == 'ebs' and 'InstanceLifecycle' not in i]
+    asg_instance_ids = get_auto_scaling_instance_ids(stoppable_ids, region)
+    instancelist = []
+    for i, flag, security_group_ids, bad_group_ids in flagged:
+        decision = decide_stop_lock(i, flag, security_group_ids, i['VpcId'], region, asg_instance_ids)
+        if bad_group_ids is not None:
+            # The lock lambda removes these groups without describing them again
+            decision.bad_security_group_ids = list(bad_group_ids)
+        instancelist.append(decision)
+    return instancelist
 
 
 # Accepts a list of instance IDs, queries the AWS API for instance details, and returns a dictionary of the results
+# The IDs are described in chunks, following NextToken. A chunk rejected for an invalid instance ID (e.g. terminated and gone)
+# is bisected, so only the invalid IDs are skipped. Raises ValueError if the instances can't be described for any other reason
 def list_instances(instance_ids, region):
-    log.info("Listing instances in region: " + region)
+    log.info("Listing instances in region: %s", region)
     ec2_client = Ec2Client(region)
+    instances = []
+    for chunk in chunk_list(list(dict.fromkeys(instance_ids)), INSTANCE_ID_CHUNK_SIZE):
+        instances.extend(describe_instance_chunk(ec2_client, chunk))
+    return {'Reservations': [{'Instances': instances}]}
+
+def describe_instance_chunk(ec2_client, instance_ids):
+    '''Describes a chunk of instance IDs following NextToken, returns the trimmed instances.
+    IDs rejected as invalid are bisected out of the chunk and skipped'''
+    instances = []
+    next_token = None
     try:
-        response = ec2_client.describe_instances(instance_ids)
+        while True:
+            response = ec2_client.describe_instances(instance_ids, next_token)
+            if 'Reservations' not in response:
+                raise ValueError("Unable to look up instance IDs in region: {0}".format(ec2_client.region))
+            instances.extend(trim_instances(response))
+            next_token = response.get('NextToken')
+            if not next_token:
+                return instances
     except ClientError as error:
-        # TODO: If we fail to lookup all instance IDs, try one instance at a time and skip the problematic instance
-        log.warn("Unable to look up instance IDs in region: {0}, continuing with next region. error: {1}".format(region, error))
-    return response
+        if len(instance_ids) == 1:
+            log.warning("Skipping instance %s, error: %s", instance_ids[0], error.response['Error']['Code'], extra=log_fields(instance_ids[0]))
+            return []
+        middle = len(instance_ids) // 2
+        return describe_instance_chunk(ec2_client, instance_ids[:middle]) + describe_instance_chunk(ec2_client, instance_ids[middle:])
 
+def trim_instances(response):
+    '''Returns the instances of a describe_instances response, keeping only INSTANCE_FIELDS'''
+    return [{field: instance[field] for field in INSTANCE_FIELDS if field in instance}
+            for reservation in response['Reservations'] for instance in reservation['Instances']]
+
+def evaluate_region(region, instance_ids):
+    '''Describes and analyzes the instances of one region, returns its decisions and the launch time of each instance.
+    The decisions aren't claimed yet, see evaluate_regions'''
+    with log_context(region=region):
+        log.info("Checking instances in region: %s", region)
+        # Send the region, and the list of instance_ids associated with it to list_instances. Returns the response to the describe_instances API method
+        with metrics.stage('describe'):
+            describe_instances_response = list_instances(instance_ids, region)
+        log.debug("Described %d running instances", len(describe_instances_response['Reservations'][0]['Instances']))
+        # Analyze the instance details, and return the list of Decisions
+        with metrics.stage('evaluate'):
+            decisions = analyze_instances(describe_instances_response, region)
+        return decisions, get_launch_times(describe_instances_response)
+
+def settle_region(region, decisions, launch_times):
+    '''Claims the decisions of an evaluated region, returns the ones left to route.
+    With INLINE_CONTAINMENT set to "stop", the region's stops are made here and only the rest is returned'''
+    decisions = claim_decisions(decisions, launch_times)
+    if INLINE_CONTAINMENT == 'stop':
+        return contain_inline(decisions, region)
+    return decisions
+
+def interleave_accounts(locations):
+    '''Orders (account ID, region) pairs round robin across their accounts'''
+    account_locations = defaultdict(list)
+    for location in locations:
+        account_locations[location[0]].append(location)
+    return [location for batch in itertools.zip_longest(*account_locations.values()) for location in batch if location is not None]
+
+def run_locations(location_args, task, deadline):
+    '''Runs task(region, args) for every (account ID, region) location of location_args on a bounded thread pool, in the account's context.
+    At most ACCOUNT_MAX_CONCURRENCY regions of an account run at once. Returns the futures keyed by location, and the set of
+    futures done by the deadline, a time.monotonic() value. Tasks still running at the deadline are left to finish in the background'''
+    if not location_args:
+        return {}, set()
+    semaphores = {account_id: threading.BoundedSemaphore(ACCOUNT_MAX_CONCURRENCY) for account_id, _ in location_args}
+    def run(account_id, region, args):
+        with semaphores[account_id], account_context(account_id), log_context(region=region):
+            return task(region, args)
+    executor = ThreadPoolExecutor(max_workers=min(REGION_MAX_WORKERS, len(location_args)))
+    # Each region runs in a copy of the log context, so its records keep the request ID.
+    # The accounts are interleaved, so the pool starts on every account before a large one takes all its workers
+    futures = {location: executor.submit(contextvars.copy_context().run, profile_thread, run, location[0], location[1], location_args[location])
+               for location in interleave_accounts(list(location_args))}
+    done, _ = wait(futures.values(), timeout=max(0, deadline - time.monotonic()))
+    # Don't wait on slow regions, their threads are left to finish in the background
+    executor.shutdown(wait=False)
+    return futures, done
+
+def evaluate_regions(instance_map, deadline=None):
+    '''Evaluates every account and region of the instance map, keyed by (account ID, region), on a bounded thread pool.
+    The deadline defaults to REGION_TIMEOUT_SECONDS from now.
+    Returns the list of per region decision lists, in instance map order, and the list of locations that failed or timed out.
+    Decisions are only claimed here, on the handler thread, for the regions that finished in time. A timed out region's thread
+    is left running in the background, claims it made would make the retry of its records drop their decisions as duplicates'''
+    if deadline is None:
+        deadline = time.monotonic() + REGION_TIMEOUT_SECONDS
+    futures, done = run_locations(instance_map, evaluate_region, deadline)
+    settled = {}
+    failed_locations = []
+    for location in instance_map:
+        future = futures[location]
+        account_id, region = location
+        with log_context(account_id=account_id):
+            if future not in done:
+                future.cancel()
+                log.error("Timed out evaluating region: %s, reporting its records for retry", region)
+                failed_locations.append(location)
+                continue
+            try:
+                decisions, launch_times = future.result()
+                with account_context(account_id), log_context(region=region):
+                    settled[location] = claim_decisions(decisions, launch_times)
+            except Exception as error:
+                log.error("Unable to evaluate region: %s, reporting its records for retry. error: %s", region, error)
+                failed_locations.append(location)
+    if INLINE_CONTAINMENT == 'stop':
+        settled = contain_locations(settled, deadline)
+    return list(settled.values()), failed_locations
+
+def contain_locations(location_decisions, deadline):
+    '''Makes the inline stops of every location on the region thread pool, within the same deadline as the evaluation.
+    Returns the decisions left to route per location. A location whose stops didn't finish in time, or failed, keeps all its decisions
+    so its stops go through the stop queue. An instance its background thread stops as well is stopped twice, which is harmless'''
+    futures, done = run_locations({location: decisions for location, decisions in location_decisions.items() if decisions},
+                                  lambda region, decisions: contain_inline(decisions, region), deadline)
+    remaining = {}
+    for location, decisions in location_decisions.items():
+        future = futures.get(location)
+        remaining[location] = decisions
+        if future is None:
+            continue
+        with log_context(account_id=location[0], region=location[1]):
+            if future not in done:
+                future.cancel()
+                log.warning("Timed out stopping instances inline in region: %s, routing them to the stop queue", location[1])
+                continue
+            try:
+                remaining[location] = future.result()
+            except Exception as error:
+                log.error("Unable to stop instances inline in region: %s, routing them to the stop queue. error: %s", location[1], error)
+    return remaining
+
+def batch_response(message, failed_message_ids):
+    '''Builds the handler response. Failed message IDs are reported as batchItemFailures so SQS only retries those records'''
+    return {
+        'statusCode': 200,
+        'body': json.dumps(message),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_message_ids)]
+    }
+
+@flush_metrics
+@bind_request_id
+@profile_invocations
 def lambda_handler(event, context):
-    # Process event input and transform it into a dict of regions and instance IDs
+    '''Evaluates every record in the SQS batch, returns the records that should be retried as batchItemFailures'''
+    # Process event input and transform it into a dict of (account ID, region) locations and instance IDs.
+    # The account ID is None for records that don't carry one, they are in the lambda's own account
     instance_map = defaultdict(list)
-    instance_event_list = []
-    for record in event['Records']:
-        log.debug("Received Event Record Body {0}".format(record['body']))
-        instance_event_dict = json.loads(record['body'])
-        instance_event_list.append(instance_event_dict)
-    # Transform the event dict into a dict of regions and instance IDs
-    # Relies on defaultdict creating the key for region if it doesn't exist
-    # and appending all instance IDs that match as a list to that key.
-    for dict in instance_event_list:
-        instance_map[dict['region']].append(dict['instance_id'])
-    # Begin the analysis
-    # We need to store the list here, since each region will have a different list of instances
-    instance_list = []
-    for region in instance_map:
-        log.info("Checking instances in region: " + region)
-        # Send the region, and the list of instance_ids associated with it to list_instances. Returns the response to the describe_instances API method
-        describe_instances_response = list_instances(instance_map[region], region)
-        log.debug("Instance response: {0}".format(describe_instances_response))
-        # Analyze the instance details, and return a list of dicts with the instance ID, action, and flag which we append to our instance_list
-        instance_list.append(analyze_instances(describe_instances_response, region))
-        log.debug("Instance list: {0}".format(instance_list))
-    if len(instance_list[0]) == 0:
-        log.info("No instances to route, exiting.")
-        return
-    else:
-        route_instance_message(instance_list)
-        log.info("Finished processing instances!")
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Instances processed successfully!')
-        }
+    # Message IDs per location and instance ID, so failed records can be reported back to SQS for retry
+    message_map = defaultdict(lambda: defaultdict(list))
+    failed_message_ids = []
+    # Dedup keys of the claimed events per location and instance ID, released if their records are retried
+    event_keys = defaultdict(lambda: defaultdict(list))
+    duplicates = 0
+    # Security group change events per location, with their message IDs
+    security_group_events = defaultdict(list)
+    metrics.put('Records', len(event['Records']))
+    with metrics.stage('parse'):
+        for record in event['Records']:
+            log.debug("Received Event Record Body %s", record['body'])
+            try:
+                instance_event_dict = json.loads(record['body'])
+                region = instance_event_dict['region']
+                location = (instance_event_dict.get('account_id') or None, region)
+                if 'security_group_event' in instance_event_dict:
+                    security_group_events[location].append((record['messageId'], parse_security_group_event(instance_event_dict)))
+                    continue
+                instance_id = instance_event_dict['instance_id']
+            except (ValueError, KeyError, TypeError) as error:
+                log.error("Unable to parse record: %s, error: %s", record['messageId'], error)
+                failed_message_ids.append(record['messageId'])
+                continue
+            # A redelivered event has the same time, it is dropped before any instance lookup
+            if instance_event_dict.get('time'):
+                key = event_dedup_key(region, instance_id, instance_event_dict['time'])
+                if not _dedup_store.claim(key):
+                    log.info("Skipping duplicate event for instance %s at %s", instance_id, instance_event_dict['time'], extra=log_fields(instance_id, sampled=True))
+                    duplicates += 1
+                    continue
+                event_keys[location][instance_id].append(key)
+            # Relies on defaultdict creating the key for location if it doesn't exist
+            # and appending all instance IDs that match as a list to that key.
+            instance_map[location].append(instance_id)
+            message_map[location][instance_id].append(record['messageId'])
+    metrics.put('DuplicateRecords', duplicates)
+    # Everything after the parsing shares one deadline, so the batch is answered before the lambda times out
+    deadline = time.monotonic() + REGION_TIMEOUT_SECONDS
+    # The index is updated before the instances of the batch are evaluated against it
+    if security_group_events:
+        with metrics.stage('security_groups'):
+            failed_message_ids.extend(handle_security_group_events(security_group_events, deadline))
+    # Begin the analysis, each account and region is evaluated concurrently and returns its own list of instances
+    instance_list, failed_locations = evaluate_regions(instance_map, deadline)
+    log.debug("Instance list: %s", Payload(instance_list))
+    for location in failed_locations:
+        for message_ids in message_map[location].values():
+            failed_message_ids.extend(message_ids)
+        for keys in event_keys[location].values():
+            for key in keys:
+                _dedup_store.release(key)
+    if not any(instance_list):
+        log.info("No instances to route.")
+        log_lookup_cache_stats()
+        return batch_response('Instances processed successfully!', failed_message_ids)
+    try:
+        with metrics.stage('route'):
+            unrouted_instances = route_instance_message(instance_list)
+    except ValueError as error:
+        log.error("Unable to route instances, reporting them for retry. error: %s", error)
+        unrouted_instances = [instance for instances in instance_list for instance in instances]
+    for instance in unrouted_instances:
+        location = (instance.account_id, instance.region)
+        failed_message_ids.extend(message_map[location][instance.instance_id])
+        for key in event_keys[location][instance.instance_id]:
+            _dedup_store.release(key)
+    release_decisions(unrouted_instances)
+    metrics.put('FailedRecords', len(set(failed_message_ids)))
+    log.info("Finished processing instances!")
+    log_lookup_cache_stats()
+    return batch_response('Instances processed successfully!', failed_message_ids)
+
+### SWEEP
+# The sweep reconciles the whole fleet, so instances whose state change event was lost are still contained.
+# It runs on a schedule, with the same evaluation and routing as lambda_handler.
+
+def iter_running_instance_pages(region, next_token=None, security_group_ids=None):
+    '''Pages through the running instances of a region, or of its instances in any of the security groups,
+    yields each describe_instances page with the token of the next page.
+    Only one page is held in memory at a time. Raises ValueError if a page can't be described'''
+    ec2_client = Ec2Client(region)
+    filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
+    if security_group_ids:
+        filters.append({'Name': 'instance.group-id', 'Values': list(security_group_ids)})
+    while True:
+        with metrics.stage('describe'):
+            response = ec2_client.describe_instance_page(filters, SWEEP_PAGE_SIZE, next_token)
+        if 'Reservations' not in response:
+            raise ValueError("Unable to describe running instances in region: {0}".format(region))
+        next_token = response.get('NextToken')
+        yield {'Reservations': [{'Instances': trim_instances(response)}]}, next_token
+        if not next_token:
+            return
+
+def sweep_page(response, region):
+    '''Evaluates one page of instances and routes its decisions, returns the number of decisions and of decisions that could not be routed'''
+    with metrics.stage('evaluate'):
+        decisions = analyze_instances(response, region)
+    # Instances an event was just handled for are left to it
+    decisions = settle_region(region, decisions, get_launch_times(response))
+    if not decisions:
+        return 0, 0
+    try:
+        with metrics.stage('route'):
+            unrouted = route_instance_message([decisions])
+    except ValueError as error:
+        log.error("Unable to route sweep decisions in region: %s, error: %s", region, error)
+        unrouted = decisions
+    release_decisions(unrouted)
+    # Unrouted instances are found again by the next sweep
+    return len(decisions), len(unrouted)
+
+def continue_sweep(checkpoint, context):
+    '''Invokes this function asynchronously to continue the sweep from the checkpoint, returns True if the invocation was accepted'''
+    try:
+        call_aws('lambda', DEFAULT_REGION, 'Invoke', get_client('lambda', DEFAULT_REGION).invoke,
+                 FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=json.dumps(checkpoint))
+        return True
+    except ClientError as error:
+        log.error("Unable to continue sweep from checkpoint: %s, error: %s", checkpoint, error)
+        return False
+
+def checkpoint_sweep(accounts, regions, next_token, stats, continuation, context):
+    '''Saves the sweep position and continues it in a new invocation, returns the sweep response.
+    regions are the regions left in the first of the accounts, the accounts after it are swept in full'''
+    checkpoint = {'accounts': accounts, 'regions': regions, 'next_token': next_token, 'stats': stats, 'continuation': continuation + 1}
+    if continuation + 1 > SWEEP_MAX_CONTINUATIONS:
+        # Invoke the function with the checkpoint as its event to resume
+        log.error("Sweep reached %d continuations, stopping at checkpoint: %s", SWEEP_MAX_CONTINUATIONS, json.dumps(checkpoint))
+        return sweep_response(stats, 'stopped')
+    if not continue_sweep(checkpoint, context):
+        log.error("Sweep stopped at checkpoint: %s", json.dumps(checkpoint))
+        return sweep_response(stats, 'stopped')
+    log.info("Sweep ran out of time in region: %s, continuing in a new invocation", regions[0] if regions else None)
+    return sweep_response(stats, 'continued')
+
+def sweep_response(stats, status):
+    return {
+        'statusCode': 200,
+        'body': json.dumps(dict(stats, status=status))
+    }
+
+@flush_metrics
+@bind_request_id
+@profile_invocations
+def sweep_handler(event, context):
+    '''Pages through every running instance of every region of every account, and routes the ones in violation to the stop and lock queues.
+    The event is empty for a scheduled sweep, or a checkpoint with the accounts left, the regions left in the first one,
+    the page token of the first region, and the sweep's running totals when a previous invocation ran out of time'''
+    event = event if isinstance(event, dict) else {}
+    accounts = event.get('accounts') or SWEEP_ACCOUNTS or [None]
+    regions = event.get('regions')
+    next_token = event.get('next_token')
+    stats = event.get('stats') or {'instances': 0, 'decisions': 0, 'unrouted': 0, 'failed_regions': []}
+    continuation = event.get('continuation', 0)
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SWEEP_TIME_RESERVE_SECONDS
+    for account_index, account_id in enumerate(accounts):
+        with account_context(account_id):
+            try:
+                regions = regions or SWEEP_REGIONS or Ec2Client(DEFAULT_REGION).describe_regions()
+            except ValueError as error:
+                # The account's role couldn't be assumed
+                log.error("Unable to sweep account: %s, error: %s", account_id, error)
+                stats['failed_regions'].append(account_id)
+                regions = []
+            log.info("Sweeping regions: %s, continuation: %s", regions, continuation)
+            for index, region in enumerate(regions):
+                try:
+                    with log_context(region=region):
+                        for response, page_token in iter_running_instance_pages(region, next_token):
+                            stats['instances'] += sum(len(reservation['Instances']) for reservation in response['Reservations'])
+                            decisions, unrouted = sweep_page(response, region)
+                            stats['decisions'] += decisions
+                            stats['unrouted'] += unrouted
+                            if page_token and deadline is not None and time.monotonic() > deadline:
+                                return checkpoint_sweep(accounts[account_index:], regions[index:], page_token, stats, continuation, context)
+                except ValueError as error:
+                    log.error("Unable to sweep region: %s, error: %s", region, error)
+                    stats['failed_regions'].append(region if account_id is None else "{0}:{1}".format(account_id, region))
+                next_token = None
+                if deadline is not None and time.monotonic() > deadline:
+                    if index + 1 < len(regions):
+                        return checkpoint_sweep(accounts[account_index:], regions[index + 1:], None, stats, continuation, context)
+                    if account_index + 1 < len(accounts):
+                        return checkpoint_sweep(accounts[account_index + 1:], None, None, stats, continuation, context)
+        regions = None
+    log.info("Sweep finished: %s", stats)
+    return sweep_response(stats, 'finished')
+
+### SECURITY GROUP EVENTS
+# Security group changes recorded by CloudTrail reach lambda_handler through the same queue as the instance events.
+# They keep the security group index current, and a group that starts violating a policy has its running instances evaluated right away
+
+def parse_security_group_event(event_dict):
+    '''Returns the event name and security group ID of a security group change message, the ID is None if the event didn't name one.
+    Raises ValueError for an event that isn't a security group change'''
+    event_name = event_dict['security_group_event']
+    if event_name not in SECURITY_GROUP_EVENTS:
+        raise ValueError("Unknown security group event: {0}".format(event_name))
+    # CreateSecurityGroup returns the new group's ID, the other events are made on an existing group
+    return event_name, event_dict.get('security_group_id') or event_dict.get('created_security_group_id') or None
+
+def apply_security_group_events(events, region):
+    '''Applies a region's security group change events to its index, returns the IDs of the groups that started violating a policy'''
+    # Verdicts and described groups made before the change may no longer hold
+    _decision_memo.clear()
+    deleted = set()
+    changed = []
+    for event_name, group_id in events:
+        if group_id is None:
+            # e.g. a rule added by group name, the whole region is scanned again instead
+            log.warning("Security group event %s names no group ID, reindexing region: %s", event_name, region)
+            _security_group_index.invalidate(region)
+            continue
+        _security_group_cache.delete((current_account_id(), region, group_id))
+        if event_name == 'DeleteSecurityGroup':
+            deleted.add(group_id)
+        else:
+            changed.append(group_id)
+    _security_group_index.remove(region, deleted)
+    changed = [group_id for group_id in dict.fromkeys(changed) if group_id not in deleted]
+    if not changed:
+        return []
+    snapshot = get_security_group_snapshot(changed, region)
+    # A group that can't be described (e.g. deleted since) leaves the index, it is described again if an instance uses it
+    _security_group_index.remove(region, [group_id for group_id in changed if group_id not in snapshot])
+    return _security_group_index.update(region, snapshot.values())
+
+def evaluate_security_group_instances(security_group_ids, region):
+    '''Evaluates the running instances in any of the security groups and routes their decisions,
+    returns the number of decisions that could not be routed. Raises ValueError if the instances can't be described'''
+    unrouted = 0
+    for chunk in chunk_list(sorted(security_group_ids), SECURITY_GROUP_CHUNK_SIZE):
+        for response, _ in iter_running_instance_pages(region, security_group_ids=chunk):
+            unrouted += sweep_page(response, region)[1]
+    return unrouted
+
+def handle_region_security_group_events(region, events):
+    '''Applies the security group change events of one region, then evaluates the running instances of every group that started
+    violating a policy. Returns the number of decisions that could not be routed. Raises ValueError if the instances can't be described'''
+    group_ids = apply_security_group_events(events, region)
+    if group_ids:
+        log.info("Security groups started violating a policy in region %s: %s", region, group_ids)
+    return evaluate_security_group_instances(group_ids, region)
+
+def handle_security_group_events(region_events, deadline=None):
+    '''Handles security group change events, keyed by (account ID, region), on the region thread pool.
+    The deadline defaults to REGION_TIMEOUT_SECONDS from now. Returns the message IDs of the events of the regions that failed,
+    timed out, or left decisions unrouted, so they are retried'''
+    if deadline is None:
+        deadline = time.monotonic() + REGION_TIMEOUT_SECONDS
+    metrics.put('SecurityGroupEvents', sum(len(events) for events in region_events.values()))
+    futures, done = run_locations({location: [event for _, event in events] for location, events in region_events.items()},
+                                  handle_region_security_group_events, deadline)
+    failed_message_ids = []
+    for location, events in region_events.items():
+        future = futures[location]
+        with log_context(account_id=location[0], region=location[1]):
+            if future not in done:
+                future.cancel()
+                log.error("Timed out handling security group events in region: %s, reporting them for retry", location[1])
+                unrouted = len(events)
+            else:
+                try:
+                    unrouted = future.result()
+                except Exception as error:
+                    log.error("Unable to handle security group events in region: %s, error: %s", location[1], error)
+                    unrouted = len(events)
+            if unrouted:
+                failed_message_ids.extend(message_id for message_id, _ in events)
+    return failed_message_ids
+
+# Runs during the lambda init phase, before the first event is handled
+if STARTUP_MODE == "prewarm":
+    prewarm_clients(PREWARM_SERVICES)
@@ -1,188 +1,307 @@
+import contextvars
 import json
-import logging
-import boto3
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+import shutdown_common
+from shutdown_common import (STARTUP_MODE, Decision, Payload, account_context, bind_request_id, call_aws, flush_metrics,
+                             get_client, get_logger, log_context, log_fields, metrics, prewarm_clients, profile_invocations,
+                             profile_thread, world_open_ip_versions)
 
-logging.basicConfig(level=logging.INFO)
+PREWARM_SERVICES = ('ec2',)
+# Number of instances of a batch that are locked in parallel
+LOCK_MAX_WORKERS = int(os.environ.get("LOCK_MAX_WORKERS", "10"))
+# Security groups are described by ID in chunks to stay within the API request limits
+SECURITY_GROUP_CHUNK_SIZE = 200
+LOCK_FLAGS = ('ssh', 'default', 'both')
+# Locked instances share one quarantine security group per VPC, its ID is cached for the TTL
+QUARANTINE_GROUP_NAME = "shutdown_service_quarantine"
+QUARANTINE_TAG_KEY = "shutdown_service_quarantine_group"
+QUARANTINE_CACHE_TTL_SECONDS = int(os.environ.get("QUARANTINE_CACHE_TTL_SECONDS", "900"))
+# Decision fields a lock needs besides the ones every decision has
+REQUIRED_FIELDS = ('flag', 'vpc_id')
 
-log = logging.getLogger("ec2_lock_logger")
-log.setLevel(logging.INFO)
+log = get_logger("ec2_lock_logger")
 
-# Receives a dict with the following keys:
-# {
-#  'instance_id': 'i-0c8f8f8f8f8f8f8f8',
-#  'action': 'lock',
-#  'security_group_ids': ['sg-0c8f8f8f8f8f8f8f8', 'sg-0c8f8f8f8f8f8f8f8'],
-#  'vpc_id': 'vpc-0c8f8f8f8f8f8f8f8',
-#  'region': 'us-east-1'
-#  'flag': 'ssh | default | both'
-#}
+### CLIENT REGISTRY
+# Quarantine group IDs keyed by region and VPC ID, with the time they expire
+_quarantine_groups = {}
+# One lock per region and VPC, so concurrent lock requests create a VPC's quarantine group at most once
+_quarantine_locks = {}
 
+def reset_clients():
+    '''Drops every cached client, quarantine group and assumed role so the next lookup builds a new one. Tests call this so a patched boto3.client is picked up'''
+    shutdown_common.reset_clients()
+    _quarantine_groups.clear()
+
+### CLASSES
 class Ec2Client:
     '''Instantiates a new EC2 client for making API calls'''
     def __init__(self, region):
-        self.client = boto3.client('ec2', region_name=region)
+        self.client = get_client('ec2', region)
         self.region = region
 
     def get_security_group_ids(self, filter):
         '''Accepts as input the filter to use in the describe_security_groups call'''
         try:
-            log.info("Getting security groups, filter: {0}".format(filter))
-            response = self.client.describe_security_groups(Filters=filter)
-            log.debug("Describe security groups response: {}".format(response))
+            log.info("Getting security groups, filter: %s", filter)
+            response = call_aws('ec2', self.region, 'DescribeSecurityGroups', self.client.describe_security_groups, Filters=filter)
+            log.debug("Describe security groups response: %s", Payload(response))
             return response
         except ClientError as error:
             raise ValueError("Unable to describe security groups, error: {0}".format(error))
 
-    def create_dummy_security_group(self, instance_id, vpc_id):
-        '''Creates a dummy security group for the instance
+    def describe_security_groups(self, security_group_ids):
+        '''Accepts a list of security group IDs, returns the described security groups'''
+        try:
+            response = call_aws('ec2', self.region, 'DescribeSecurityGroups', self.client.describe_security_groups, GroupIds=security_group_ids)
+            log.debug("Describe security groups response: %s", Payload(response))
+            return response['SecurityGroups']
+        except ClientError as error:
+            raise ValueError("Unable to describe security groups, error: {0}".format(error))
+
+    def find_quarantine_security_group(self, vpc_id):
+        '''Looks up the quarantine security group of a VPC by its tag, returns its ID or None'''
+        response = self.get_security_group_ids(filter=[{'Name': 'vpc-id', 'Values': [vpc_id]}, {'Name': 'tag:' + QUARANTINE_TAG_KEY, 'Values': ['True']}])
+        if response['SecurityGroups']:
+            return response['SecurityGroups'][0]['GroupId']
+        return None
+
+    def create_quarantine_security_group(self, vpc_id):
+        '''Creates the quarantine security group of a VPC
         We want to remove access to the SSH and default SGs, but can't do so if
         they are the only security groups attached to the instance.
-        This method creates a security group which effectively does nothing,'''
+        This method creates a security group which effectively does nothing, and is shared by every locked instance in the VPC.
+        Its default egress rule is revoked, so the group gives a locked instance no outbound access either'''
         try:
-            log.info("Creating dummy security group for instance: {0}".format(instance_id))
-            response = self.client.create_security_group(
-                GroupName='dummy_security_group ' + instance_id,
-                Description='dummy security group for instance ' + instance_id,
+            log.info("Creating quarantine security group for VPC: %s", vpc_id)
+            response = call_aws(
+                'ec2', self.region, 'CreateSecurityGroup', self.client.create_security_group,
+                GroupName=QUARANTINE_GROUP_NAME,
+                Description='quarantine security group for instances locked by the shutdown service',
                 VpcId=vpc_id,
-                TagSpecifications=[{'ResourceType': 'security-group', 'Tags': [{'Key': 'shutdown_service_dummy_group', 'Value': 'True'}]}]
+                TagSpecifications=[{'ResourceType': 'security-group', 'Tags': [
+                    {'Key': QUARANTINE_TAG_KEY, 'Value': 'True'},
+                    {'Key': 'shutdown_service_dummy_group', 'Value': 'True'}
+                ]}]
             )
-            log.info("Created dummy security group: {0}".format(response))
-            return response['GroupId']
+            log.info("Created quarantine security group: %s", response['GroupId'])
+            group_id = response['GroupId']
         except ClientError as error:
-            if error.response['Error']['Code'] == 'InvalidGroup.Duplicate':
-                # TODO: Move this before the create_dummy_security_group call
-                dummy_response = self.get_security_group_ids(filter=[{'Name': 'group-name', 'Values': ['dummy_security_group ' + instance_id]}])
-                log.info("Found existing dummy security group: {0}, returning ID".format(dummy_response['SecurityGroups'][0]['GroupId']))
-                return dummy_response['SecurityGroups'][0]['GroupId']
-            log.error("Unable to create dummy security group, error: {0}".format(error))
-            raise ValueError("Unable to create dummy security group, error: {0}".format(error))
-
-    def authorize_rule_for_dummy_group(self, sg_id):
-        '''To create a security group that does nothing, create a rule which allows egress traffic to the new SG
-        This is similar behaviour to the VPC default SG, but since it's unique to the instance, we don't permit unnecessary access.'''
+            if error.response['Error']['Code'] != 'InvalidGroup.Duplicate':
+                log.error("Unable to create quarantine security group, error: %s", error)
+                raise ValueError("Unable to create quarantine security group, error: {0}".format(error))
+            # Another container created the group first, group names are unique per VPC so look it up by name
+            response = self.get_security_group_ids(filter=[{'Name': 'vpc-id', 'Values': [vpc_id]}, {'Name': 'group-name', 'Values': [QUARANTINE_GROUP_NAME]}])
+            log.info("Found existing quarantine security group: %s, returning ID", response['SecurityGroups'][0]['GroupId'])
+            group_id = response['SecurityGroups'][0]['GroupId']
+        # The other container may not have revoked the egress rule yet, revoking it again is a no-op
+        self.revoke_egress_rules(group_id)
+        return group_id
+
+    def revoke_egress_rules(self, sg_id):
+        '''Accepts a security group ID, revokes every egress rule of the group.
+        A new security group allows all outbound traffic, which the quarantine group must not give a locked instance'''
+        response = self.get_security_group_ids(filter=[{'Name': 'group-id', 'Values': [sg_id]}])
+        egress_rules = [rule for group in response['SecurityGroups'] for rule in group.get('IpPermissionsEgress', [])]
+        if not egress_rules:
+            return None
         try:
-            response = self.client.authorize_security_group_egress(
-                GroupId=sg_id,
-                IpPermissions=[{'FromPort': -1, 'ToPort': -1, 'IpProtocol': '-1', 'IpRanges': [{'CidrIp': sg_id}], 'Ipv6Ranges': [{'CidrIpv6': sg_id}]}]
-            )
-            log.info("Authorized rule for dummy security group: {0}".format(response))
+            response = call_aws('ec2', self.region, 'RevokeSecurityGroupEgress', self.client.revoke_security_group_egress,
+                                GroupId=sg_id, IpPermissions=egress_rules)
+            log.info("Revoked egress rules of security group: %s", sg_id)
             return response
         except ClientError as error:
-            log.error("Unable to authorize rule for dummy security group, error: {0}".format(error))
-            raise ValueError("Unable to create authorize rule for dummy security group, error: {0}".format(error))
+            log.error("Unable to revoke egress rules of security group: %s, error: %s", sg_id, error)
+            raise ValueError("Unable to revoke egress rules of security group: {0}, error: {1}".format(sg_id, error))
 
     # Accepts a lsit of security group IDs and an instance ID, modifies the instance to have the listed security groups
     def modify_security_groups(self, sg_ids, instance_id):
         '''Accepts a list of security group IDs and an instance ID,
         modifies the instance to have the listed security groups'''
         try:
-            response = self.client.modify_instance_attribute(InstanceId=instance_id, Groups=sg_ids)
-            log.info("Modified security groups: {0}".format(response))
+            response = call_aws('ec2', self.region, 'ModifyInstanceAttribute', self.client.modify_instance_attribute, InstanceId=instance_id, Groups=sg_ids)
+            log.debug("Modified security groups: %s", Payload(response))
             return response
         except ClientError as error:
             raise ValueError("Unable to modify security groups, error: {0}".format(error))
 
-def modify_security_groups(sg_ids, instance_id, region):
-    '''Calls modify_security_groups on the EC2 client'''
-    try:
-        ec2_client = Ec2Client(region)
-        response = ec2_client.modify_security_groups(sg_ids, instance_id)
-        log.info("Modified security groups: {0}".format(response))
-        return "Successfully Locked Instance"
-    except ClientError as error:
-        raise ValueError("Unable to modify security groups, error: {0}".format(error))
-
 def remove_duplicates(input_list, bad_group_list):
     '''Compares the list of previous security groups to the list of bad security groups
-    converts lists to sets and removes duplicates from instance_dict['security_group_ids'] set
+    converts lists to sets and removes duplicates from the decision's security_group_ids set
     returns a new list with only the security groups that are not in the bad_group_list set'''
     new_list = set(input_list).difference(set(bad_group_list))
     return new_list
 
-def lock_ssh(instance_dict, filter):
-    '''Accepts the instance dict as an input, gets the security groups ids with open ssh,
-    locks the instance by removing the bad SG and adding the dummy SG'''
-    ssh_group_list = []
-    ec2_client = Ec2Client(instance_dict['region'])
-    response = ec2_client.get_security_group_ids(filter)
-    for security_group in response['SecurityGroups']:
-        ssh_group_list.append(security_group['GroupId'])
-    log.info("Bad group list: {}".format(ssh_group_list))
-    # Remove the flagged open SSH security groups from the list
-    new_sg_list = list(remove_duplicates(instance_dict['security_group_ids'], ssh_group_list))
-    # add dummy sg ID to the list
-    new_sg_list.append(ec2_client.create_dummy_security_group(instance_dict['instance_id'], instance_dict['vpc_id']))
-    # call modify_security_groups
-    modify_security_groups(new_sg_list, instance_dict['instance_id'], instance_dict['region'])
-    return
-
-def lock_default(instance_dict, filter):
-    '''Accepts the instance dict as an input, gets the security group id for the default SG,
-    locks the instance by removing the default SG and creating a new dummy security group'''
-    default_group_list = []
-    ec2_client = Ec2Client(instance_dict['region'])
-    response = ec2_client.get_security_group_ids(filter)
-    for security_group in response['SecurityGroups']:
-        default_group_list.append(security_group['GroupId'])
-    log.info("Bad group list: {}".format(default_group_list))
-    new_sg_list = list(remove_duplicates(instance_dict['security_group_ids'], default_group_list))
-    new_sg_list.append(ec2_client.create_dummy_security_group(instance_dict['instance_id'], instance_dict['vpc_id']))
-    log.info("New SG list: {}".format(new_sg_list))
-    modify_security_groups(new_sg_list, instance_dict['instance_id'], instance_dict['region'])
-    return 
-
-# TODO: Instead of repeating the same logic, can we reorganize lock_ssh and lock_default to be more DRY?
-# This would require moving the "create_dummy_security_group" method out of the functions
-def lock_both(instance_dict, filterdefault, filterssh):
-    '''If the instance has both open SSH and default security groups, lock both'''
-    get_default_sg_filter = filterdefault
-    get_ssh_sg_filter = filterssh
-    group_list = []
-    ec2_client = Ec2Client(instance_dict['region'])
-    # Query for default group IDs
-    default_response = ec2_client.get_security_group_ids(get_default_sg_filter)
-    log.info("Default group list: {}".format(default_response))
-    for security_group in default_response['SecurityGroups']:
-        log.info("SG: {}".format(security_group))
-        group_list.append(security_group['GroupId'])
-    # Query for SSH Group IDs
-    ssh_response = ec2_client.get_security_group_ids(get_ssh_sg_filter)
-    for security_group in ssh_response['SecurityGroups']:
-        group_list.append(security_group['GroupId'])
-    # Remove the flag groups from the list
-    log.info("Bad Group list: {}".format(group_list))
-    new_sg_list = list(remove_duplicates(instance_dict['security_group_ids'], group_list))
-    new_sg_list.append(ec2_client.create_dummy_security_group(instance_dict['instance_id'], instance_dict['vpc_id']))
-    # Modify instance with the good SG list
-    modify_security_groups(new_sg_list, instance_dict['instance_id'], instance_dict['region'])
-
-# Accepts the instance dict as input, sets our filters, and calls the appropriate lock function
-def lock_instance(instance_dict):
-    '''Accepts the instance dict as input, sets filters, and calls the appropriate lock function'''
-    get_default_sg_filter = [{'Name': 'vpc-id', 'Values': [instance_dict['vpc_id']], 'Name': 'group-name', 'Values': ['default']}]
-    get_ssh_sg_filter = [{'Name': 'vpc-id', 'Values': [instance_dict['vpc_id']], 'Name': 'ip-permission.to-port', 'Values': ['22', '-1'], 'Name': 'ip-permission.cidr', 'Values': ['0.0.0.0/0'], 'Name': 'ip-permission.ipv6-cidr', 'Values': ['::/0']}]
-    if instance_dict['flag'] == 'ssh':
-        lock_ssh(instance_dict, get_ssh_sg_filter)
-        return True
-    elif instance_dict['flag'] == 'default':
-        lock_default(instance_dict, get_default_sg_filter)
-        return True
-    elif instance_dict['flag'] == 'both':
-        lock_both(instance_dict, get_default_sg_filter, get_ssh_sg_filter)
-        return True
-    log.error("No flag found for instance {0}, review evaluate_instance/lambda logs".format(instance_dict['instance_id']))
+def has_ssh_open(security_group):
+    '''Returns True if the security group allows SSH from the whole IPv4 or IPv6 internet'''
+    for p in security_group.get('IpPermissions', []):
+        if p['IpProtocol'] not in ('tcp', '6', '-1'):
+            continue
+        # Rules for all protocols have no ports, they cover port 22 as well
+        from_port = p.get('FromPort', -1)
+        to_port = p.get('ToPort', -1)
+        if from_port != -1 and not from_port <= 22 <= to_port:
+            continue
+        if world_open_ip_versions(p):
+            return True
     return False
 
-def lambda_handler(event, context):
-    '''Receives an event body containing instance id, region, and other flags.
-    We can expect only one record in event['Records']'''
-    for record in event['Records']:
-        log.info("Received record body: {}".format(record['body']))
-        instance_dict = json.loads(record['body'])
-        lock_instance(instance_dict)
-        log.info("Locked instance: {0}".format(instance_dict['instance_id']))
+def get_bad_security_group_ids(security_groups, flag):
+    '''Accepts the described security groups of an instance and its flag,
+    returns the IDs of the groups that have to be removed from the instance'''
+    bad_group_list = []
+    for security_group in security_groups:
+        if flag in ('default', 'both') and security_group['GroupName'] == 'default':
+            bad_group_list.append(security_group['GroupId'])
+        elif flag in ('ssh', 'both') and has_ssh_open(security_group):
+            bad_group_list.append(security_group['GroupId'])
+    return bad_group_list
+
+def describe_batch_security_groups(decisions, region):
+    '''Describes the union of the security groups of every instance in the batch for a region,
+    returns a dict of security group ID to security group'''
+    ec2_client = Ec2Client(region)
+    security_group_ids = sorted(set(sg_id for decision in decisions for sg_id in decision.security_group_ids))
+    security_groups = {}
+    for start in range(0, len(security_group_ids), SECURITY_GROUP_CHUNK_SIZE):
+        for security_group in ec2_client.describe_security_groups(security_group_ids[start:start + SECURITY_GROUP_CHUNK_SIZE]):
+            security_groups[security_group['GroupId']] = security_group
+    return security_groups
+
+def get_quarantine_security_group(region, vpc_id):
+    '''Returns the ID of the VPC's quarantine security group, finding or creating it at most once per TTL'''
+    key = (region, vpc_id)
+    cached = _quarantine_groups.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    with _quarantine_locks.setdefault(key, threading.Lock()):
+        # Another thread may have resolved the group while we waited
+        cached = _quarantine_groups.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        ec2_client = Ec2Client(region)
+        group_id = ec2_client.find_quarantine_security_group(vpc_id)
+        if group_id is None:
+            group_id = ec2_client.create_quarantine_security_group(vpc_id)
+        _quarantine_groups[key] = (group_id, time.monotonic() + QUARANTINE_CACHE_TTL_SECONDS)
+        return group_id
+
+def lock_with_quarantine_group(decision, new_sg_list):
+    '''Replaces the instance's security groups with the good groups and the VPC's quarantine group'''
+    key = (decision.region, decision.vpc_id)
+    new_sg_list = list(new_sg_list)
+    new_sg_list.append(get_quarantine_security_group(decision.region, decision.vpc_id))
+    log.info("New SG list for instance %s: %s", decision.instance_id, new_sg_list)
+    try:
+        Ec2Client(decision.region).modify_security_groups(new_sg_list, decision.instance_id)
+    except ValueError:
+        # The cached group may have been deleted, resolve it again when the record is retried
+        _quarantine_groups.pop(key, None)
+        raise
+    return True
+
+def lock_instances(decisions):
+    '''Locks a batch of instances. The bad groups of an instance come with its message, or for messages without them,
+    the groups of every instance in a region are resolved with one describe.
+    Then the instances are moved to their VPC's quarantine group on a bounded worker pool.
+    Returns a list with one result per decision, True if it was locked, or the error that prevented it'''
+    results = [None] * len(decisions)
+    region_map = defaultdict(list)
+    for index, decision in enumerate(decisions):
+        if decision.flag not in LOCK_FLAGS:
+            log.error("No flag found for instance %s, review evaluate_instance/lambda logs", decision.instance_id, extra=log_fields(decision.instance_id))
+            results[index] = ValueError("Unknown flag: {0}".format(decision.flag))
+            continue
+        region_map[(decision.account_id or None, decision.region)].append(index)
+    tasks = []
+    for (account_id, region), indexes in region_map.items():
+        described = [index for index in indexes if decisions[index].bad_security_group_ids is None]
+        metrics.put('IndexedBadGroups', len(indexes) - len(described))
+        security_groups = {}
+        if described:
+            try:
+                with account_context(account_id), log_context(region=region), metrics.stage('describe'):
+                    security_groups = describe_batch_security_groups([decisions[index] for index in described], region)
+            except ValueError as error:
+                log.error("Unable to resolve security groups in region: %s, error: %s", region, error)
+                for index in described:
+                    results[index] = error
+                indexes = [index for index in indexes if index not in described]
+        for index in indexes:
+            decision = decisions[index]
+            if decision.bad_security_group_ids is not None:
+                bad_group_list = decision.bad_security_group_ids
+            else:
+                instance_groups = [security_groups[sg_id] for sg_id in decision.security_group_ids if sg_id in security_groups]
+                bad_group_list = get_bad_security_group_ids(instance_groups, decision.flag)
+            log.info("Bad group list for instance %s: %s", decision.instance_id, bad_group_list, extra=log_fields(decision.instance_id))
+            tasks.append((index, remove_duplicates(decision.security_group_ids, bad_group_list)))
+    if tasks:
+        def run(task):
+            index, new_sg_list = task
+            decision = decisions[index]
+            with account_context(decision.account_id or None), log_context(instance_id=decision.instance_id, region=decision.region):
+                try:
+                    return lock_with_quarantine_group(decision, new_sg_list)
+                except ValueError as error:
+                    log.error("Unable to lock instance %s, error: %s", decision.instance_id, error)
+                    return error
+        with metrics.stage('lock'), ThreadPoolExecutor(max_workers=min(LOCK_MAX_WORKERS, len(tasks))) as executor:
+            # Every task runs in its own copy of the log context, with the request ID and stage
+            futures = [executor.submit(contextvars.copy_context().run, profile_thread, run, task) for task in tasks]
+            for (index, _), future in zip(tasks, futures):
+                results[index] = future.result()
+    return results
+
+# Accepts a lock Decision as input, locks the instance and returns True on success
+def lock_instance(decision):
+    '''Accepts a lock Decision as input, locks the instance by swapping its flagged security groups for the quarantine group'''
+    return lock_instances([decision])[0] is True
+
+def batch_response(message, failed_message_ids):
+    '''Builds the handler response, reporting the failed message IDs as batchItemFailures'''
     return {
         'statusCode': 200,
-        'body': json.dumps('Instances processed successfully!')
+        'body': json.dumps(message),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_message_ids)]
     }
+
+@flush_metrics
+@bind_request_id
+@profile_invocations
+def lambda_handler(event, context):
+    '''Receives an event body containing instance id, region, and other flags.
+    Every record in the batch is locked together, records that fail are reported as batchItemFailures'''
+    failed_message_ids = []
+    records = []
+    decisions = []
+    metrics.put('Records', len(event['Records']))
+    with metrics.stage('parse'):
+        for record in event['Records']:
+            log.debug("Received record body: %s", record['body'])
+            try:
+                decision = Decision.decode(record['body'])
+                missing_fields = [field for field in REQUIRED_FIELDS if getattr(decision, field) is None]
+                if missing_fields:
+                    raise ValueError("Missing fields: {0}".format(missing_fields))
+            except (ValueError, TypeError) as error:
+                log.error("Unable to parse record: %s, error: %s", record['messageId'], error)
+                failed_message_ids.append(record['messageId'])
+                continue
+            records.append(record)
+            decisions.append(decision)
+    for record, decision, result in zip(records, decisions, lock_instances(decisions)):
+        if result is True:
+            log.info("Locked instance: %s", decision.instance_id, extra=log_fields(decision.instance_id))
+            continue
+        failed_message_ids.append(record['messageId'])
+    metrics.put('FailedRecords', len(set(failed_message_ids)))
+    return batch_response('Instances processed successfully!', failed_message_ids)
+
+# Runs during the lambda init phase, before the first event is handled
+if STARTUP_MODE == "prewarm":
+    prewarm_clients(PREWARM_SERVICES)
@@ -1,103 +1,146 @@
 import json
-import logging
-import boto3
+from collections import defaultdict
 from botocore.exceptions import ClientError
+import shutdown_common
+from shutdown_common import (DEFAULT_REGION, STARTUP_MODE, Decision, Payload, account_context, bind_request_id, call_aws,
+                             flush_metrics, get_client, get_logger, log_context, metrics, prewarm_clients, profile_invocations,
+                             stop_instances)
 
+### VARIABLES
 LOCK_QUEUE_NAME = "lock_instance_queue"
-DEFAULT_REGION = "us-east-1"
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("ec2_stop_logger")
-log.setLevel(logging.INFO)
+# SendMessageBatch accepts at most 10 entries per call
+SQS_BATCH_SIZE = 10
+PREWARM_SERVICES = ('ec2', 'sqs')
+
+log = get_logger("ec2_stop_logger")
+
+### CLIENT REGISTRY
+# Queue URLs are looked up once per container, keyed by region and queue name
+_queue_urls = {}
+
+def reset_clients():
+    '''Drops every cached client, queue URL and assumed role so the next lookup builds a new one. Tests call this so a patched boto3.client is picked up'''
+    shutdown_common.reset_clients()
+    _queue_urls.clear()
 
 ### CLASSES
 class SqsClient:
     '''Instantiates a SQS client for API calls'''
     def __init__(self, region):
-        self.client = boto3.client('sqs', region_name=region)
+        self.client = get_client('sqs', region)
         self.region = region
 
     def get_queue_url(self, queue_name):
-        '''Accepts a queue name, returns the queue URL'''
+        '''Accepts a queue name, returns the queue URL. The URL is cached for the lifetime of the container'''
+        key = (self.region, queue_name)
+        if key in _queue_urls:
+            return _queue_urls[key]
         try:
-            response = self.client.get_queue_url(QueueName=queue_name)
-            log.debug("Got queue url: {0}".format(response))
+            response = call_aws('sqs', self.region, 'GetQueueUrl', self.client.get_queue_url, QueueName=queue_name)
+            log.debug("Got queue url: %s", Payload(response))
+            _queue_urls[key] = response['QueueUrl']
             return response['QueueUrl']
         except ClientError as error:
-            log.error("Unable to get queue URL for queue: {0}, error: {1}".format(queue_name, error))
+            log.error("Unable to get queue URL for queue: %s, error: %s", queue_name, error)
             return {}
 
     def send_message(self, queue_url, message):
         '''Accepts a queue URL and a message, sends the message to the queue'''
         try:
-            response = self.client.send_message(QueueUrl=queue_url, MessageBody=message)
-            log.debug("Sent message: {0}".format(response))
+            response = call_aws('sqs', self.region, 'SendMessage', self.client.send_message, QueueUrl=queue_url, MessageBody=message)
+            log.debug("Sent message: %s", Payload(response))
             return response
         except ClientError as error:
-            log.error("Unable to send message to queue: {0}, error: {1}".format(queue_url, error))
-            return {}
-
-class Ec2Client:
-    '''Instantiates an EC2 client for API calls'''
-    def __init__(self, region):
-        self.client = boto3.client('ec2', region_name=region)
-        self.region = region
-
-    def stop_instance(self, instance_id_list):
-        '''Accepts a list of instance IDs, stops the instances'''
-        try:
-            response = self.client.stop_instances(InstanceIds=instance_id_list)
-            log.info("Stopped instances: {}".format(instance_id_list))
-            return response
-        except ClientError as error:
-            log.error("Error stopping instance: {}".format(error))
+            log.error("Unable to send message to queue: %s, error: %s", queue_url, error)
             return {}
 
+    def send_message_batch(self, queue_url, messages):
+        '''Accepts a queue URL and a list of messages, sends them in batches of SQS_BATCH_SIZE.
+        Returns the indexes of the messages that could not be sent'''
+        failed_indexes = []
+        for start in range(0, len(messages), SQS_BATCH_SIZE):
+            chunk = messages[start:start + SQS_BATCH_SIZE]
+            entries = [{'Id': str(start + offset), 'MessageBody': message} for offset, message in enumerate(chunk)]
+            try:
+                response = call_aws('sqs', self.region, 'SendMessageBatch', self.client.send_message_batch, QueueUrl=queue_url, Entries=entries)
+                log.debug("Sent message batch: %s", Payload(response))
+            except ClientError as error:
+                log.error("Unable to send message batch to queue: %s, error: %s", queue_url, error)
+                failed_indexes.extend(range(start, start + len(chunk)))
+                continue
+            for failure in response.get('Failed', []):
+                log.error("Unable to send message to queue: %s, error: %s", queue_url, failure.get('Message', failure['Code']))
+                failed_indexes.append(int(failure['Id']))
+        return sorted(failed_indexes)
 
 ### FUNCTIONS
-def send_instance_to_lock_queue(message, region):
-    '''Accepts a message and region, sends the message to the lock queue'''
-    sqs_client = SqsClient(region)
+def send_instances_to_lock_queue(messages):
+    '''Accepts a list of messages, sends them to the lock queue in batches.
+    Returns the indexes of the messages that could not be sent'''
+    # The lock queue lives in the default region, whichever region the instances are in
+    sqs_client = SqsClient(DEFAULT_REGION)
     queue_url = sqs_client.get_queue_url(LOCK_QUEUE_NAME)
-    if queue_url:
-        sqs_response = sqs_client.send_message(queue_url, message)
-        if sqs_response:
-            log.info("Successfully sent message to lock queue: {}".format(message))
-            return True
-        else:
-            log.error("Error sending message to lock queue: {}".format(message))
-            return False
-    else:
-        log.error("Unable to get queue url for queue: {0}".format(LOCK_QUEUE_NAME))
-        return False
+    if not queue_url:
+        log.error("Unable to get queue url for queue: %s", LOCK_QUEUE_NAME)
+        return list(range(len(messages)))
+    failed_indexes = sqs_client.send_message_batch(queue_url, messages)
+    log.info("Sent %d of %d messages to lock queue", len(messages) - len(failed_indexes), len(messages))
+    return failed_indexes
 
 def stop_instance(instance_id, region):
     '''Accepts an instance ID and region, stops the instance'''
-    ec2_client = Ec2Client(region)
-    response = ec2_client.stop_instance([instance_id])
-    if response:
-        log.info("Stopped instance: {}".format(instance_id))
-        log.debug("Response from stop_instance: {}".format(response))
-        return True
-    log.error("Error stopping instance, sending to lock queue: {}".format(instance_id))
-    return False
+    return stop_instances([instance_id], region) == []
+
+def batch_response(message, failed_message_ids):
+    '''Builds the handler response, failed message IDs are returned as batchItemFailures so only those records are retried'''
+    return {
+        'statusCode': 200,
+        'body': json.dumps(message),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_message_ids)]
+    }
 
+@flush_metrics
+@bind_request_id
+@profile_invocations
 def lambda_handler(event, context):
-    '''Accepts an event from SQS, which contains instance ID, region,
-    and other flags we only care about on lock. We can expect only
-    one record in event['Records']'''
-    for record in event['Records']:
-        log.debug("Received event: {}".format(record))
-        instance_dict = json.loads(record['body'])
-        stop_result = stop_instance(instance_dict['instance_id'], instance_dict['region'])
-        if stop_result:
-            log.info("Successfully stopped instance, exiting")
-            return {
-                'statusCode': 200,
-                'body': json.dumps('Successfully stopped instance!')
-            }
-        log.info("Error stopping instance, sending to lock queue")
-        send_instance_to_lock_queue(record['body'], instance_dict['region'])
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Successfully sent instance to lock queue!')
-        }
+    '''Accepts an event from SQS, whose records are Decisions with the instance ID, region,
+    and other flags we only care about on lock. The batch is stopped with one StopInstances call per region,
+    instances that can't be stopped are forwarded to the lock queue in one batch.
+    Records that could neither be stopped nor sent to the lock queue are reported as batchItemFailures'''
+    failed_message_ids = []
+    # Group the records by account and region, each region of an account is stopped with a single call
+    region_map = defaultdict(list)
+    metrics.put('Records', len(event['Records']))
+    with metrics.stage('parse'):
+        for record in event['Records']:
+            log.debug("Received event: %s", Payload(record))
+            try:
+                decision = Decision.decode(record['body'])
+                region_map[(decision.account_id or None, decision.region)].append((record, decision.instance_id))
+            except (ValueError, KeyError, TypeError) as error:
+                log.error("Unable to process record: %s, error: %s", record['messageId'], error)
+                failed_message_ids.append(record['messageId'])
+    lock_records = []
+    for (account_id, region), region_records in region_map.items():
+        instance_ids = list(dict.fromkeys(instance_id for _, instance_id in region_records))
+        with account_context(account_id), log_context(region=region), metrics.stage('stop'):
+            try:
+                failed_instance_ids = set(stop_instances(instance_ids, region))
+            except ValueError as error:
+                # The account's role couldn't be assumed, locking would fail the same way so the records are retried
+                log.error("Unable to stop instances in region: %s, error: %s", region, error)
+                failed_message_ids.extend(record['messageId'] for record, _ in region_records)
+                continue
+            log.info("Stopped %d of %d instances in region: %s", len(instance_ids) - len(failed_instance_ids), len(instance_ids), region)
+        lock_records.extend(record for record, instance_id in region_records if instance_id in failed_instance_ids)
+    if lock_records:
+        log.info("Error stopping %d instances, sending to lock queue", len(lock_records))
+        with metrics.stage('route'):
+            failed_indexes = send_instances_to_lock_queue([record['body'] for record in lock_records])
+        failed_message_ids.extend(lock_records[index]['messageId'] for index in failed_indexes)
+    metrics.put('FailedRecords', len(set(failed_message_ids)))
+    return batch_response('Instances processed successfully!', failed_message_ids)
+
+# Runs during the lambda init phase, before the first event is handled
+if STARTUP_MODE == "prewarm":
+    prewarm_clients(PREWARM_SERVICES)
@@ -0,0 +1,19 @@
+### DEDUPLICATION
+
+# Shared tier of the evaluate lambdas' dedup store, one item per claimed event or decision.
+# Items expire on their own through the expires_at TTL attribute
+resource "aws_dynamodb_table" "dedup_table" {
+  name         = "shutdown_service_dedup"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "dedup_key"
+
+  attribute {
+    name = "dedup_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
@@ -62,6 +62,25 @@ data "aws_iam_policy_document" "allow_multiregion_resource_policy" {
       identifiers = ["${aws_iam_role.assume_send_events_role.arn}"]
     }
   }
+  # The member accounts forward their events from their own regional rules
+  dynamic "statement" {
+    for_each = var.organization_id == "" ? [] : [var.organization_id]
+    content {
+      sid       = "OrganizationAccountAccess"
+      effect    = "Allow"
+      actions   = ["events:PutEvents"]
+      resources = [aws_cloudwatch_event_bus.ec2_shutdown_bus.arn]
+      principals {
+        type        = "*"
+        identifiers = ["*"]
+      }
+      condition {
+        test     = "StringEquals"
+        variable = "aws:PrincipalOrgID"
+        values   = [statement.value]
+      }
+    }
+  }
 }
 
 # Attachs our resource based policy to our destination event bus
@@ -73,19 +92,37 @@ resource "aws_cloudwatch_event_bus_policy" "allow_multiregion_events_policy" {
 }
 
 ### Deliver EC2 State Changes to own event bus
-resource "aws_cloudwatch_event_rule" "capture_ec2_remote_us_east" {
-  name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
+locals {
+  # Security group changes are AWS API Call via CloudTrail events, they need a CloudTrail trail recording management events in each region
+  security_group_events = ["AuthorizeSecurityGroupIngress", "RevokeSecurityGroupIngress", "CreateSecurityGroup", "DeleteSecurityGroup"]
+  # Every region forwards its running instances and its security group changes to the destination bus
+  forwarded_ec2_events = jsonencode({
     "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
+    "$or" : [
+      {
+        "detail-type" : ["EC2 Instance State-change Notification"],
+        "detail" : {
+          "state" : ["running"]
+        }
+      },
+      {
+        "detail-type" : ["AWS API Call via CloudTrail"],
+        "detail" : {
+          "eventName" : local.security_group_events
+        }
+      }
+    ]
   })
 }
 
+resource "aws_cloudwatch_event_rule" "capture_ec2_remote_us_east" {
+  name        = "capture-ec2-remote"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
+
+  event_pattern = local.forwarded_ec2_events
+}
+
 resource "aws_cloudwatch_event_target" "send_to_remote_us_east" {
   target_id = "SendToRemoteBus"
   arn       = aws_cloudwatch_event_bus.ec2_shutdown_bus.arn
@@ -126,16 +163,95 @@ resource "aws_cloudwatch_event_target" "sqs" {
   input_transformer {
     input_paths = {
       instance = "$.detail.instance-id"
+      account  = "$.account"
       region   = "$.region"
+      time     = "$.time"
     }
+    # The event time identifies a delivery, so the evaluate lambda can drop redelivered copies.
+    # The account tells the lambdas which account's role to act on the instance through
     input_template = <<EOF
 {
   "instance_id": "<instance>",
-  "region": "<region>"
+  "account_id": "<account>",
+  "region": "<region>",
+  "time": "<time>"
+}
+EOF
+  }
+
+}
+
+# Security group changes go to the same queue, so the evaluate lambda keeps its security group index current
+resource "aws_cloudwatch_event_rule" "security_group_changes" {
+  name           = "capture-security-group-changes"
+  description    = "Capture each security group change that can expose or unexpose instances"
+  event_bus_name = aws_cloudwatch_event_bus.ec2_shutdown_bus.name
+
+  event_pattern = jsonencode({
+    "source" : ["aws.ec2"],
+    "detail-type" : ["AWS API Call via CloudTrail"],
+    "detail" : {
+      "eventName" : local.security_group_events
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_target" "security_group_changes_sqs" {
+  rule           = aws_cloudwatch_event_rule.security_group_changes.name
+  target_id      = "SendSecurityGroupChangesToSQS"
+  arn            = aws_sqs_queue.get_instance_info_queue.arn
+  event_bus_name = aws_cloudwatch_event_bus.ec2_shutdown_bus.name
+  retry_policy {
+    maximum_retry_attempts       = "2"
+    maximum_event_age_in_seconds = "600"
+  }
+  dead_letter_config {
+    arn = aws_sqs_queue.get_instance_info_dl_queue.arn
+  }
+  input_transformer {
+    input_paths = {
+      event_name    = "$.detail.eventName"
+      group         = "$.detail.requestParameters.groupId"
+      created_group = "$.detail.responseElements.groupId"
+      account       = "$.account"
+      region        = "$.region"
+      time          = "$.time"
+    }
+    # CreateSecurityGroup only carries the new group's ID in its response
+    input_template = <<EOF
+{
+  "security_group_event": "<event_name>",
+  "security_group_id": "<group>",
+  "created_security_group_id": "<created_group>",
+  "account_id": "<account>",
+  "region": "<region>",
+  "time": "<time>"
 }
 EOF
   }
+}
+
+### SWEEP SCHEDULE
 
+# Runs the sweep on the default event bus, catching instances whose state change event was lost
+resource "aws_cloudwatch_event_rule" "sweep_schedule" {
+  name                = "sweep-instances-schedule"
+  description         = "Periodically sweep every running instance"
+  schedule_expression = var.sweep_schedule
+}
+
+resource "aws_cloudwatch_event_target" "sweep_lambda" {
+  rule      = aws_cloudwatch_event_rule.sweep_schedule.name
+  target_id = "SweepInstances"
+  arn       = aws_lambda_function.sweep_instances.arn
+}
+
+resource "aws_lambda_permission" "allow_sweep_schedule" {
+  statement_id  = "AllowExecutionFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.sweep_instances.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.sweep_schedule.arn
 }
 
 ### MULTI-REGION
@@ -149,15 +265,9 @@ EOF
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_us_west" {
   provider    = aws.uswest1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_us_west" {
@@ -173,16 +283,10 @@ resource "aws_cloudwatch_event_target" "send_to_remote_us_west" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_us_east_2" {
   provider    = aws.useast2
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_us_east_2" {
@@ -198,15 +302,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_us_east_2" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_us_west2" {
   provider    = aws.uswest2
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_us_west2" {
@@ -222,15 +320,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_us_west2" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ap_south_1" {
   provider    = aws.apsouth1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ap_south_1" {
@@ -246,15 +338,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ap_south_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ap_southeast_1" {
   provider    = aws.apsoutheast1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ap_southeast_1" {
@@ -270,15 +356,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ap_southeast_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ap_southeast_2" {
   provider    = aws.apsoutheast2
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ap_southeast_2" {
@@ -294,15 +374,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ap_southeast_2" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ap_northeast_1" {
   provider    = aws.apnortheast1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ap_northeast_1" {
@@ -318,15 +392,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ap_northeast_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ap_northeast_2" {
   provider    = aws.apnortheast2
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ap_northeast_2" {
@@ -342,15 +410,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ap_northeast_2" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ap_northeast_3" {
   provider    = aws.apnortheast3
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ap_northeast_3" {
@@ -366,15 +428,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ap_northeast_3" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_ca_central_1" {
   provider    = aws.cacentral1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_ca_central_1" {
@@ -390,15 +446,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_ca_central_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_eu_central_1" {
   provider    = aws.eucentral1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_eu_central_1" {
@@ -414,15 +464,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_eu_central_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_eu_west_1" {
   provider    = aws.euwest1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_eu_west_1" {
@@ -438,14 +482,8 @@ resource "aws_cloudwatch_event_target" "send_to_remote_eu_west_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_eu_west_2" {
   provider    = aws.euwest2
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_eu_west_2" {
@@ -461,15 +499,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_eu_west_2" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_eu_west_3" {
   provider    = aws.euwest3
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_eu_west_3" {
@@ -485,14 +517,8 @@ resource "aws_cloudwatch_event_target" "send_to_remote_eu_west_3" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_eu_north_1" {
   provider    = aws.eunorth1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
+  event_pattern = local.forwarded_ec2_events
 }
 
 resource "aws_cloudwatch_event_target" "send_to_remote_eu_north_1" {
@@ -508,15 +534,9 @@ resource "aws_cloudwatch_event_target" "send_to_remote_eu_north_1" {
 resource "aws_cloudwatch_event_rule" "capture_ec2_remote_sa_east_1" {
   provider    = aws.saeast1
   name        = "capture-ec2-remote"
-  description = "Capture each Running EC2 instance and sends the event unmodified to remote event bus"
+  description = "Capture each Running EC2 instance and security group change, and send the event unmodified to remote event bus"
 
-  event_pattern = jsonencode({
-    "source" : ["aws.ec2"],
-    "detail-type" : ["EC2 Instance State-change Notification"],
-    "detail" : {
-      "state" : ["running"]
-    }
-  })
+  event_pattern = local.forwarded_ec2_events
 }
 resource "aws_cloudwatch_event_target" "send_to_remote_sa_east_1" {
   provider  = aws.saeast1
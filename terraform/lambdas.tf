@@ -3,7 +3,7 @@
 ### IAM
 
 # EVALUATE LAMBDA
-# Requires permission to read EC2, manage SQS, publish to logs
+# Requires permission to read EC2, stop EC2 instances in inline containment mode, manage SQS, claim dedup keys, publish to logs
 resource "aws_iam_role" "evaluate_lambda_role" {
   name = "evaluate_lambda_role"
 
@@ -27,7 +27,7 @@ EOF
 resource "aws_iam_policy" "evaluate_lambda_policy" {
     name = "evaluate_lambda_policy"
     path = "/"
-    description = "IAM policy for evaluate lambda function. Grants read to EC2, manage SQS, publish to logs"
+    description = "IAM policy for evaluate lambda function. Grants read and stop to EC2, manage SQS, write to the dedup table, assume the member account role, publish to logs"
     policy = jsonencode({
         Version = "2012-10-17"
         Statement = [
@@ -38,6 +38,14 @@ resource "aws_iam_policy" "evaluate_lambda_policy" {
             Effect   = "Allow"
             Resource = "*"
         },
+        {
+            # Only used when inline_containment is "stop"
+            Action = [
+            "ec2:StopInstances",
+            ]
+            Effect   = "Allow"
+            Resource = "*"
+        },
         {
             "Effect": "Allow",
             "Action": "elasticloadbalancing:Describe*",
@@ -78,6 +86,21 @@ resource "aws_iam_policy" "evaluate_lambda_policy" {
             Effect   = "Allow"
             Resource = "*"
         },
+        {
+            Action = [
+            "dynamodb:PutItem",
+            "dynamodb:DeleteItem",
+            ]
+            Effect   = "Allow"
+            Resource = aws_dynamodb_table.dedup_table.arn
+        },
+        {
+            Action = [
+            "sts:AssumeRole",
+            ]
+            Effect   = "Allow"
+            Resource = "arn:aws:iam::*:role/${var.account_role_name}"
+        },
         ]
     })
 }
@@ -114,7 +137,7 @@ EOF
 resource "aws_iam_policy" "stop_lock_lambda_policy" {
     name = "iam_policy_for_stop_lock_lambda"
     path = "/"
-    description = "IAM policy for stop/lock lambda function. Grants write to EC2, manage SQS, publish to logs"
+    description = "IAM policy for stop/lock lambda function. Grants write to EC2, manage SQS, assume the member account role, publish to logs"
     policy = jsonencode({
         Version = "2012-10-17"
         Statement = [
@@ -163,6 +186,13 @@ resource "aws_iam_policy" "stop_lock_lambda_policy" {
             Effect   = "Allow"
             Resource = "*"
         },
+        {
+            Action = [
+            "sts:AssumeRole",
+            ]
+            Effect   = "Allow"
+            Resource = "arn:aws:iam::*:role/${var.account_role_name}"
+        },
         ]
     })
 }
@@ -200,6 +230,16 @@ resource "aws_lambda_function" "evaluate_instances" {
     image_uri = "${aws_ecr_repository.evaluate_repository.repository_url}@${data.aws_ecr_image.evaluate_image.image_digest}"
     memory_size = "128"
     publish = true
+    environment {
+        variables = {
+            INLINE_CONTAINMENT = var.inline_containment
+            DEDUP_TABLE = aws_dynamodb_table.dedup_table.name
+            ACCOUNT_ROLE_NAME = var.account_role_name
+            HOME_ACCOUNT_ID = var.account_id
+            PROFILE_COLD_START = var.profile_cold_start
+            PROFILE_WARM_ONE_IN = var.profile_warm_one_in
+        }
+    }
     dead_letter_config {
         target_arn = aws_sqs_queue.get_instance_info_dl_queue.arn
     }
@@ -208,9 +248,66 @@ resource "aws_lambda_function" "evaluate_instances" {
 resource "aws_lambda_event_source_mapping" "evaluate_instances" {
     event_source_arn = aws_sqs_queue.get_instance_info_queue.arn
     function_name = aws_lambda_function.evaluate_instances.arn
-    batch_size = 0
+    batch_size = 10
     enabled = true
     maximum_batching_window_in_seconds = 0
+    # Handlers return the failed message IDs, so only those records are retried and redriven
+    function_response_types = ["ReportBatchItemFailures"]
+}
+
+
+# For the sweep:
+# Runs the evaluate image's sweep_handler on a schedule, see the sweep schedule in eventbridge.tf.
+# It reuses the evaluate role, plus permission to invoke itself when a sweep continues in a new invocation
+resource "aws_lambda_function" "sweep_instances" {
+    function_name = "sweep_instances"
+    role = aws_iam_role.evaluate_lambda_role.arn
+    description = "Sweeps every running instance in every region for problematic security groups, and routes them to the stop and lock queues."
+    timeout = "900"
+    package_type = "Image"
+    image_uri = "${aws_ecr_repository.evaluate_repository.repository_url}@${data.aws_ecr_image.evaluate_image.image_digest}"
+    image_config {
+        command = ["evaluate_instance.sweep_handler"]
+    }
+    memory_size = "512"
+    publish = true
+    environment {
+        variables = {
+            INLINE_CONTAINMENT = var.inline_containment
+            SWEEP_TIME_RESERVE_SECONDS = "60"
+            DEDUP_TABLE = aws_dynamodb_table.dedup_table.name
+            ACCOUNT_ROLE_NAME = var.account_role_name
+            HOME_ACCOUNT_ID = var.account_id
+            PROFILE_COLD_START = var.profile_cold_start
+            PROFILE_WARM_ONE_IN = var.profile_warm_one_in
+            # The sweep covers this account first, then the member accounts
+            SWEEP_ACCOUNTS = join(",", concat([var.account_id], var.member_account_ids))
+        }
+    }
+}
+
+resource "aws_iam_policy" "sweep_lambda_policy" {
+    name = "sweep_lambda_policy"
+    path = "/"
+    description = "IAM policy for the sweep lambda function. Grants invoke on itself to continue a sweep"
+    policy = jsonencode({
+        Version = "2012-10-17"
+        Statement = [
+        {
+            Action = [
+            "lambda:InvokeFunction",
+            ]
+            Effect   = "Allow"
+            Resource = "arn:aws:lambda:${var.region}:${var.account_id}:function:sweep_instances"
+        },
+        ]
+    })
+}
+
+resource "aws_iam_policy_attachment" "sweep_lambda_policy_attachment" {
+    name = "sweep_lambda_policy_attachment"
+    roles       = [aws_iam_role.evaluate_lambda_role.name]
+    policy_arn = "${aws_iam_policy.sweep_lambda_policy.arn}"
 }
 
 
@@ -225,6 +322,14 @@ resource "aws_lambda_function" "lock_instance" {
     image_uri = "${aws_ecr_repository.lock_repository.repository_url}@${data.aws_ecr_image.lock_image.image_digest}"
     memory_size = "128"
     publish = true
+    environment {
+        variables = {
+            ACCOUNT_ROLE_NAME = var.account_role_name
+            HOME_ACCOUNT_ID = var.account_id
+            PROFILE_COLD_START = var.profile_cold_start
+            PROFILE_WARM_ONE_IN = var.profile_warm_one_in
+        }
+    }
     dead_letter_config {
         target_arn = aws_sqs_queue.lock_instance_dl_queue.arn
     }
@@ -233,9 +338,11 @@ resource "aws_lambda_function" "lock_instance" {
 resource "aws_lambda_event_source_mapping" "lock_instance" {
     event_source_arn = aws_sqs_queue.lock_instance_queue.arn
     function_name = aws_lambda_function.lock_instance.arn
-    batch_size = 0
+    batch_size = 10
     enabled = true
     maximum_batching_window_in_seconds = 0
+    # Handlers return the failed message IDs, so only those records are retried and redriven
+    function_response_types = ["ReportBatchItemFailures"]
 }
 
 
@@ -250,6 +357,14 @@ resource "aws_lambda_function" "stop_instance" {
     image_uri = "${aws_ecr_repository.stop_repository.repository_url}@${data.aws_ecr_image.stop_image.image_digest}"
     memory_size = "128"
     publish = true
+    environment {
+        variables = {
+            ACCOUNT_ROLE_NAME = var.account_role_name
+            HOME_ACCOUNT_ID = var.account_id
+            PROFILE_COLD_START = var.profile_cold_start
+            PROFILE_WARM_ONE_IN = var.profile_warm_one_in
+        }
+    }
     dead_letter_config {
         target_arn = aws_sqs_queue.stop_instance_dl_queue.arn
     }
@@ -258,7 +373,9 @@ resource "aws_lambda_function" "stop_instance" {
 resource "aws_lambda_event_source_mapping" "stop_instance" {
     event_source_arn = aws_sqs_queue.stop_instance_queue.arn
     function_name = aws_lambda_function.stop_instance.arn
-    batch_size = 0
+    batch_size = 10
     enabled = true
     maximum_batching_window_in_seconds = 0
+    # Handlers return the failed message IDs, so only those records are retried and redriven
+    function_response_types = ["ReportBatchItemFailures"]
 }
\ No newline at end of file
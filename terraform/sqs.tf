@@ -31,7 +31,10 @@ resource "aws_sqs_queue_policy" "get_instance_info_queue_policy" {
       "Resource": "${aws_sqs_queue.get_instance_info_queue.arn}",
       "Condition": {
         "ArnEquals": {
-          "aws:SourceArn": "${aws_cloudwatch_event_rule.instance_id.arn}"
+          "aws:SourceArn": [
+            "${aws_cloudwatch_event_rule.instance_id.arn}",
+            "${aws_cloudwatch_event_rule.security_group_changes.arn}"
+          ]
         }
       }
     }
@@ -60,7 +63,10 @@ resource "aws_sqs_queue_policy" "get_instance_info_dl_queue_policy" {
       "Resource": "${aws_sqs_queue.get_instance_info_dl_queue.arn}",
       "Condition": {
         "ArnEquals": {
-          "aws:SourceArn": "${aws_cloudwatch_event_rule.instance_id.arn}"
+          "aws:SourceArn": [
+            "${aws_cloudwatch_event_rule.instance_id.arn}",
+            "${aws_cloudwatch_event_rule.security_group_changes.arn}"
+          ]
         }
       }
     }
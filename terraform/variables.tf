@@ -3,3 +3,39 @@ variable "region" {
 }
 
 variable "account_id" {}
+
+# "stop" makes evaluate_instances stop flagged instances itself instead of routing them through the stop queue, "off" routes every decision
+variable "inline_containment" {
+  default = "off"
+}
+
+# Opt-in profiling of the lambdas: profile each container's first invocation, and 1 in profile_warm_one_in warm invocations (0 for none)
+variable "profile_cold_start" {
+  default = false
+}
+
+variable "profile_warm_one_in" {
+  default = 0
+}
+
+# How often the sweep reconciles the whole fleet
+variable "sweep_schedule" {
+  default = "rate(6 hours)"
+}
+
+# Other accounts of the organization the service protects. Each of them needs a role of this name that trusts
+# evaluate_lambda_role and stop_lock_lambda_role, and forwards its EC2 events to the bus like the regional rules do
+variable "account_role_name" {
+  default = "ec2-shutdown-service"
+}
+
+# Lets the accounts of the organization put their events on the destination bus
+variable "organization_id" {
+  default = ""
+}
+
+# Accounts the sweep covers besides this one
+variable "member_account_ids" {
+  type    = list(string)
+  default = []
+}
@@ -1,4 +1,13 @@
 import json
+import os
+import sys
+import pytest
+# The handlers import the shared module the lambda images copy next to them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'common'))
+import shutdown_common  # noqa: E402
+from src.evaluate_instance import evaluate_instance  # noqa: E402
+from src.lock_instance import lock_instance  # noqa: E402
+from src.stop_instance import stop_instance  # noqa: E402
 
 TEST_INSTANCE_ID = "i-0c8f8f8f8f8f8f8f8"
 TEST_REGION = "us-east-1"
@@ -12,4 +21,12 @@ empty_asg_response = {'AutoScalingInstances': []}
 def test_conf():
     '''Simply shows that the test config is working'''
     assert True
-    
\ No newline at end of file
+    
+@pytest.fixture(autouse=True)
+def reset_shared_clients():
+    '''The lambdas cache boto3 clients and lookups at module scope, clear them so every test builds its clients from its own mocks'''
+    for module in (evaluate_instance, lock_instance, stop_instance):
+        module.reset_clients()
+    shutdown_common.metrics.reset()
+    evaluate_instance.reset_lookup_caches()
+    yield
@@ -0,0 +1,175 @@
+import json
+import sys
+import mock
+from benchmarks import profile_report, replay, run_benchmarks
+from benchmarks.fake_aws import FakeAws
+from benchmarks.fleet import generate_fleet
+import shutdown_common
+from src.evaluate_instance import evaluate_instance
+from src.stop_instance import stop_instance
+
+### TEST API CALL SCALING
+def test_analyze_api_calls_do_not_grow_per_instance():
+    small, large = [run_benchmarks.run_scenario('analyze', size, runs=0) for size in (50, 500)]
+    # One security group snapshot per batch, the ASG lookups are chunked
+    assert large['calls_by_service']['ec2'] == small['calls_by_service']['ec2'] == 1
+    assert large['calls_per_instance'] < small['calls_per_instance']
+
+def test_evaluate_api_calls_per_instance_are_bounded():
+    small, large = [run_benchmarks.run_scenario('evaluate', size, runs=0) for size in (20, 200)]
+    assert large['calls_per_instance'] <= small['calls_per_instance']
+
+def test_route_sends_batches():
+    result = run_benchmarks.run_scenario('route', 100, runs=0)
+    # Two queue URL lookups, then one batch per 10 decisions
+    assert result['calls'] == {'sqs:GetQueueUrl': 2, 'sqs:SendMessageBatch': 10}
+
+def test_compare_flags_api_call_growth():
+    baseline = [{'scenario': 'stop', 'size': 10, 'wall_ms': 1.0, 'calls_by_service': {'ec2': 1}}]
+    results = [{'scenario': 'stop', 'size': 10, 'wall_ms': 5.0, 'calls_by_service': {'ec2': 10}}]
+    assert run_benchmarks.compare(results, baseline) == ['stop/10: ec2 calls went from 1 to 10']
+    assert len(run_benchmarks.compare(results, baseline, time_tolerance=0.5)) == 2
+
+### TEST SWEEP
+def test_sweep_finds_violations_in_fake_fleet():
+    aws = FakeAws(generate_fleet(300, regions=('us-east-1', 'eu-west-1')))
+    with aws.patched(evaluate_instance), mock.patch.object(evaluate_instance, 'SWEEP_PAGE_SIZE', 100):
+        stats = json.loads(evaluate_instance.sweep_handler({}, None)['body'])
+    assert stats['instances'] == 300
+    assert stats['decisions'] == sum(len(messages) for messages in aws.queues.values()) > 0
+    assert aws.calls[('ec2', 'DescribeInstances')] == 4
+
+### TEST SECURITY GROUP EVENTS
+def test_security_group_event_contains_instances_of_a_newly_exposed_group():
+    fleet = generate_fleet(200)
+    groups = fleet.security_groups['us-east-1']
+    events = run_benchmarks.sqs_batches(fleet.instance_events(), 10)
+    aws = FakeAws(fleet)
+    with aws.patched(evaluate_instance), mock.patch.object(shutdown_common, 'RATE_LIMIT_ENABLED', False):
+        for event in events:
+            evaluate_instance.lambda_handler(event, None)
+        routed = set(evaluate_instance.Decision.decode(body).instance_id for messages in aws.queues.values() for body in messages)
+        # A clean group used by running instances that weren't flagged gets a world open SSH rule
+        members = {}
+        for instance in fleet.instances['us-east-1'].values():
+            for sg in instance['SecurityGroups']:
+                members.setdefault(sg['GroupId'], set()).add(instance['InstanceId'])
+        group_id = next(sg_id for sg_id, instance_ids in sorted(members.items())
+                        if not evaluate_instance.security_group_violations(groups[sg_id]) and instance_ids - routed)
+        groups[group_id]['IpPermissions'].append({'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                                                   'Ipv6Ranges': [], 'PrefixListIds': [], 'UserIdGroupPairs': []})
+        aws.reset_calls()
+        body = {'security_group_event': 'AuthorizeSecurityGroupIngress', 'security_group_id': group_id, 'region': 'us-east-1', 'time': '2022-01-07T05:00:00Z'}
+        result = evaluate_instance.lambda_handler({'Records': [{'messageId': 'message-1', 'body': json.dumps(body)}]}, None)
+    assert result['batchItemFailures'] == []
+    lock_decisions = [evaluate_instance.Decision.decode(body) for body in aws.queues[evaluate_instance.LOCK_QUEUE_NAME]]
+    newly_routed = set(evaluate_instance.Decision.decode(body).instance_id for messages in aws.queues.values() for body in messages) - routed
+    instances = fleet.instances['us-east-1']
+    exposed = set(i for i in members[group_id] - routed if instances[i]['State']['Name'] == 'running'
+                  and not any(t['Key'] == 'shutdown_service_excluded' for t in instances[i].get('Tags', [])))
+    assert exposed and newly_routed == exposed
+    assert all(group_id in decision.bad_security_group_ids for decision in lock_decisions if decision.instance_id in newly_routed)
+    # The region was indexed by the first batch, the event only describes the changed group
+    assert aws.calls[('ec2', 'DescribeSecurityGroups')] == 1
+
+### TEST ACCOUNTS
+def test_accounts_are_handled_with_their_own_cached_role():
+    fleet = generate_fleet(100, regions=('us-east-1', 'eu-west-1'))
+    accounts = ('111111111111', '222222222222')
+    bodies = [dict(body, account_id=accounts[n % 2]) for n, body in enumerate(fleet.instance_events())]
+    account_of = {body['instance_id']: body['account_id'] for body in bodies}
+    aws = FakeAws(fleet)
+    with aws.patched(evaluate_instance, stop_instance), mock.patch.object(shutdown_common, 'RATE_LIMIT_ENABLED', False), \
+         mock.patch.object(shutdown_common._account_credentials, 'role_name', 'shutdown-service'):
+        for event in run_benchmarks.sqs_batches(bodies, 10):
+            assert evaluate_instance.lambda_handler(event, None)['batchItemFailures'] == []
+        stop_messages = list(aws.queues[evaluate_instance.STOP_QUEUE_NAME])
+        # The stop lambda runs in its own container, with credentials of its own
+        stop_instance.reset_clients()
+        for event in run_benchmarks.sqs_batches(stop_messages, 10):
+            assert stop_instance.lambda_handler(event, None)['batchItemFailures'] == []
+    assert stop_messages and aws.stopped == set(evaluate_instance.Decision.decode(body).instance_id for body in stop_messages)
+    routed = [evaluate_instance.Decision.decode(body) for messages in aws.queues.values() for body in messages]
+    assert routed and all(decision.account_id == account_of[decision.instance_id] for decision in routed)
+    # Each lambda assumes the role of an account once, and reuses it for every region and batch
+    assert sorted(aws.assumed_roles) == sorted('arn:aws:iam::{0}:role/shutdown-service'.format(account_id) for account_id in accounts for _ in range(2))
+    assert all(aws.clients[(account_id, 'ec2')] > 0 for account_id in accounts)
+    # The queues stay in the lambda's own account
+    assert aws.clients[(None, 'sqs')] > 0 and not any(aws.clients[(account_id, 'sqs')] for account_id in accounts)
+
+### TEST PROFILING
+def test_sampled_invocations_are_profiled_and_reported(tmp_path):
+    fleet = generate_fleet(100, regions=('us-east-1', 'eu-west-1'))
+    events = run_benchmarks.sqs_batches(fleet.instance_events(), 10)
+    aws = FakeAws(fleet)
+    profiler = shutdown_common.profiler
+    with aws.patched(evaluate_instance), mock.patch.object(shutdown_common, 'RATE_LIMIT_ENABLED', False), \
+         mock.patch.multiple(profiler, cold_start=True, warm_one_in=0, path=str(tmp_path), invocations=0):
+        # Only the cold start is profiled
+        for event in events[:5]:
+            evaluate_instance.lambda_handler(event, None)
+        assert len(list(tmp_path.glob('*.prof'))) == 1
+        # Then every warm invocation, into an injected sink
+        profiles = []
+        with mock.patch.object(profiler, 'warm_one_in', 1), mock.patch.object(profiler, 'sink', lambda tags, stats: profiles.append(tags)):
+            for event in events[5:]:
+                evaluate_instance.lambda_handler(event, None)
+        assert len(profiles) == 5 and not any(tags['cold_start'] for tags in profiles)
+    [cold] = [profile_report.load_profile(path) for path in profile_report.find_profiles([str(tmp_path)])]
+    tags, stats = cold
+    assert tags['cold_start'] and tags['batch_size'] == 10 and tags['regions'] and set(tags['stages']) >= {'parse', 'describe', 'evaluate'}
+    report = profile_report.aggregate([cold], top=50, sort='cumtime')
+    assert report['cold_starts'] == 1 and report['batch_size']['p50'] == 10
+    hot = [entry['function'] for entry in report['top']]
+    assert any('(lambda_handler)' in function for function in hot)
+    if sys.version_info < (3, 12):
+        # The regions are evaluated on the thread pool, their tasks are profiled too
+        assert any('(evaluate_region)' in function for function in hot)
+
+### TEST DEDUPLICATION
+def test_redelivered_events_make_no_api_calls():
+    evaluate, redelivery = [run_benchmarks.run_scenario(scenario, 100, runs=0) for scenario in ('evaluate', 'redelivery')]
+    assert redelivery['calls'] == evaluate['calls']
+
+def test_shared_dedup_table_drops_events_seen_by_another_container():
+    fleet = generate_fleet(50)
+    aws = FakeAws(fleet)
+    events = run_benchmarks.sqs_batches(fleet.instance_events(), 10)
+    with aws.patched(evaluate_instance), mock.patch.object(shutdown_common, 'RATE_LIMIT_ENABLED', False), \
+         mock.patch.object(evaluate_instance, '_dedup_store', evaluate_instance.DedupStore(600, 1000, 'dedup')) as dedup_store:
+        for event in events:
+            evaluate_instance.lambda_handler(event, None)
+        routed = sum(len(messages) for messages in aws.queues.values())
+        # A new container has an empty memory tier, the table still holds the claims
+        dedup_store.memory.clear()
+        aws.reset_calls()
+        for event in events:
+            evaluate_instance.lambda_handler(event, None)
+    assert aws.calls_by_service() == {'dynamodb': 50}
+    assert sum(len(messages) for messages in aws.queues.values()) == routed
+
+### TEST REPLAY
+def test_replayed_burst_contains_every_flagged_instance():
+    fleet, trace = replay.synthetic_trace('burst', 100, burst_seconds=10)
+    report = replay.replay(fleet, trace)
+    assert report['events'] == 100
+    assert report['contained'] == report['flagged'] > 0
+    assert report['containment_seconds']['p99'] is not None
+    assert all(queue['dead_letters'] == 0 for queue in report['queues'].values())
+
+def test_replayed_lock_failures_are_retried_then_dead_lettered():
+    fleet, trace = replay.synthetic_trace('mixed', 50, regions=('us-east-1', 'eu-west-1'))
+    report = replay.replay(fleet, trace, unstoppable_fraction=1.0, unlockable_fraction=1.0)
+    lock_queue = report['queues'][evaluate_instance.LOCK_QUEUE_NAME]
+    assert report['contained'] == 0
+    assert lock_queue['dead_letters'] == lock_queue['messages'] == report['flagged'] > 0
+    assert lock_queue['received'] == lock_queue['messages'] * replay.MAX_RECEIVE_COUNT
+
+def test_local_queue_waits_for_the_batching_window():
+    queue = replay.LocalQueue('queue', batch_size=3, batching_window=2.0)
+    queue.send('{}', 0.0)
+    assert queue.ready_at(0.0) == 2.0
+    queue.send('{}', 1.0)
+    queue.send('{}', 1.5)
+    assert queue.ready_at(1.5) == 1.5
+    assert len(queue.receive(1.5)) == 3
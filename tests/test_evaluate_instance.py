@@ -1,5 +1,11 @@
+import json
+import threading
+import time
 import mock
+import pytest
+from botocore.exceptions import ClientError
 from conftest import TEST_INSTANCE_ID, TEST_REGION, describe_instance_response, describe_security_groups_response, empty_asg_response
+import shutdown_common
 from src.evaluate_instance import evaluate_instance
 
 
@@ -27,6 +33,22 @@ def test_has_ssh_open():
     result = evaluate_instance.has_ssh_open(security_groups)
     assert result == expected_result
 
+def test_has_ssh_open_checks_every_range():
+    def group(*permissions):
+        return [{'GroupId': 'sg-test', 'GroupName': 'test', 'IpPermissions': list(permissions)}]
+    private_v4 = {'CidrIp': '10.0.0.0/8'}
+    assert evaluate_instance.has_ssh_open(group({'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [private_v4], 'Ipv6Ranges': [{'CidrIpv6': '::/0'}]}))
+    assert evaluate_instance.has_ssh_open(group({'IpProtocol': 'tcp', 'FromPort': 20, 'ToPort': 30, 'IpRanges': [private_v4, {'CidrIp': '0.0.0.0/0'}]}))
+    assert evaluate_instance.has_ssh_open(group({'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}))
+    assert not evaluate_instance.has_ssh_open(group({'IpProtocol': 'udp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}))
+    assert not evaluate_instance.has_ssh_open(group({'IpProtocol': 'tcp', 'FromPort': 80, 'ToPort': 443, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}))
+    assert not evaluate_instance.has_ssh_open(group({'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [private_v4], 'UserIdGroupPairs': [{'GroupId': 'sg-other'}]}))
+
+def test_find_exposures_with_custom_policies():
+    security_groups = [{'GroupId': 'sg-rdp', 'IpPermissions': [{'IpProtocol': '6', 'FromPort': 3000, 'ToPort': 4000, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}]}]
+    policies = (evaluate_instance.SSH_EXPOSURE, evaluate_instance.ExposurePolicy('rdp', 'tcp', 3389))
+    assert evaluate_instance.find_exposures(security_groups, policies) == ['rdp']
+
 def test_has_default_security_group():
     security_groups = [{'GroupName': 'default'}]
     expected_result = True
@@ -53,7 +75,7 @@ def test_check_stop_lock_no_autoscale(mock_boto_client):
     instance_dict = {'InstanceId': TEST_INSTANCE_ID, 'RootDeviceType': 'ebs'}
     mock_boto_client.return_value = mock_boto_client
     mock_boto_client.describe_auto_scaling_instances.return_value = empty_asg_response
-    expected_result = {'instance_id': TEST_INSTANCE_ID, 'action': 'stop', 'flag': 'test_flag', 'security_group_ids': ['test_group_id'], 'vpc_id': 'test_vpc_id', 'region': TEST_REGION}
+    expected_result = evaluate_instance.Decision(TEST_INSTANCE_ID, 'stop', 'test_flag', TEST_REGION, ['test_group_id'], 'test_vpc_id')
     result = evaluate_instance.stop_lock_instance(instance_dict, "test_flag", ["test_group_id"], "test_vpc_id", TEST_REGION)
     assert result == expected_result
 
@@ -64,16 +86,460 @@ def test_check_stop_lock_autoscale(mock_boto_client):
     mock_boto_client.return_value = mock_boto_client
     mock_boto_client.describe_auto_scaling_instances.return_value = response
     
-    expected_result = {'instance_id': TEST_INSTANCE_ID, 'action': 'lock', 'flag': 'test_flag', 'security_group_ids': ['test_group_id'], 'vpc_id': 'test_vpc_id', 'region': TEST_REGION}
+    expected_result = evaluate_instance.Decision(TEST_INSTANCE_ID, 'lock', 'test_flag', TEST_REGION, ['test_group_id'], 'test_vpc_id')
     result = evaluate_instance.stop_lock_instance(instance_dict, "test_flag", ["test_group_id"], "test_vpc_id", TEST_REGION)
     assert result == expected_result
 
+@mock.patch('boto3.client')
+def test_check_stop_lock_autoscale_error_keeps_vpc(mock_boto_client):
+    instance_dict = {'InstanceId': TEST_INSTANCE_ID, 'RootDeviceType': 'ebs'}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_auto_scaling_instances.side_effect = ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'denied'}}, 'DescribeAutoScalingInstances')
+    result = evaluate_instance.stop_lock_instance(instance_dict, "test_flag", ["test_group_id"], "test_vpc_id", TEST_REGION)
+    # The lock lambda needs the VPC to find the quarantine group, even when the ASG lookup failed
+    assert result == evaluate_instance.Decision(TEST_INSTANCE_ID, 'lock', 'test_flag', TEST_REGION, ['test_group_id'], 'test_vpc_id')
+    assert evaluate_instance.Decision.decode(result.encode()).vpc_id == 'test_vpc_id'
+
 ### TEST LIST INSTANCES
 @mock.patch('boto3.client')    
 def test_list_instances(mock_boto_client):
     instance_list = [TEST_INSTANCE_ID]
     mock_boto_client.return_value = mock_boto_client
     mock_boto_client.describe_instances.return_value = describe_instance_response
-    expected_result = describe_instance_response
+    instance = describe_instance_response['Reservations'][0]['Instances'][0]
+    expected_result = {'Reservations': [{'Instances': [{field: instance[field] for field in evaluate_instance.INSTANCE_FIELDS if field in instance}]}]}
     result = evaluate_instance.list_instances(instance_list, TEST_REGION)
     assert result == expected_result
+    assert 'ImageId' not in result['Reservations'][0]['Instances'][0]
+
+@mock.patch('boto3.client')
+def test_list_instances_skips_invalid_instance_ids(mock_boto_client):
+    instance = describe_instance_response['Reservations'][0]['Instances'][0]
+    instance_ids = ['i-0000000000000000{0}'.format(n) for n in range(4)]
+    def describe_instances(InstanceIds, Filters, NextToken=None):
+        if 'i-00000000000000002' in InstanceIds:
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': 'not found'}}, 'DescribeInstances')
+        return {'Reservations': [{'Instances': [dict(instance, InstanceId=instance_id)]} for instance_id in InstanceIds]}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_instances.side_effect = describe_instances
+    result = evaluate_instance.list_instances(instance_ids, TEST_REGION)
+    assert [i['InstanceId'] for i in result['Reservations'][0]['Instances']] == ['i-00000000000000000', 'i-00000000000000001', 'i-00000000000000003']
+
+@mock.patch('boto3.client')
+def test_list_instances_chunks_and_follows_next_token(mock_boto_client):
+    instance = describe_instance_response['Reservations'][0]['Instances'][0]
+    instance_ids = ['i-{0:017x}'.format(n) for n in range(evaluate_instance.INSTANCE_ID_CHUNK_SIZE + 1)]
+    def describe_instances(InstanceIds, Filters, NextToken=None):
+        if NextToken is None and len(InstanceIds) > 1:
+            return {'Reservations': [{'Instances': [dict(instance, InstanceId=InstanceIds[0])]}], 'NextToken': 'page-2'}
+        remaining = InstanceIds if NextToken is None else InstanceIds[1:]
+        return {'Reservations': [{'Instances': [dict(instance, InstanceId=instance_id)]} for instance_id in remaining]}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_instances.side_effect = describe_instances
+    result = evaluate_instance.list_instances(instance_ids, TEST_REGION)
+    assert [i['InstanceId'] for i in result['Reservations'][0]['Instances']] == instance_ids
+    assert mock_boto_client.describe_instances.call_count == 3
+
+@mock.patch('boto3.client')
+def test_list_instances_raises_on_other_errors(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_instances.side_effect = ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'denied'}}, 'DescribeInstances')
+    with pytest.raises(ValueError):
+        evaluate_instance.list_instances([TEST_INSTANCE_ID], TEST_REGION)
+
+### TEST BATCHED ANALYSIS
+@mock.patch('boto3.client')
+def test_analyze_instances_batches_lookups(mock_boto_client):
+    instance = describe_instance_response['Reservations'][0]['Instances'][0]
+    second_instance = dict(instance, InstanceId='i-0d8f8f8f8f8f8f8f8')
+    response = {'Reservations': [{'Instances': [instance, second_instance]}]}
+    default_group = {'GroupName': 'default', 'GroupId': instance['SecurityGroups'][0]['GroupId'], 'IpPermissions': []}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.return_value = {'SecurityGroups': [default_group]}
+    mock_boto_client.describe_auto_scaling_instances.return_value = {'AutoScalingInstances': [{'InstanceId': 'i-0d8f8f8f8f8f8f8f8'}]}
+    result = evaluate_instance.analyze_instances(response, TEST_REGION)
+    assert [(r.instance_id, r.action, r.flag) for r in result] == [(instance['InstanceId'], 'stop', 'default'), ('i-0d8f8f8f8f8f8f8f8', 'lock', 'default')]
+    assert mock_boto_client.describe_security_groups.call_count == 1
+    assert mock_boto_client.describe_auto_scaling_instances.call_count == 1
+
+### TEST DECISION MEMO
+@mock.patch('boto3.client')
+def test_analyze_instances_evaluates_once_per_launch_fingerprint(mock_boto_client):
+    instance = describe_instance_response['Reservations'][0]['Instances'][0]
+    burst = [dict(instance, InstanceId='i-burst{0}'.format(n)) for n in range(3)]
+    excluded = dict(instance, InstanceId='i-excluded', Tags=instance['Tags'] + [{'Key': 'shutdown_service_excluded', 'Value': 'True'}])
+    response = {'Reservations': [{'Instances': burst + [excluded]}]}
+    default_group = {'GroupName': 'default', 'GroupId': instance['SecurityGroups'][0]['GroupId'], 'IpPermissions': []}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.return_value = {'SecurityGroups': [default_group]}
+    mock_boto_client.describe_auto_scaling_instances.return_value = empty_asg_response
+    with mock.patch.object(evaluate_instance, 'evaluate_security_group_violations', wraps=evaluate_instance.evaluate_security_group_violations) as mock_evaluate:
+        result = evaluate_instance.analyze_instances(response, TEST_REGION)
+        assert [(r.instance_id, r.action) for r in result] == [(i['InstanceId'], 'stop') for i in burst]
+        assert mock_evaluate.call_count == 1
+        # A later batch from the same launch configuration reuses the memoized verdict
+        later = {'Reservations': [{'Instances': [dict(instance, InstanceId='i-burst3')]}]}
+        assert evaluate_instance.analyze_instances(later, TEST_REGION)[0].action == 'stop'
+        assert mock_evaluate.call_count == 1
+    assert mock_boto_client.describe_security_groups.call_count == 1
+    assert evaluate_instance._decision_memo.stats()['hits'] == 1
+    # The same launch configuration in another account has its own verdict
+    with mock.patch.object(evaluate_instance, 'evaluate_security_group_violations', wraps=evaluate_instance.evaluate_security_group_violations) as mock_evaluate, \
+         evaluate_instance.account_context('222222222222'):
+        evaluate_instance.analyze_instances(later, TEST_REGION)
+    assert mock_evaluate.call_count == 1
+    assert evaluate_instance._decision_memo.stats()['hits'] == 1
+
+### TEST SECURITY GROUP INDEX
+@mock.patch('boto3.client')
+def test_security_group_index_is_scanned_once_and_updated_from_events(mock_boto_client):
+    ssh_rule = {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}
+    groups = {
+        'sg-default': {'GroupId': 'sg-default', 'GroupName': 'default', 'IpPermissions': []},
+        'sg-web': {'GroupId': 'sg-web', 'GroupName': 'web', 'IpPermissions': []},
+    }
+    def describe_security_groups(GroupIds=None, MaxResults=None, NextToken=None):
+        if GroupIds is None:
+            # The scan, in pages of one group
+            ids = sorted(groups)
+            start = int(NextToken or 0)
+            page = {'SecurityGroups': [groups[ids[start]]]}
+            if start + 1 < len(ids):
+                page['NextToken'] = str(start + 1)
+            return page
+        return {'SecurityGroups': [groups[sg_id] for sg_id in GroupIds if sg_id in groups]}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.side_effect = describe_security_groups
+    violations = evaluate_instance.get_security_group_violations(['sg-default', 'sg-web'], TEST_REGION)
+    assert violations == {'sg-default': frozenset(['default']), 'sg-web': frozenset()}
+    assert evaluate_instance.evaluate_security_group_violations(TEST_INSTANCE_ID, violations)['bad_security_group_ids'] == ['sg-default']
+    assert mock_boto_client.describe_security_groups.call_count == 2
+    # An ingress rule opening SSH is applied to the index without scanning the region again
+    groups['sg-web'] = dict(groups['sg-web'], IpPermissions=[ssh_rule])
+    assert evaluate_instance.apply_security_group_events([('AuthorizeSecurityGroupIngress', 'sg-web')], TEST_REGION) == ['sg-web']
+    assert evaluate_instance.get_security_group_violations(['sg-web'], TEST_REGION) == {'sg-web': frozenset(['ssh'])}
+    assert evaluate_instance.apply_security_group_events([('DeleteSecurityGroup', 'sg-web')], TEST_REGION) == []
+    assert evaluate_instance._security_group_index.stats()['size'] == 1
+    assert evaluate_instance._security_group_index.stats()['scans'] == 1
+    assert mock_boto_client.describe_security_groups.call_count == 3
+    # A change delivered to another container is seen once the index expires
+    groups['sg-default'] = dict(groups['sg-default'], IpPermissions=[ssh_rule])
+    with mock.patch('time.monotonic', return_value=time.monotonic() + evaluate_instance.LOOKUP_CACHE_TTL_SECONDS + 1):
+        assert evaluate_instance.get_security_group_violations(['sg-default'], TEST_REGION) == {'sg-default': frozenset(['default'])}
+    assert evaluate_instance._security_group_index.stats()['scans'] == 1
+    with mock.patch('time.monotonic', return_value=time.monotonic() + evaluate_instance.SECURITY_GROUP_INDEX_TTL_SECONDS + 1):
+        assert evaluate_instance.get_security_group_violations(['sg-default'], TEST_REGION) == {'sg-default': frozenset(['default', 'ssh'])}
+    assert evaluate_instance._security_group_index.stats()['scans'] == 2
+
+def test_lambda_handler_fails_unknown_security_group_events():
+    body = '{"security_group_event": "ModifyVpcAttribute", "security_group_id": "sg-1", "region": "us-east-1"}'
+    result = evaluate_instance.lambda_handler({'Records': [{'messageId': 'message-1', 'body': body}]}, None)
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+
+def test_slow_security_group_events_are_reported_for_retry():
+    unblocked = threading.Event()
+    def apply_security_group_events(events, region):
+        if region == TEST_REGION:
+            unblocked.wait(5)
+        return []
+    region_events = {
+        (None, TEST_REGION): [('message-1', ('AuthorizeSecurityGroupIngress', 'sg-web'))],
+        (None, 'us-west-2'): [('message-2', ('AuthorizeSecurityGroupIngress', 'sg-db'))],
+    }
+    started = time.monotonic()
+    with mock.patch.object(evaluate_instance, 'apply_security_group_events', side_effect=apply_security_group_events):
+        failed_message_ids = evaluate_instance.handle_security_group_events(region_events, time.monotonic() + 0.05)
+    unblocked.set()
+    # The slow region doesn't hold the handler past the deadline, only its events are retried
+    assert failed_message_ids == ['message-1']
+    assert time.monotonic() - started < 1
+
+### TEST REGION FAN-OUT
+def test_evaluate_regions_isolates_failed_region():
+    def fake_evaluate_region(region, instance_ids):
+        if region == 'us-west-2':
+            raise KeyError('Reservations')
+        return [evaluate_instance.Decision(instance_ids[0], 'stop', 'ssh', region)], {}
+    instance_map = {(None, 'eu-west-1'): ['i-1'], (None, 'us-west-2'): ['i-2'], (None, TEST_REGION): ['i-3']}
+    with mock.patch.object(evaluate_instance, 'evaluate_region', side_effect=fake_evaluate_region):
+        instance_list, failed_locations = evaluate_instance.evaluate_regions(instance_map)
+    assert [instances[0].region for instances in instance_list] == ['eu-west-1', TEST_REGION]
+    assert failed_locations == [(None, 'us-west-2')]
+
+def test_timed_out_region_is_routed_on_retry():
+    event = {'Records': [{'messageId': 'message-1', 'body': '{"instance_id": "i-1", "region": "us-west-2", "time": "2022-01-07T04:52:50Z"}'}]}
+    decisions = [evaluate_instance.Decision('i-1', 'stop', 'ssh', 'us-west-2')]
+    unblocked, finished = threading.Event(), threading.Event()
+    def slow_list_instances(instance_ids, region):
+        unblocked.wait(5)
+        return {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'LaunchTime': '2022-01-07T04:52:00Z'}]}]}
+    def analyze_instances(response, region):
+        finished.set()
+        return list(decisions)
+    with mock.patch.object(evaluate_instance, 'list_instances', side_effect=slow_list_instances), \
+         mock.patch.object(evaluate_instance, 'analyze_instances', side_effect=analyze_instances), \
+         mock.patch.object(evaluate_instance, 'route_instance_message', return_value=[]) as mock_route:
+        with mock.patch.object(evaluate_instance, 'REGION_TIMEOUT_SECONDS', 0.05):
+            assert evaluate_instance.lambda_handler(event, None)['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+        # The timed out region finishes in the background, it must not claim the decision its retry makes
+        unblocked.set()
+        assert finished.wait(5)
+        time.sleep(0.05)
+        assert evaluate_instance.lambda_handler(event, None)['batchItemFailures'] == []
+    mock_route.assert_called_once_with([decisions])
+
+def test_lambda_handler_reports_failed_region_records():
+    event = {'Records': [{'messageId': 'message-1', 'body': '{"instance_id": "i-1", "region": "us-west-2"}'}]}
+    with mock.patch.object(evaluate_instance, 'evaluate_region', side_effect=KeyError('Reservations')):
+        result = evaluate_instance.lambda_handler(event, None)
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+
+### TEST ROUTING
+@mock.patch('boto3.client')
+def test_route_instance_message_batches_and_fails_over(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.get_queue_url.side_effect = lambda QueueName: {'QueueUrl': QueueName}
+    # The fourth stop message fails and must be re-batched to the lock queue
+    mock_boto_client.send_message_batch.side_effect = [
+        {'Failed': [{'Id': '3', 'Code': 'InternalError'}]},
+        {'Failed': []},
+        {'Failed': []},
+        {'Failed': []},
+    ]
+    stops = [evaluate_instance.Decision('i-{0}'.format(n), 'stop', 'ssh', TEST_REGION) for n in range(12)]
+    locks = [evaluate_instance.Decision('i-lock', 'lock', 'ssh', TEST_REGION)]
+    unrouted = evaluate_instance.route_instance_message([stops, locks])
+    assert unrouted == []
+    calls = mock_boto_client.send_message_batch.call_args_list
+    assert [call.kwargs['QueueUrl'] for call in calls] == ['stop_instance_queue', 'stop_instance_queue', 'lock_instance_queue']
+    assert [len(call.kwargs['Entries']) for call in calls] == [10, 2, 2]
+    assert '"i-3"' in calls[2].kwargs['Entries'][1]['MessageBody']
+    evaluate_instance.route_instance_message([locks])
+    assert mock_boto_client.get_queue_url.call_count == 2
+
+### TEST PARTIAL BATCH RESPONSES
+def test_lambda_handler_reports_unparseable_and_unrouted_records():
+    event = {'Records': [
+        {'messageId': 'message-1', 'body': 'not json'},
+        {'messageId': 'message-2', 'body': '{"instance_id": "i-2", "region": "us-east-1"}'},
+        {'messageId': 'message-3', 'body': '{"instance_id": "i-3", "region": "us-east-1"}'},
+    ]}
+    decisions = [evaluate_instance.Decision('i-2', 'stop', 'ssh', TEST_REGION), evaluate_instance.Decision('i-3', 'lock', 'ssh', TEST_REGION)]
+    with mock.patch.object(evaluate_instance, 'evaluate_region', return_value=(decisions, {})), \
+         mock.patch.object(evaluate_instance, 'route_instance_message', return_value=[decisions[1]]) as mock_route:
+        result = evaluate_instance.lambda_handler(event, None)
+    assert mock_route.call_args.args[0] == [decisions]
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-1'}, {'itemIdentifier': 'message-3'}]
+
+### TEST LOOKUP CACHES
+@mock.patch('boto3.client')
+def test_security_group_lookups_are_cached(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.return_value = describe_security_groups_response
+    security_group_id = describe_security_groups_response['SecurityGroups'][0]['GroupId']
+    ec2_client = evaluate_instance.Ec2Client(TEST_REGION)
+    ec2_client.describe_security_groups([security_group_id])
+    result = ec2_client.describe_security_groups([security_group_id])
+    assert result['SecurityGroups'] == describe_security_groups_response['SecurityGroups']
+    assert mock_boto_client.describe_security_groups.call_count == 1
+    assert evaluate_instance._security_group_cache.stats()['hits'] == 1
+    # The cache of one account doesn't answer for another
+    with evaluate_instance.account_context('222222222222'):
+        evaluate_instance.Ec2Client(TEST_REGION).describe_security_groups([security_group_id])
+    assert mock_boto_client.describe_security_groups.call_count == 2
+
+@mock.patch('boto3.client')
+def test_asg_membership_is_cached(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_auto_scaling_instances.return_value = {'AutoScalingInstances': [{'InstanceId': 'i-asg', 'AutoScalingGroupName': 'test_autoscale_group'}]}
+    assert evaluate_instance.get_auto_scaling_instance_ids(['i-asg', TEST_INSTANCE_ID], TEST_REGION) == set(['i-asg'])
+    assert evaluate_instance.get_auto_scaling_instance_ids(['i-asg', TEST_INSTANCE_ID], TEST_REGION) == set(['i-asg'])
+    assert mock_boto_client.describe_auto_scaling_instances.call_count == 1
+    with evaluate_instance.account_context('222222222222'):
+        evaluate_instance.get_auto_scaling_instance_ids(['i-asg', TEST_INSTANCE_ID], TEST_REGION)
+    assert mock_boto_client.describe_auto_scaling_instances.call_count == 2
+
+@mock.patch('boto3.client')
+def test_paginated_asg_membership_is_cached(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_auto_scaling_instances.side_effect = [
+        {'AutoScalingInstances': [{'InstanceId': 'i-asg1', 'AutoScalingGroupName': 'test_autoscale_group'}], 'NextToken': 'page-2'},
+        {'AutoScalingInstances': [{'InstanceId': 'i-asg2', 'AutoScalingGroupName': 'test_autoscale_group'}]},
+    ]
+    instance_ids = ['i-asg1', 'i-asg2', TEST_INSTANCE_ID]
+    assert evaluate_instance.get_auto_scaling_instance_ids(instance_ids, TEST_REGION) == set(['i-asg1', 'i-asg2'])
+    # Every page asks for the same instances, and the members and non members of all pages are cached
+    calls = mock_boto_client.describe_auto_scaling_instances.call_args_list
+    assert [call.kwargs['InstanceIds'] for call in calls] == [instance_ids, instance_ids]
+    assert calls[1].kwargs['NextToken'] == 'page-2'
+    assert evaluate_instance.get_auto_scaling_instance_ids(instance_ids, TEST_REGION) == set(['i-asg1', 'i-asg2'])
+    assert mock_boto_client.describe_auto_scaling_instances.call_count == 2
+
+def test_ttl_cache_expires_and_evicts():
+    cache = evaluate_instance.TTLCache('test', max_size=2, ttl_seconds=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+        assert cache.get('a') is None
+
+### TEST DEDUPLICATION
+def test_dedup_store_claims_once_until_released():
+    dedup_store = evaluate_instance.DedupStore(ttl_seconds=60, max_size=10, table_name='')
+    assert dedup_store.claim('key')
+    assert not dedup_store.claim('key')
+    dedup_store.release('key')
+    assert dedup_store.claim('key')
+    with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+        assert dedup_store.claim('key')
+
+def test_lambda_handler_drops_duplicate_events_and_releases_unrouted():
+    body = '{"instance_id": "i-1", "region": "us-east-1", "time": "2022-01-07T04:52:50Z"}'
+    event = {'Records': [{'messageId': 'message-1', 'body': body}, {'messageId': 'message-2', 'body': body}]}
+    decisions = [evaluate_instance.Decision('i-1', 'stop', 'ssh', TEST_REGION)]
+    with mock.patch.object(evaluate_instance, 'list_instances', return_value={'Reservations': [{'Instances': []}]}), \
+         mock.patch.object(evaluate_instance, 'analyze_instances', side_effect=lambda response, region: list(decisions)), \
+         mock.patch.object(evaluate_instance, 'route_instance_message', side_effect=ValueError('no queue')) as mock_route:
+        result = evaluate_instance.lambda_handler(event, None)
+        assert result['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+        # The unrouted event and its decision were released, so the retry is evaluated and routed again
+        mock_route.side_effect = None
+        mock_route.return_value = []
+        result = evaluate_instance.lambda_handler({'Records': [event['Records'][0]]}, None)
+        assert result['batchItemFailures'] == []
+        assert mock_route.call_args.args[0] == [decisions]
+        # Once routed, a redelivery is dropped before it is evaluated
+        evaluate_instance.lambda_handler({'Records': [event['Records'][1]]}, None)
+    assert mock_route.call_count == 2
+
+@mock.patch('boto3.client')
+def test_dynamodb_dedup_table_uses_conditional_puts(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    table = evaluate_instance.DynamoDbDedupTable('dedup', TEST_REGION)
+    assert table.claim('key', 600)
+    put = mock_boto_client.put_item.call_args.kwargs
+    assert put['ConditionExpression'] == 'attribute_not_exists(dedup_key) OR expires_at < :now'
+    mock_boto_client.put_item.side_effect = ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}}, 'PutItem')
+    assert not table.claim('key', 600)
+    # An unreachable table never blocks an evaluation
+    mock_boto_client.put_item.side_effect = ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'denied'}}, 'PutItem')
+    assert table.claim('key', 600)
+
+### TEST METRICS
+@mock.patch('boto3.client')
+def test_lambda_handler_flushes_one_emf_line(mock_boto_client, capsys):
+    mock_boto_client.return_value = mock_boto_client
+    throttled = ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'slow down'}}, 'DescribeInstances')
+    mock_boto_client.describe_instances.side_effect = throttled
+    event = {'Records': [{'messageId': 'message-1', 'body': '{"instance_id": "i-1", "region": "us-east-1"}'}]}
+    with mock.patch('time.sleep'):
+        result = evaluate_instance.lambda_handler(event, None)
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert len(lines) == 1
+    document = json.loads(lines[0])
+    names = [metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']]
+    assert 'Stage.parse.Duration' in names and 'Stage.describe.Duration' in names
+    assert document['ec2.DescribeInstances.Calls'] == 1
+    assert document['ec2.DescribeInstances.Throttles'] == shutdown_common.RETRY_MAX_ATTEMPTS
+    assert document['ec2.DescribeInstances.Retries'] == shutdown_common.RETRY_MAX_ATTEMPTS - 1
+    assert document['ec2.DescribeInstances.Errors'] == 1
+    assert document['ec2.DescribeInstances.BatchSize'] == [1]
+    assert document['Records'] == 1
+
+### TEST INLINE CONTAINMENT
+@mock.patch('boto3.client')
+def test_contain_inline_stops_and_falls_back_to_lock(mock_boto_client):
+    def fake_stop_instances(InstanceIds):
+        if 'i-protected' in InstanceIds:
+            raise ClientError({'Error': {'Code': 'OperationNotPermitted', 'Message': 'protected'}}, 'StopInstances')
+        return {'StoppingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.side_effect = fake_stop_instances
+    decisions = [
+        evaluate_instance.Decision('i-1', 'stop', 'ssh', TEST_REGION),
+        evaluate_instance.Decision('i-protected', 'stop', 'ssh', TEST_REGION),
+        evaluate_instance.Decision('i-asg', 'lock', 'ssh', TEST_REGION),
+        evaluate_instance.Decision('i-overflow', 'stop', 'ssh', TEST_REGION),
+    ]
+    with mock.patch.object(evaluate_instance, 'INLINE_STOP_MAX_INSTANCES', 2):
+        remaining = evaluate_instance.contain_inline(decisions, TEST_REGION)
+    assert remaining == [
+        evaluate_instance.Decision('i-protected', 'lock', 'ssh', TEST_REGION),
+        evaluate_instance.Decision('i-asg', 'lock', 'ssh', TEST_REGION),
+        evaluate_instance.Decision('i-overflow', 'stop', 'ssh', TEST_REGION),
+    ]
+
+@mock.patch('boto3.client')
+def test_inline_stop_failed_and_unrouted_is_released_for_retry(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.side_effect = ClientError({'Error': {'Code': 'IncorrectInstanceState', 'Message': 'pending'}}, 'StopInstances')
+    mock_boto_client.get_queue_url.return_value = {'QueueUrl': 'queue'}
+    mock_boto_client.send_message_batch.side_effect = ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'denied'}}, 'SendMessageBatch')
+    event = {'Records': [{'messageId': 'message-1', 'body': '{"instance_id": "i-1", "region": "us-east-1"}'}]}
+    with mock.patch.object(evaluate_instance, 'INLINE_CONTAINMENT', 'stop'), \
+         mock.patch.object(evaluate_instance, 'list_instances', return_value={'Reservations': [{'Instances': []}]}), \
+         mock.patch.object(evaluate_instance, 'analyze_instances', return_value=[evaluate_instance.Decision('i-1', 'stop', 'ssh', TEST_REGION)]):
+        assert evaluate_instance.lambda_handler(event, None)['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+        # The stop's claim was released although the decision was routed as a lock, so the retry contains the instance again
+        assert evaluate_instance.lambda_handler(event, None)['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+    assert mock_boto_client.stop_instances.call_count == 2
+    assert mock_boto_client.send_message_batch.call_count == 2
+
+def test_settle_region_routes_everything_when_inline_is_off():
+    decisions = [evaluate_instance.Decision('i-1', 'stop', 'ssh', TEST_REGION)]
+    with mock.patch.object(evaluate_instance, 'contain_inline') as mock_contain:
+        assert evaluate_instance.settle_region(TEST_REGION, decisions, {}) == decisions
+        # The same decision for the same launch would be dropped as a duplicate
+        evaluate_instance.reset_lookup_caches()
+        with mock.patch.object(evaluate_instance, 'INLINE_CONTAINMENT', 'stop'):
+            evaluate_instance.settle_region(TEST_REGION, decisions, {})
+    mock_contain.assert_called_once_with(decisions, TEST_REGION)
+
+def test_inline_stops_past_the_deadline_go_through_the_stop_queue():
+    decisions = [evaluate_instance.Decision('i-1', 'stop', 'ssh', TEST_REGION)]
+    unblocked = threading.Event()
+    def slow_contain_inline(decisions, region):
+        unblocked.wait(5)
+        return []
+    with mock.patch.object(evaluate_instance, 'INLINE_CONTAINMENT', 'stop'), \
+         mock.patch.object(evaluate_instance, 'evaluate_region', return_value=(decisions, {})), \
+         mock.patch.object(evaluate_instance, 'contain_inline', side_effect=slow_contain_inline) as mock_contain:
+        instance_list, failed_locations = evaluate_instance.evaluate_regions({(None, TEST_REGION): ['i-1']}, time.monotonic() + 0.05)
+    unblocked.set()
+    # The region was evaluated in time, only its stop is left to the stop queue
+    assert instance_list == [decisions]
+    assert failed_locations == []
+    mock_contain.assert_called_once_with(decisions, TEST_REGION)
+
+### TEST SWEEP
+@mock.patch('boto3.client')
+def test_sweep_pages_through_running_instances(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_instances.side_effect = [dict(describe_instance_response, NextToken='page-2'), {'Reservations': []}]
+    with mock.patch.object(evaluate_instance, 'sweep_page', return_value=(1, 0)) as mock_sweep_page:
+        result = evaluate_instance.sweep_handler({'regions': [TEST_REGION]}, None)
+    calls = mock_boto_client.describe_instances.call_args_list
+    assert calls[0].kwargs['Filters'] == [{'Name': 'instance-state-name', 'Values': ['running']}]
+    assert calls[1].kwargs['NextToken'] == 'page-2'
+    assert mock_sweep_page.call_count == 2
+    assert json.loads(result['body']) == {'instances': 1, 'decisions': 2, 'unrouted': 0, 'failed_regions': [], 'status': 'finished'}
+
+@mock.patch('boto3.client')
+def test_sweep_checkpoints_when_out_of_time(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_instances.return_value = dict(describe_instance_response, NextToken='page-2')
+    context = mock.Mock(invoked_function_arn='arn:aws:lambda:us-east-1:000000000000:function:sweep_instances')
+    context.get_remaining_time_in_millis.return_value = 0
+    with mock.patch.object(evaluate_instance, 'sweep_page', return_value=(0, 0)):
+        result = evaluate_instance.sweep_handler({'regions': [TEST_REGION, 'us-west-2']}, context)
+    assert json.loads(result['body'])['status'] == 'continued'
+    invoke = mock_boto_client.invoke.call_args.kwargs
+    assert invoke['InvocationType'] == 'Event'
+    checkpoint = json.loads(invoke['Payload'])
+    assert checkpoint['regions'] == [TEST_REGION, 'us-west-2']
+    assert checkpoint['next_token'] == 'page-2'
+    assert checkpoint['continuation'] == 1
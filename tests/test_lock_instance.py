@@ -0,0 +1,116 @@
+import json
+import mock
+import pytest
+from conftest import TEST_INSTANCE_ID, TEST_REGION, describe_security_groups_response
+from src.evaluate_instance import evaluate_instance
+from src.lock_instance import lock_instance
+
+SSH_GROUP_ID = describe_security_groups_response['SecurityGroups'][0]['GroupId']
+DEFAULT_GROUP = {'GroupName': 'default', 'GroupId': 'sg-default', 'IpPermissions': []}
+GOOD_GROUP = {'GroupName': 'web', 'GroupId': 'sg-web', 'IpPermissions': [{'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}]}
+
+
+def lock_decision(instance_id, flag, security_group_ids):
+    return lock_instance.Decision(instance_id, 'lock', flag, TEST_REGION, security_group_ids, 'vpc-1')
+
+### TEST SECURITY GROUPS
+def test_get_bad_security_group_ids_by_flag():
+    security_groups = describe_security_groups_response['SecurityGroups'] + [DEFAULT_GROUP, GOOD_GROUP]
+    assert lock_instance.get_bad_security_group_ids(security_groups, 'ssh') == [SSH_GROUP_ID]
+    assert lock_instance.get_bad_security_group_ids(security_groups, 'default') == ['sg-default']
+    assert lock_instance.get_bad_security_group_ids(security_groups, 'both') == [SSH_GROUP_ID, 'sg-default']
+
+def test_has_ssh_open_agrees_with_the_evaluation():
+    def ssh_group(ip_ranges=(), ipv6_ranges=()):
+        return {'GroupName': 'ssh', 'GroupId': 'sg-ssh', 'IpPermissions': [{'IpProtocol': '6', 'FromPort': 22, 'ToPort': 22,
+                'IpRanges': [{'CidrIp': cidr} for cidr in ip_ranges], 'Ipv6Ranges': [{'CidrIpv6': cidr} for cidr in ipv6_ranges]}]}
+    # A /0 block is the whole internet whatever its address bits, a group the evaluation flags is always locked
+    for group, world_open in ((ssh_group(['0.0.0.0/0']), True), (ssh_group(['10.0.0.0/0']), True), (ssh_group(ipv6_ranges=['2001:db8::/0']), True),
+                              (ssh_group(['10.0.0.0/8']), False), (ssh_group(ipv6_ranges=['::/64']), False)):
+        assert lock_instance.has_ssh_open(group) == evaluate_instance.has_ssh_open([group]) == world_open
+
+### TEST LOCK ENGINE
+@mock.patch('boto3.client')
+def test_lock_instances_resolves_groups_once(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    def fake_describe_security_groups(GroupIds=None, Filters=None):
+        if Filters:
+            # No quarantine group exists in the VPC yet
+            return {'SecurityGroups': []}
+        return {'SecurityGroups': describe_security_groups_response['SecurityGroups'] + [DEFAULT_GROUP, GOOD_GROUP]}
+    mock_boto_client.describe_security_groups.side_effect = fake_describe_security_groups
+    mock_boto_client.create_security_group.return_value = {'GroupId': 'sg-dummy'}
+    decisions = [
+        lock_decision(TEST_INSTANCE_ID, 'ssh', [SSH_GROUP_ID, 'sg-web']),
+        lock_decision('i-2', 'both', [SSH_GROUP_ID, 'sg-default']),
+        lock_decision('i-3', 'unknown', ['sg-web']),
+    ]
+    results = lock_instance.lock_instances(decisions)
+    assert results[:2] == [True, True]
+    assert isinstance(results[2], ValueError)
+    assert len([call for call in mock_boto_client.describe_security_groups.call_args_list if 'GroupIds' in call.kwargs]) == 1
+    # Both instances are in the same VPC and share one quarantine group
+    assert mock_boto_client.create_security_group.call_count == 1
+    groups = {call.kwargs['InstanceId']: sorted(call.kwargs['Groups']) for call in mock_boto_client.modify_instance_attribute.call_args_list}
+    assert groups == {TEST_INSTANCE_ID: ['sg-dummy', 'sg-web'], 'i-2': ['sg-dummy']}
+
+@mock.patch('boto3.client')
+def test_lock_instances_uses_bad_groups_from_the_message(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.return_value = {'SecurityGroups': [{'GroupId': 'sg-quarantine'}]}
+    decision = lock_decision(TEST_INSTANCE_ID, 'both', [SSH_GROUP_ID, 'sg-default', 'sg-web']).replace(bad_security_group_ids=[SSH_GROUP_ID, 'sg-default'])
+    assert lock_instance.lock_instances([decision]) == [True]
+    # Only the quarantine group lookup, the instance's groups aren't described
+    assert [call for call in mock_boto_client.describe_security_groups.call_args_list if 'GroupIds' in call.kwargs] == []
+    assert sorted(mock_boto_client.modify_instance_attribute.call_args.kwargs['Groups']) == ['sg-quarantine', 'sg-web']
+
+### TEST DECISIONS
+def test_decision_wire_format_is_compact_and_reads_the_previous_format():
+    decision = lock_decision(TEST_INSTANCE_ID, 'both', [SSH_GROUP_ID, 'sg-default'])
+    legacy_body = json.dumps({'instance_id': TEST_INSTANCE_ID, 'action': 'lock', 'flag': 'both', 'security_group_ids': [SSH_GROUP_ID, 'sg-default'],
+                              'vpc_id': 'vpc-1', 'region': TEST_REGION})
+    assert lock_instance.Decision.decode(decision.encode()) == decision
+    assert lock_instance.Decision.decode(legacy_body) == decision
+    assert len(decision.encode()) < len(legacy_body)
+    flagged = decision.replace(bad_security_group_ids=[SSH_GROUP_ID])
+    assert lock_instance.Decision.decode(flagged.encode()).bad_security_group_ids == [SSH_GROUP_ID]
+    for body in ('[2, "i-1", "lock", "both", "us-east-1"]', '[1, "i-1", "reboot", "both", "us-east-1"]', '[1, "i-1"]',
+                 '{"instance_id": "i-1", "action": "lock"}', '"i-1"'):
+        with pytest.raises(ValueError):
+            lock_instance.Decision.decode(body)
+
+### TEST HANDLER
+@mock.patch('boto3.client')
+def test_lambda_handler_reports_failed_records(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    event = {'Records': [
+        {'messageId': 'message-1', 'body': lock_decision(TEST_INSTANCE_ID, 'unknown', []).encode()},
+        {'messageId': 'message-2', 'body': 'not json'},
+        {'messageId': 'message-3', 'body': '{"instance_id": "i-3", "region": "us-east-1"}'},
+    ]}
+    result = lock_instance.lambda_handler(event, None)
+    assert sorted(failure['itemIdentifier'] for failure in result['batchItemFailures']) == ['message-1', 'message-2', 'message-3']
+
+@mock.patch('boto3.client')
+def test_get_quarantine_security_group_is_cached(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.return_value = {'SecurityGroups': [{'GroupId': 'sg-quarantine'}]}
+    assert lock_instance.get_quarantine_security_group(TEST_REGION, 'vpc-1') == 'sg-quarantine'
+    assert lock_instance.get_quarantine_security_group(TEST_REGION, 'vpc-1') == 'sg-quarantine'
+    assert mock_boto_client.describe_security_groups.call_count == 1
+    assert mock_boto_client.create_security_group.call_count == 0
+
+@mock.patch('boto3.client')
+def test_quarantine_group_is_created_without_egress(mock_boto_client):
+    default_egress = [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'Ipv6Ranges': [{'CidrIpv6': '::/0'}]}]
+    def fake_describe_security_groups(Filters):
+        if Filters[0]['Name'] == 'group-id':
+            return {'SecurityGroups': [{'GroupId': 'sg-quarantine', 'IpPermissionsEgress': default_egress}]}
+        # No quarantine group exists in the VPC yet
+        return {'SecurityGroups': []}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.describe_security_groups.side_effect = fake_describe_security_groups
+    mock_boto_client.create_security_group.return_value = {'GroupId': 'sg-quarantine'}
+    assert lock_instance.get_quarantine_security_group(TEST_REGION, 'vpc-1') == 'sg-quarantine'
+    # A locked instance can't connect out through the quarantine group
+    mock_boto_client.revoke_security_group_egress.assert_called_once_with(GroupId='sg-quarantine', IpPermissions=default_egress)
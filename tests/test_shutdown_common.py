@@ -0,0 +1,149 @@
+import datetime
+import json
+import logging
+import mock
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from conftest import TEST_INSTANCE_ID, TEST_REGION, describe_instance_response
+import shutdown_common
+
+
+### TEST CLIENT REGISTRY
+@mock.patch('boto3.client')
+def test_get_client_is_shared(mock_boto_client):
+    first_client = shutdown_common.get_client('ec2', TEST_REGION)
+    assert shutdown_common.get_client('ec2', TEST_REGION) is first_client
+    shutdown_common.get_client('ec2', 'us-west-2')
+    assert mock_boto_client.call_count == 2
+    shutdown_common.reset_clients()
+    shutdown_common.get_client('ec2', TEST_REGION)
+    assert mock_boto_client.call_count == 3
+
+@mock.patch('boto3.client')
+def test_account_clients_use_the_cached_role_until_it_is_refreshed(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    mock_boto_client.assume_role.return_value = {'Credentials': {'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'SessionToken': 'token', 'Expiration': expiration}}
+    with mock.patch.object(shutdown_common._account_credentials, 'role_name', 'shutdown-service'), shutdown_common.account_context('111111111111'):
+        shutdown_common.get_client('ec2', TEST_REGION)
+        shutdown_common.get_client('autoscaling', TEST_REGION)
+        shutdown_common.get_client('sqs', TEST_REGION)
+        assert mock_boto_client.assume_role.call_count == 1
+        assert mock_boto_client.assume_role.call_args.kwargs['RoleArn'] == 'arn:aws:iam::111111111111:role/shutdown-service'
+        # The queues stay in the lambda's own account
+        keys = {call.args[0]: call.kwargs.get('aws_access_key_id') for call in mock_boto_client.call_args_list}
+        assert keys == {'sts': None, 'ec2': 'key', 'autoscaling': 'key', 'sqs': None}
+        # Within CREDENTIAL_REFRESH_SECONDS of the expiry, the role is assumed again and the account's clients rebuilt
+        with mock.patch('time.time', return_value=expiration.timestamp() - 60):
+            shutdown_common.get_client('ec2', TEST_REGION)
+            shutdown_common.get_client('sqs', TEST_REGION)
+        assert mock_boto_client.assume_role.call_count == 2
+        assert mock_boto_client.call_count == 5
+
+def test_clients_make_a_single_attempt():
+    sent = []
+    def unreachable(request, **kwargs):
+        sent.append(request)
+        raise EndpointConnectionError(endpoint_url=request.url)
+    with mock.patch.dict('os.environ', AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing'):
+        client = shutdown_common.get_client('ec2', TEST_REGION)
+        assert client.meta.config.retries == {'mode': 'standard', 'total_max_attempts': 1}
+        # botocore doesn't retry on its own, every throttled or failed attempt reaches call_aws and the rate limiter
+        client.meta.events.register('before-send', unreachable)
+        with pytest.raises(EndpointConnectionError):
+            client.describe_instances(InstanceIds=['i-1'])
+    assert len(sent) == 1
+
+### TEST INSTANCES
+@mock.patch('boto3.client')
+def test_stop_instances_bisects_failed_call(mock_boto_client):
+    def fake_stop_instances(InstanceIds):
+        if 'i-bad' in InstanceIds:
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': 'not found'}}, 'StopInstances')
+        return {'StoppingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.side_effect = fake_stop_instances
+    result = shutdown_common.stop_instances(['i-1', 'i-2', 'i-bad', 'i-4'], TEST_REGION)
+    assert result == ['i-bad']
+
+@mock.patch('boto3.client')
+def test_stop_instances_fails_the_call_at_once_on_other_errors(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.side_effect = ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'denied'}}, 'StopInstances')
+    result = shutdown_common.stop_instances(['i-1', 'i-2', 'i-3', 'i-4'], TEST_REGION)
+    assert result == ['i-1', 'i-2', 'i-3', 'i-4']
+    # Bisecting would only repeat the error, once per half
+    assert mock_boto_client.stop_instances.call_count == 1
+
+### TEST LOGGING
+def test_json_log_records_carry_the_log_context():
+    record = logging.LogRecord('ec2_common_logger', logging.INFO, __file__, 1, "Checking instance: %s", (TEST_INSTANCE_ID,), None)
+    with shutdown_common.log_context(request_id='request-1', region=TEST_REGION), shutdown_common.metrics.stage('evaluate'):
+        assert shutdown_common.ContextFilter().filter(record)
+    document = json.loads(shutdown_common.JsonFormatter().format(record))
+    assert document['message'] == 'Checking instance: ' + TEST_INSTANCE_ID
+    assert (document['request_id'], document['region'], document['stage'], document['instance_id']) == ('request-1', TEST_REGION, 'evaluate', None)
+
+def test_high_volume_log_records_are_sampled():
+    def record(level):
+        record = logging.LogRecord('ec2_common_logger', level, __file__, 1, "message", (), None)
+        record.sampled = True
+        return record
+    with mock.patch('random.random', return_value=0.5):
+        assert not shutdown_common.ContextFilter().filter(record(logging.INFO))
+        assert shutdown_common.ContextFilter().filter(record(logging.WARNING))
+    with mock.patch('random.random', return_value=0.05):
+        assert shutdown_common.ContextFilter().filter(record(logging.INFO))
+
+def test_payloads_are_summarized_unless_enabled():
+    payload = shutdown_common.Payload(describe_instance_response)
+    assert str(payload) == "{Reservations: [1 items]}"
+    with mock.patch.object(shutdown_common, 'LOG_PAYLOADS', True), mock.patch.object(shutdown_common, 'LOG_PAYLOAD_MAX_CHARS', 20):
+        assert str(payload).startswith('{"Reservations": [{"') and str(payload).endswith('chars)')
+
+### TEST METRICS
+def test_metrics_disabled_records_nothing(capsys):
+    recorder = shutdown_common.MetricsRecorder('test', 'test', enabled=False)
+    with mock.patch.object(shutdown_common, 'metrics', recorder):
+        assert shutdown_common.call_aws('ec2', TEST_REGION, 'DescribeInstances', lambda **kwargs: kwargs, InstanceIds=['i-1']) == {'InstanceIds': ['i-1']}
+        with shutdown_common.metrics.stage('parse'):
+            pass
+        recorder.flush()
+    assert recorder.snapshot() is None
+    assert capsys.readouterr().out == ''
+
+### TEST RATE LIMITING
+def test_rate_limiter_backs_off_and_recovers():
+    limiter = shutdown_common.AdaptiveRateLimiter(rate=20, min_rate=1, max_rate=40)
+    limiter.on_throttle()
+    assert limiter.rate == 10
+    # Concurrent throttles within the cooldown are one signal
+    limiter.on_throttle()
+    assert limiter.rate == 10
+    for _ in range(10):
+        limiter.on_success()
+    assert 10.9 < limiter.rate < 11
+
+def test_rate_limiter_is_shared_per_service_and_region():
+    limiter = shutdown_common.get_rate_limiter('ec2', TEST_REGION)
+    assert shutdown_common.get_rate_limiter('ec2', TEST_REGION) is limiter
+    assert shutdown_common.get_rate_limiter('ec2', 'us-west-2') is not limiter
+
+@mock.patch('time.sleep')
+def test_call_aws_retries_throttles_with_jitter(mock_sleep):
+    throttled = ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'DescribeAutoScalingInstances')
+    method = mock.Mock(side_effect=[throttled, throttled, {'AutoScalingInstances': []}])
+    with mock.patch('random.uniform', return_value=0.05) as mock_uniform:
+        response = shutdown_common.call_aws('autoscaling', TEST_REGION, 'DescribeAutoScalingInstances', method, InstanceIds=['i-1'])
+    assert response == {'AutoScalingInstances': []}
+    assert method.call_count == 3
+    # Full jitter over an exponentially growing window
+    assert [call.args for call in mock_uniform.call_args_list] == [(0, 0.2), (0, 0.4)]
+    mock_sleep.assert_any_call(0.05)
+    assert shutdown_common.get_rate_limiter('autoscaling', TEST_REGION).rate < shutdown_common.RATE_LIMIT_INITIAL_RATE
+
+def test_call_aws_does_not_retry_other_errors():
+    method = mock.Mock(side_effect=ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': 'not found'}}, 'DescribeInstances'))
+    with pytest.raises(ClientError):
+        shutdown_common.call_aws('ec2', TEST_REGION, 'DescribeInstances', method, InstanceIds=['i-1'])
+    assert method.call_count == 1
@@ -0,0 +1,67 @@
+import datetime
+import json
+import mock
+from botocore.exceptions import ClientError, EndpointConnectionError
+from conftest import TEST_INSTANCE_ID, TEST_REGION
+import shutdown_common
+from src.stop_instance import stop_instance
+
+
+def stop_record(message_id, instance_id, region=TEST_REGION):
+    return {'messageId': message_id, 'body': '{"instance_id": "%s", "region": "%s", "action": "stop"}' % (instance_id, region)}
+
+### TEST HANDLER
+@mock.patch('boto3.client')
+def test_lambda_handler_stops_each_region_once(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.return_value = {'StoppingInstances': [{'InstanceId': TEST_INSTANCE_ID}]}
+    event = {'Records': [
+        stop_record('message-1', TEST_INSTANCE_ID),
+        {'messageId': 'message-2', 'body': '{"region": "us-east-1"}'},
+        stop_record('message-3', 'i-2'),
+        stop_record('message-4', 'i-3', 'us-west-2'),
+    ]}
+    result = stop_instance.lambda_handler(event, None)
+    assert [call.kwargs['InstanceIds'] for call in mock_boto_client.stop_instances.call_args_list] == [[TEST_INSTANCE_ID, 'i-2'], ['i-3']]
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-2'}]
+
+@mock.patch('boto3.client')
+def test_lambda_handler_forwards_failed_stops_to_lock_queue(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.side_effect = ClientError({'Error': {'Code': 'OperationNotPermitted', 'Message': 'protected'}}, 'StopInstances')
+    mock_boto_client.get_queue_url.return_value = {'QueueUrl': 'lock_instance_queue'}
+    mock_boto_client.send_message_batch.return_value = {'Failed': [{'Id': '1', 'Code': 'InternalError'}]}
+    result = stop_instance.lambda_handler({'Records': [stop_record('message-1', 'i-1'), stop_record('message-2', 'i-2')]}, None)
+    assert mock_boto_client.send_message_batch.call_count == 1
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-2'}]
+
+@mock.patch('boto3.client')
+def test_lambda_handler_fails_only_the_records_of_an_unreachable_account(mock_boto_client):
+    mock_boto_client.return_value = mock_boto_client
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    def fake_assume_role(RoleArn, **kwargs):
+        if '222222222222' in RoleArn:
+            raise EndpointConnectionError(endpoint_url='https://sts.amazonaws.com')
+        return {'Credentials': {'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'SessionToken': 'token', 'Expiration': expiration}}
+    mock_boto_client.assume_role.side_effect = fake_assume_role
+    mock_boto_client.stop_instances.return_value = {'StoppingInstances': [{'InstanceId': 'i-1'}]}
+    records = [{'messageId': 'message-{0}'.format(n), 'body': stop_instance.Decision('i-{0}'.format(n), 'stop', None, TEST_REGION, account_id=account_id).encode()}
+               for n, account_id in ((1, '111111111111'), (2, '222222222222'))]
+    with mock.patch.object(shutdown_common._account_credentials, 'role_name', 'shutdown-service'):
+        result = stop_instance.lambda_handler({'Records': records}, None)
+    # The STS error is the account's alone, the other account's instances are still stopped
+    assert [call.kwargs['InstanceIds'] for call in mock_boto_client.stop_instances.call_args_list] == [['i-1']]
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'message-2'}]
+
+### TEST METRICS
+@mock.patch('boto3.client')
+def test_lambda_handler_flushes_stop_metrics(mock_boto_client, capsys):
+    mock_boto_client.return_value = mock_boto_client
+    mock_boto_client.stop_instances.return_value = {'StoppingInstances': [], 'ResponseMetadata': {'RetryAttempts': 1}}
+    stop_instance.lambda_handler({'Records': [stop_record('message-1', 'i-1'), stop_record('message-2', 'i-2')]}, None)
+    document = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert document['FunctionName'] == 'stop_instance'
+    assert document['ec2.StopInstances.Calls'] == 1
+    assert document['ec2.StopInstances.Retries'] == 1
+    assert document['ec2.StopInstances.BatchSize'] == [2]
+    assert len(document['Stage.stop.Duration']) == 1